@@ -1,23 +1,55 @@
+from datetime import timedelta
+from django.utils import timezone
 from rest_framework import serializers
 from rest_framework.exceptions import ValidationError
 
-from apps.donation.models import Donation, ManualPayment
+from apps.donation.models import Donation, DonationRollup, DonorTotal, ManualPayment, PaymentUpload
+from apps.libs.midtrans import Midtrans
 from apps.utils.file import get_content_file_from_base64
 
 
 class ManualPaymentSerializer(serializers.Serializer):
     bank_name = serializers.CharField()
-    payment_file = serializers.CharField()
+    payment_file = serializers.CharField(required=False, allow_blank=True)
+    payment_upload = serializers.PrimaryKeyRelatedField(
+        queryset=PaymentUpload.objects.all(),
+        required=False,
+        allow_null=True,
+    )
 
     def validate_payment_file(self, value: str):
         if not value:
             return None
         return get_content_file_from_base64(value)
 
+    def validate(self, attrs):
+        payment_upload = attrs.get('payment_upload')
+        if payment_upload is not None:
+            if payment_upload.user_id != self.context.get('request').user.id:
+                raise ValidationError("Unknown payment upload")
+            if payment_upload.used_at is not None:
+                raise ValidationError("Payment upload is already used")
+            attrs['payment_file'] = payment_upload.file.name
+        if not attrs.get('payment_file'):
+            raise ValidationError("Payment file is required")
+        return attrs
+
+
+class PaymentUploadSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = PaymentUpload
+        fields = ('id', 'size', 'sha256', 'content_type', 'date_created')
+
 
 class InstantPaymentSerializer(serializers.Serializer):
     bank_code = serializers.CharField()
 
+    def validate_bank_code(self, value: str):
+        bank_codes = [bank['code'] for bank in Midtrans.instance().get_available_banks()]
+        if value not in bank_codes:
+            raise ValidationError("Unknown bank")
+        return value
+
 class CreateDonationSerializer(serializers.ModelSerializer):
     manual_payment = ManualPaymentSerializer(required=False, allow_null=True)
     instant_payment = InstantPaymentSerializer(required=False, allow_null=True)
@@ -40,11 +72,15 @@ class CreateDonationSerializer(serializers.ModelSerializer):
     
     def create_manual_payment(self, validated_data):
         user = self.context.get('request').user
+        manual_payment = dict(validated_data.get('manual_payment'))
+        payment_upload = manual_payment.pop('payment_upload', None)
+        if payment_upload is not None and not payment_upload.claim():
+            raise ValidationError("Payment upload is already used")
         donation = Donation.create_manual_payment(
             streaming=validated_data.get('streaming'),
             user=user,
             amount=validated_data.get('amount'),
-            payment=ManualPayment(**validated_data.get('manual_payment'))
+            payment=ManualPayment(**manual_payment)
         )
         return donation
     
@@ -83,11 +119,17 @@ class DonationSerializer(serializers.ModelSerializer):
     def get_manual_payment(self, obj: Donation):
         request = self.context.get('request')
         payment_file = None
-        if obj.payment_file.name:
+        payment_thumbnail = None
+        if obj.payment_image.name:
+            payment_file = request.build_absolute_uri(obj.payment_image.url)
+        elif obj.payment_file.name:
             payment_file = request.build_absolute_uri(obj.payment_file.url)
+        if obj.payment_thumbnail.name:
+            payment_thumbnail = request.build_absolute_uri(obj.payment_thumbnail.url)
         return {
             'bank_name': obj.bank_name,
             'payment_file': payment_file,
+            'payment_thumbnail': payment_thumbnail,
         }
     
     def get_instant_payment(self, obj: Donation):
@@ -112,5 +154,143 @@ class DonationSerializer(serializers.ModelSerializer):
         )
 
 
+class DonationFeedSerializer(serializers.BaseSerializer):
+    FIELDS = (
+        'id',
+        'user',
+        'user__id',
+        'user__first_name',
+        'user__last_name',
+        'user__email',
+        'streaming_id',
+        'amount',
+        'status',
+        'payment_type',
+        'bank_name',
+        'payment_file',
+        'payment_image',
+        'payment_thumbnail',
+        'bank_code',
+        'va_number',
+        'success_at',
+        'date_created',
+        'date_updated',
+    )
+    datetime_field = serializers.DateTimeField()
+
+    @classmethod
+    def optimize(cls, queryset):
+        return queryset.with_related(('user',), cls.FIELDS)
+
+    def get_base_uri(self):
+        # built once per response instead of once per row
+        if not hasattr(self, '_base_uri'):
+            self._base_uri = self.context.get('request').build_absolute_uri('/')[:-1]
+        return self._base_uri
+
+    def get_file_url(self, file):
+        if not file.name:
+            return None
+        url = file.url
+        if url.startswith('/'):
+            return self.get_base_uri() + url
+        return url
+
+    def to_representation(self, obj: Donation):
+        user = obj.user
+        return {
+            'id': obj.id,
+            'user': {
+                'id': user.id,
+                'name': user.name,
+                'email': user.email,
+            },
+            'amount': obj.amount,
+            'status': obj.status,
+            'payment_type': obj.payment_type,
+            'manual_payment': {
+                'bank_name': obj.bank_name,
+                'payment_file': self.get_file_url(obj.payment_image) or self.get_file_url(obj.payment_file),
+                'payment_thumbnail': self.get_file_url(obj.payment_thumbnail),
+            },
+            'instant_payment': {
+                'bank_code': obj.bank_code,
+                'va_number': obj.va_number,
+            },
+            'success_at': self.datetime_field.to_representation(obj.success_at) if obj.success_at else None,
+            'date_created': self.datetime_field.to_representation(obj.date_created),
+            'date_updated': self.datetime_field.to_representation(obj.date_updated),
+        }
+
+
+class DonationHistorySerializer(DonationFeedSerializer):
+    FIELDS = DonationFeedSerializer.FIELDS + (
+        'streaming',
+        'streaming__code',
+        'streaming__status',
+        'streaming__user',
+    )
+
+    @classmethod
+    def optimize(cls, queryset):
+        return queryset.with_related(('user', 'streaming'), cls.FIELDS)
+
+    def to_representation(self, obj: Donation):
+        data = super().to_representation(obj)
+        streaming = obj.streaming
+        data['streaming'] = {
+            'code': streaming.code,
+            'status': streaming.status,
+            'user': streaming.user_id,
+        }
+        return data
+
+
 class ConfirmDonationSerializer(serializers.Serializer):
     valid = serializers.BooleanField()
+
+
+class ReviewDonationsSerializer(serializers.Serializer):
+    ids = serializers.ListField(child=serializers.IntegerField(), allow_empty=False, max_length=500)
+    valid = serializers.BooleanField()
+
+
+class DonorTotalSerializer(serializers.ModelSerializer):
+    user = serializers.SerializerMethodField()
+
+    def get_user(self, obj: DonorTotal):
+        user = obj.user
+        return {
+            'id': user.id,
+            'name': user.name,
+        }
+
+    class Meta:
+        model = DonorTotal
+        fields = ('user', 'total', 'donation_count')
+
+
+class DonationStatsQuerySerializer(serializers.Serializer):
+    GRANULARITIES = {'minute': DonationRollup.MINUTE, 'hour': DonationRollup.HOUR}
+    MAX_POINTS = 1000
+
+    granularity = serializers.ChoiceField(choices=tuple(GRANULARITIES), default='minute')
+    since = serializers.DateTimeField(required=False)
+    until = serializers.DateTimeField(required=False)
+    step = serializers.IntegerField(min_value=1, default=1)
+
+    def validate(self, attrs):
+        granularity = self.GRANULARITIES[attrs['granularity']]
+        until = attrs.get('until') or timezone.now()
+        since = attrs.get('since') or until - timedelta(seconds=granularity * 60)
+        if since > until:
+            raise ValidationError("Since cannot be greater than until")
+        if (until - since).total_seconds() // (granularity * attrs['step']) >= self.MAX_POINTS:
+            raise ValidationError(f"Range is too long, use a larger step or granularity (at most {self.MAX_POINTS} points)")
+        return {'granularity': granularity, 'since': since, 'until': until, 'step': attrs['step']}
+
+
+class DonationStatsSerializer(serializers.Serializer):
+    bucket_start = serializers.DateTimeField()
+    total = serializers.FloatField()
+    donation_count = serializers.IntegerField()
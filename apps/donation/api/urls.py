@@ -7,6 +7,7 @@ urlpatterns = []
 
 router = DefaultRouter()
 router.register('donations', views.donation_view, basename='donation')
+router.register('payment-uploads', views.payment_upload_view, basename='payment-upload')
 router.register('midtrans/callback', views.midtrans_callback_view, basename='midtrans-callback')
 
 urlpatterns += router.urls
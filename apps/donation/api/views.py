@@ -1,31 +1,52 @@
+from django.conf import settings
+from django.db import transaction
 from rest_framework import status, permissions
 from rest_framework.response import Response
-from rest_framework.exceptions import NotFound
+from rest_framework.exceptions import NotFound, ValidationError
 from rest_framework.viewsets import GenericViewSet
 from rest_framework.decorators import action
 
-from apps.donation.models import Donation
+from apps.donation.models import Donation, PaymentUpload, PendingConfirmationCount
 from apps.donation.api.serializers import (
     ConfirmDonationSerializer,
     CreateDonationSerializer,
+    DonationFeedSerializer,
+    DonationHistorySerializer,
     DonationSerializer,
+    PaymentUploadSerializer,
+    ReviewDonationsSerializer,
 )
 from apps.libs.midtrans import Midtrans
+from apps.streaming.models import Streaming
+from apps.utils.db import ReplicaReadMixin
+from apps.utils.file import FileTooLarge, StreamingFileWriter, StreamingUploadHandler
+from apps.utils.lru import LRUSet
+from apps.utils.paginations import FeedPagination, KeysetPagination
+from apps.utils.throttles import StreamRateThrottle
 
 
-class DonationView(GenericViewSet):
+class DonationView(ReplicaReadMixin, GenericViewSet):
     permission_classes = (permissions.IsAuthenticatedOrReadOnly,)
+    replica_actions = ('list', 'retrieve', 'mine', 'pending', 'pending_count')
+    pagination_class = FeedPagination
+    keyset_ordering = ('date_created', 'id')
+    throttle_scope = 'donations'
 
     def get_queryset(self):
         streaming_code = self.request.query_params.get('stream')
-        return Donation.objects.filter(streaming=streaming_code, status__in=(Donation.NEED_CONFIRMATION_STATUS, Donation.SUCCESS_STATUS)).order_by('date_created')
+        return Donation.objects.for_stream(streaming_code).filter(status__in=(Donation.NEED_CONFIRMATION_STATUS, Donation.SUCCESS_STATUS)).order_by('date_created', 'id')
     
     def get_object(self):
-        donation = Donation.objects.filter(id=self.kwargs['pk']).first()
+        donation = Donation.objects.filter(id=self.kwargs['pk']).find()
         if donation is None:
             raise NotFound()
         return donation
 
+    def get_throttles(self):
+        if self.action == 'create':
+            return [StreamRateThrottle()]
+        return super().get_throttles()
+
     def create(self, request):
         serializer = CreateDonationSerializer(data=request.data, context=self.get_serializer_context())
         serializer.is_valid(raise_exception=True)
@@ -35,8 +56,8 @@ class DonationView(GenericViewSet):
         return Response(response_serializer.data, status=status.HTTP_201_CREATED)
     
     def list(self, request):
-        donations = self.paginate_queryset(self.get_queryset())
-        serializer = DonationSerializer(donations, many=True, context=self.get_serializer_context())
+        donations = self.paginate_queryset(DonationFeedSerializer.optimize(self.get_queryset()))
+        serializer = DonationFeedSerializer(donations, many=True, context=self.get_serializer_context())
         return self.get_paginated_response(serializer.data)
     
     def retrieve(self, request, pk):
@@ -58,29 +79,122 @@ class DonationView(GenericViewSet):
 
         return Response(status=status.HTTP_204_NO_CONTENT)
 
+    @action(
+        methods=['get'],
+        detail=False,
+        permission_classes=(permissions.IsAuthenticated,),
+        pagination_class=KeysetPagination,
+        keyset_ordering=('-date_created', '-id'),
+    )
+    def mine(self, request):
+        queryset = Donation.objects.filter(user=request.user)
+        donations = self.paginate_queryset(DonationHistorySerializer.optimize(queryset))
+        serializer = DonationHistorySerializer(donations, many=True, context=self.get_serializer_context())
+        return self.get_paginated_response(serializer.data)
+
+    @action(methods=['get'], detail=False, permission_classes=(permissions.IsAuthenticated,))
+    def pending(self, request):
+        queryset = (
+            Donation.objects
+            .in_streams(Streaming.objects.filter(user=request.user).values('code'))
+            .filter(status=Donation.NEED_CONFIRMATION_STATUS)
+            .order_by('date_created')
+        )
+        donations = self.paginate_queryset(DonationFeedSerializer.optimize(queryset))
+        serializer = DonationFeedSerializer(donations, many=True, context=self.get_serializer_context())
+        return self.get_paginated_response(serializer.data)
+
+    @action(methods=['get'], detail=False, url_path='pending/count', permission_classes=(permissions.IsAuthenticated,))
+    def pending_count(self, request):
+        return Response({'count': PendingConfirmationCount.get_count(request.user.id)})
+
+    @action(methods=['post'], detail=False, permission_classes=(permissions.IsAuthenticated,))
+    def review(self, request):
+        serializer = ReviewDonationsSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        ids = list(dict.fromkeys(serializer.validated_data.get('ids')))
+
+        results = Donation.review_many(ids, request.user, serializer.validated_data.get('valid'))
+        return Response({'results': [{'id': id, 'result': results[id]} for id in ids]})
+
+
+class PaymentUploadView(GenericViewSet):
+    permission_classes = (permissions.IsAuthenticated,)
+    chunk_size = 64 * 1024
+
+    def create(self, request):
+        max_size = settings.PAYMENT_UPLOAD_MAX_SIZE
+        content_length = request.META.get('CONTENT_LENGTH')
+        if content_length and content_length.isdigit() and int(content_length) > max_size + self.chunk_size:
+            raise ValidationError("File is too large")
+
+        if request.content_type.startswith('multipart/form-data'):
+            file = self.receive_multipart(request, max_size)
+        else:
+            file = self.receive_raw(request, max_size)
+
+        try:
+            upload = PaymentUpload.create(request.user, file)
+        except Exception as error:
+            raise ValidationError(str(error))
+        finally:
+            file.close()
+
+        serializer = PaymentUploadSerializer(upload, context=self.get_serializer_context())
+        return Response(serializer.data, status=status.HTTP_201_CREATED)
+
+    def receive_multipart(self, request, max_size):
+        handler = StreamingUploadHandler(request._request, max_size)
+        request._request.upload_handlers = [handler]
+        file = request.FILES.get('file')
+        if handler.too_large:
+            raise ValidationError("File is too large")
+        if file is None:
+            raise ValidationError("File is required")
+        return file
+
+    def receive_raw(self, request, max_size):
+        stream = request.stream
+        if stream is None:
+            raise ValidationError("File is required")
+
+        writer = StreamingFileWriter(max_size)
+        try:
+            for chunk in iter(lambda: stream.read(self.chunk_size), b''):
+                writer.write(chunk)
+        except FileTooLarge:
+            raise ValidationError("File is too large")
+        return writer.complete()
+
 
 class MidtransCallbackView(GenericViewSet):
     permission_classes = ()
     authentication_classes = ()
 
+    processed_notifications = LRUSet(settings.MIDTRANS_NOTIFICATION_CACHE_SIZE)
+
     def create(self, request):
-        midtrans = Midtrans()
+        midtrans = Midtrans.instance()
         if not midtrans.validate_transaction_signature(request.data):
             return Response({"error": "Invalid signature"}, status=status.HTTP_400_BAD_REQUEST)
 
-        transaction_id = request.data.get("transaction_id")
-        payment = midtrans.get_transaction_detail(transaction_id)
-        donation = Donation.objects.filter(payment_id=transaction_id).first()
-        if donation is None:
+        # only order_id is signed, transaction_id and transaction_status are not trusted to pick or skip anything
+        order_id = request.data.get("order_id")
+        if (order_id, request.data.get("transaction_status")) in self.processed_notifications:
             return Response()
-        
-        if payment.is_success:
-            donation.mark_as_success()
-        elif payment.is_failed:
-            donation.mark_as_failed()
 
+        if settings.MIDTRANS_TRUST_NOTIFICATION and midtrans.is_notification_consistent(request.data):
+            payment = midtrans.get_notification_payment(request.data)
+        else:
+            payment = midtrans.get_transaction_detail(order_id)
+        Donation.apply_payment(payment)
+
+        # the status that was applied is remembered, not the one the notification claimed
+        notification_key = (order_id, payment.transaction_status)
+        transaction.on_commit(lambda: self.processed_notifications.add(notification_key))
         return Response()
 
 
 donation_view = DonationView
+payment_upload_view = PaymentUploadView
 midtrans_callback_view = MidtransCallbackView
@@ -0,0 +1,114 @@
+import random
+import secrets
+from datetime import timedelta
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.utils import timezone
+
+from apps.donation.models import Donation, DonationRollup, DonorTotal
+from apps.streaming.models import Comment, Streaming, StreamingRanking
+
+User = get_user_model()
+
+
+class Command(BaseCommand):
+    help = 'EXPLAIN the hot list and callback queries and fail on sequential scans'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--seed', type=int, default=0, help='Insert this many donations and comments first (rolled back afterwards)')
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            stream_code, payment_id = self.seed(options['seed'])
+            if connection.vendor == 'postgresql':
+                with connection.cursor() as cursor:
+                    cursor.execute('ANALYZE')
+                    # make the planner pick an index whenever one can serve the query
+                    cursor.execute('SET LOCAL enable_seqscan = off')
+
+            failures = []
+            for name, queryset in self.get_queries(stream_code, payment_id):
+                plan = queryset.explain()
+                self.stdout.write(f'== {name}\n{plan}\n')
+                if self.has_sequential_scan(plan):
+                    failures.append(name)
+
+            transaction.set_rollback(True)
+
+        if failures:
+            raise CommandError(f'Sequential scan in: {", ".join(failures)}')
+        self.stdout.write(self.style.SUCCESS('No sequential scans'))
+
+    def get_queries(self, stream_code, payment_id):
+        user_id = Streaming.objects.filter(code=stream_code).values_list('user', flat=True).first() or 0
+        return (
+            ('donation list', Donation.objects.filter(
+                streaming=stream_code,
+                status__in=(Donation.NEED_CONFIRMATION_STATUS, Donation.SUCCESS_STATUS),
+            ).order_by('date_created', 'id')[:10]),
+            ('midtrans callback', Donation.objects.filter(payment_id=payment_id)),
+            ('comment list', Comment.objects.filter(streaming=stream_code).order_by('-date_created')),
+            ('leaderboard', DonorTotal.get_leaderboard(stream_code, 10)),
+            ('streams due to start', Streaming.objects.filter(
+                status__in=(Streaming.PENDING,),
+                date_start__lte=timezone.now(),
+            ).order_by('date_start')[:100]),
+            ('streams due to end', Streaming.objects.filter(
+                status__in=(Streaming.PENDING, Streaming.LIVE),
+                date_end__lte=timezone.now(),
+            ).order_by('date_end')[:100]),
+            ('pending confirmations', Donation.objects.in_streams(
+                Streaming.objects.filter(user=user_id).values('code'),
+            ).filter(status=Donation.NEED_CONFIRMATION_STATUS).order_by('date_created')),
+            ('donation history', Donation.objects.filter(user=user_id).order_by('-date_created', '-id')[:10]),
+            ('donation stats', DonationRollup.objects.filter(
+                streaming=stream_code,
+                granularity=DonationRollup.MINUTE,
+                bucket_start__gte=timezone.now() - timedelta(hours=1),
+            )),
+            ('trending streams', StreamingRanking.objects.order_by('-score', 'streaming_id')[:10]),
+        )
+
+    def has_sequential_scan(self, plan):
+        if connection.vendor == 'postgresql':
+            return 'Seq Scan' in plan
+        if connection.vendor == 'sqlite':
+            return any(' SCAN ' in line and 'USING' not in line for line in plan.splitlines())
+        return False
+
+    def seed(self, count):
+        if not count:
+            streaming = Streaming.objects.first()
+            donation = Donation.objects.exclude(payment_id=None).first()
+            return (
+                streaming.code if streaming else 'seed0000',
+                donation.payment_id if donation else 'seed-payment',
+            )
+
+        user = User.register('Query Plan', f'query-plan-{secrets.token_hex(8)}@example.com', secrets.token_hex(16))
+        now = timezone.now()
+        streams = []
+        for _ in range(max(count // 1000, 10)):
+            streaming = Streaming(user=user, date_start=now, date_end=now + timedelta(hours=1))
+            streaming.set_code()
+            streams.append(streaming)
+        Streaming.objects.bulk_create(streams)
+
+        Donation.objects.bulk_create([
+            Donation(
+                user=user,
+                streaming=random.choice(streams),
+                amount=random.randint(1, 100) * 1000,
+                payment_type=Donation.INSTANT_PAYMENT,
+                status=random.choice(Donation.STATUS_CHOICES)[0],
+                payment_id=f'seed-payment-{index}',
+            )
+            for index in range(count)
+        ], batch_size=1000)
+        Comment.objects.bulk_create([
+            Comment(user=user, streaming=random.choice(streams), comment='seed')
+            for _ in range(count)
+        ], batch_size=1000)
+
+        return streams[0].code, 'seed-payment-0'
@@ -0,0 +1,33 @@
+from datetime import timedelta
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from apps.donation.models import PaymentUpload
+
+
+class Command(BaseCommand):
+    help = 'Delete payment uploads that no donation claimed within the given hours, together with their files'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--hours', type=int, default=24)
+        parser.add_argument('--batch-size', type=int, default=500)
+
+    def handle(self, *args, **options):
+        cutoff = timezone.now() - timedelta(hours=options['hours'])
+        queryset = PaymentUpload.objects.filter(used_at=None, date_created__lt=cutoff)
+        storage = PaymentUpload._meta.get_field('file').storage
+
+        deleted = 0
+        while True:
+            files = dict(queryset.order_by('date_created').values_list('id', 'file')[:options['batch_size']])
+            if not files:
+                break
+            # the delete repeats the used_at check, an upload claimed in the meantime keeps its row and file
+            queryset.filter(id__in=files).delete()
+            kept = set(PaymentUpload.objects.filter(id__in=files).values_list('id', flat=True))
+            for upload_id, name in files.items():
+                if upload_id not in kept:
+                    storage.delete(name)
+                    deleted += 1
+
+        self.stdout.write(self.style.SUCCESS(f'Deleted {deleted} unclaimed payment uploads'))
@@ -0,0 +1,27 @@
+from concurrent.futures import ThreadPoolExecutor
+from itertools import chain
+from django.core.management.base import BaseCommand
+
+from apps.donation.models import Donation
+from apps.donation.tasks import process_payment_image
+
+
+class Command(BaseCommand):
+    help = 'Generate normalized images and thumbnails for payment proofs that do not have them yet'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=4)
+
+    def handle(self, *args, **options):
+        queryset = (
+            Donation.objects
+            .exclude(payment_file=None)
+            .exclude(payment_file='')
+            .filter(payment_thumbnail=None)
+            .values_list('id', flat=True)
+        )
+        donation_ids = chain.from_iterable(queryset.iterator() for queryset in queryset.get_shard_querysets())
+        with ThreadPoolExecutor(max_workers=options['workers']) as executor:
+            processed = sum(1 for _ in executor.map(process_payment_image, donation_ids))
+
+        self.stdout.write(self.style.SUCCESS(f'Processed {processed} payment images'))
@@ -0,0 +1,73 @@
+from datetime import timezone as dt_timezone
+from itertools import chain
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Count, Sum
+from django.db.models.functions import TruncHour, TruncMinute
+
+from apps.donation.models import Donation, DonationRollup
+from apps.streaming.models import Streaming
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the per-minute and per-hour donation rollups from successful donations'
+
+    truncations = (
+        (DonationRollup.MINUTE, TruncMinute),
+        (DonationRollup.HOUR, TruncHour),
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--stream', action='append', default=[], help='Only rebuild the given stream code')
+        parser.add_argument('--batch-size', type=int, default=100)
+
+    def handle(self, *args, **options):
+        queryset = Streaming.objects.order_by('code')
+        if options['stream']:
+            queryset = queryset.filter(code__in=options['stream'])
+
+        rebuilt = 0
+        last_code = ''
+        while True:
+            codes = list(queryset.filter(code__gt=last_code).values_list('code', flat=True)[:options['batch_size']])
+            if not codes:
+                break
+            self.rebuild(codes)
+            rebuilt += len(codes)
+            last_code = codes[-1]
+
+        self.stdout.write(self.style.SUCCESS(f'Rebuilt donation rollups for {rebuilt} streams'))
+
+    def rebuild(self, codes):
+        with transaction.atomic():
+            # like reconcile_donation_totals, increments wait until the rebuilt rows are committed
+            Streaming.lock_counters(codes)
+            DonationRollup.objects.filter(streaming__in=codes).delete()
+            for granularity, truncate in self.truncations:
+                # buckets are in UTC like the ones record_success maintains
+                buckets = chain.from_iterable(
+                    queryset
+                    .annotate(bucket_start=truncate('success_at', tzinfo=dt_timezone.utc))
+                    .order_by()
+                    .values('streaming', 'bucket_start')
+                    .annotate(total=Sum('amount'), donation_count=Count('id'))
+                    .iterator()
+                    for queryset in (
+                        Donation.objects
+                        .filter(status=Donation.SUCCESS_STATUS, success_at__isnull=False)
+                        .for_streams(codes)
+                    )
+                )
+                DonationRollup.objects.bulk_create(
+                    [
+                        DonationRollup(
+                            streaming_id=bucket['streaming'],
+                            granularity=granularity,
+                            bucket_start=bucket['bucket_start'],
+                            total=bucket['total'],
+                            donation_count=bucket['donation_count'],
+                        )
+                        for bucket in buckets
+                    ],
+                    batch_size=1000,
+                )
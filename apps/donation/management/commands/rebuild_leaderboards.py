@@ -0,0 +1,62 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Count, Sum
+
+from apps.donation.models import Donation, DonorTotal
+from apps.streaming.models import Streaming
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the per-stream donor totals behind the leaderboard from successful donations'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--stream', action='append', default=[], help='Only rebuild the given stream code')
+        parser.add_argument('--batch-size', type=int, default=500)
+
+    def handle(self, *args, **options):
+        queryset = Streaming.objects.order_by('code')
+        if options['stream']:
+            queryset = queryset.filter(code__in=options['stream'])
+
+        rebuilt = 0
+        last_code = ''
+        while True:
+            codes = list(queryset.filter(code__gt=last_code).values_list('code', flat=True)[:options['batch_size']])
+            if not codes:
+                break
+            self.rebuild(codes)
+            rebuilt += len(codes)
+            last_code = codes[-1]
+
+        self.stdout.write(self.style.SUCCESS(f'Rebuilt leaderboards for {rebuilt} streams'))
+
+    def rebuild(self, codes):
+        with transaction.atomic():
+            # like reconcile_donation_totals, increments wait until the rebuilt rows are committed
+            Streaming.lock_counters(codes)
+            donors = [
+                donor
+                for queryset in Donation.objects.filter(status=Donation.SUCCESS_STATUS).for_streams(codes)
+                for donor in (
+                    queryset
+                    .order_by()
+                    .values('streaming', 'user')
+                    .annotate(total=Sum('amount'), donation_count=Count('id'))
+                )
+            ]
+            DonorTotal.objects.filter(streaming__in=codes).delete()
+            DonorTotal.objects.bulk_create(
+                [
+                    DonorTotal(
+                        streaming_id=donor['streaming'],
+                        user_id=donor['user'],
+                        total=donor['total'],
+                        donation_count=donor['donation_count'],
+                    )
+                    for donor in donors
+                ],
+                batch_size=1000,
+                update_conflicts=True,
+                unique_fields=('streaming', 'user'),
+                update_fields=('total', 'donation_count'),
+            )
@@ -0,0 +1,50 @@
+from collections import defaultdict
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Count
+
+from apps.donation.models import Donation, PendingConfirmationCount
+from apps.streaming.models import Streaming
+
+User = get_user_model()
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the per-streamer pending confirmation counts from the donations waiting for them'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500)
+
+    def handle(self, *args, **options):
+        queryset = User.objects.filter(streaming__isnull=False).distinct().order_by('id')
+
+        rebuilt = 0
+        last_id = 0
+        while True:
+            user_ids = list(queryset.filter(id__gt=last_id).values_list('id', flat=True)[:options['batch_size']])
+            if not user_ids:
+                break
+            self.rebuild(user_ids)
+            rebuilt += len(user_ids)
+            last_id = user_ids[-1]
+
+        self.stdout.write(self.style.SUCCESS(f'Rebuilt pending counts for {rebuilt} streamers'))
+
+    def rebuild(self, user_ids):
+        owners = dict(Streaming.objects.filter(user__in=user_ids).values_list('code', 'user'))
+        counts = defaultdict(int)
+        stream_counts = (
+            Donation.objects
+            .filter(status=Donation.NEED_CONFIRMATION_STATUS)
+            .aggregate_by_stream(list(owners), Count('id'))
+        )
+        for code, count in stream_counts.items():
+            counts[owners[code]] += count
+        with transaction.atomic():
+            PendingConfirmationCount.objects.bulk_create(
+                [PendingConfirmationCount(user_id=user_id, count=counts.get(user_id, 0)) for user_id in user_ids],
+                update_conflicts=True,
+                unique_fields=('user',),
+                update_fields=('count',),
+            )
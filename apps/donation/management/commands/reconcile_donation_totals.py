@@ -0,0 +1,49 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Case, FloatField, Sum, Value, When
+
+from apps.donation.models import Donation
+from apps.streaming.models import DonationTotalShard, Streaming
+
+
+class Command(BaseCommand):
+    help = 'Rebuild Streaming.donation_total from successful donations'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--stream', action='append', default=[], help='Only reconcile the given stream code')
+        parser.add_argument('--batch-size', type=int, default=500)
+
+    def handle(self, *args, **options):
+        queryset = Streaming.objects.order_by('code')
+        if options['stream']:
+            queryset = queryset.filter(code__in=options['stream'])
+
+        reconciled = 0
+        last_code = ''
+        while True:
+            codes = list(queryset.filter(code__gt=last_code).values_list('code', flat=True)[:options['batch_size']])
+            if not codes:
+                break
+            self.reconcile(codes)
+            reconciled += len(codes)
+            last_code = codes[-1]
+
+        self.stdout.write(self.style.SUCCESS(f'Reconciled {reconciled} streams'))
+
+    def reconcile(self, codes):
+        with transaction.atomic():
+            # increments block on these locks, so none can slip in between the sum and the reset. Donations on
+            # a shard commit their status before the increment, one landing in between is counted twice.
+            Streaming.lock_counters(codes)
+
+            # the ledger can be on other databases, so the sums are brought over as values
+            totals = Donation.objects.filter(status=Donation.SUCCESS_STATUS).aggregate_by_stream(codes, Sum('amount'))
+            Streaming.objects.filter(code__in=codes).update(
+                donation_total=Case(
+                    *[When(code=code, then=Value(total)) for code, total in totals.items()],
+                    default=Value(0.0),
+                    output_field=FloatField(),
+                ),
+            )
+            DonationTotalShard.objects.filter(streaming__in=codes).update(total=0)
+            Streaming.invalidate_cache(*codes)
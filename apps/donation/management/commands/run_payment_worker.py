@@ -0,0 +1,37 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+from apps.donation.models import Donation, PaymentJob
+
+
+class Command(BaseCommand):
+    help = 'Charge queued instant payments against Midtrans'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=4)
+        parser.add_argument('--poll-interval', type=float, default=1.0)
+        parser.add_argument('--once', action='store_true', help='Drain the queue once and exit')
+
+    def handle(self, *args, **options):
+        workers = options['workers']
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            while True:
+                job_ids = PaymentJob.claim(workers * 2)
+                if job_ids:
+                    list(executor.map(self.run_job, job_ids))
+                    continue
+                if options['once']:
+                    break
+                time.sleep(options['poll_interval'])
+
+    def run_job(self, job_id):
+        close_old_connections()
+        job = PaymentJob.objects.filter(id=job_id).first()
+        if job is None:
+            return
+        # the donation can be on another database than its job
+        job.donation = Donation.objects.filter(id=job.donation_id).find()
+        job.run()
+        self.stdout.write(f'Payment job {job.id} for donation {job.donation_id}: {job.get_status_display()}')
@@ -0,0 +1,31 @@
+# Generated by Django 4.2.13 on 2026-10-18 09:11
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('donation', '0002_donation_bank_code'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PaymentJob',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date_created', models.DateTimeField(auto_now_add=True, db_index=True)),
+                ('date_updated', models.DateTimeField(auto_now=True)),
+                ('status', models.PositiveSmallIntegerField(choices=[(1, 'Queued'), (2, 'Running'), (3, 'Done'), (4, 'Failed')], default=1)),
+                ('attempts', models.PositiveSmallIntegerField(default=0)),
+                ('available_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('last_error', models.TextField(blank=True, null=True)),
+                ('donation', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='payment_job', to='donation.donation')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['status', 'available_at'], name='payment_job_queue_idx')],
+            },
+        ),
+    ]
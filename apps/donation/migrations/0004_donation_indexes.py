@@ -0,0 +1,22 @@
+# Generated by Django 4.2.13 on 2026-10-18 09:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('donation', '0003_paymentjob'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='donation',
+            name='payment_id',
+            field=models.CharField(blank=True, max_length=100, null=True, unique=True),
+        ),
+        migrations.AddIndex(
+            model_name='donation',
+            index=models.Index(fields=['streaming', 'status', 'date_created'], name='donation_stream_status_idx'),
+        ),
+    ]
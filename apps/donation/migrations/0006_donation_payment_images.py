@@ -0,0 +1,23 @@
+# Generated by Django 4.2.13 on 2026-10-18 09:16
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('donation', '0005_paymentupload'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='donation',
+            name='payment_image',
+            field=models.FileField(blank=True, null=True, upload_to=''),
+        ),
+        migrations.AddField(
+            model_name='donation',
+            name='payment_thumbnail',
+            field=models.FileField(blank=True, null=True, upload_to=''),
+        ),
+    ]
@@ -0,0 +1,34 @@
+# Generated by Django 4.2.13 on 2026-10-18 09:17
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('streaming', '0004_comment_stream_date_idx'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('donation', '0006_donation_payment_images'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DonorTotal',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('total', models.FloatField(default=0)),
+                ('donation_count', models.PositiveIntegerField(default=0)),
+                ('streaming', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='donor_totals', to='streaming.streaming')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='donor_totals', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['streaming', '-total'], name='donor_total_rank_idx')],
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='donortotal',
+            constraint=models.UniqueConstraint(fields=('streaming', 'user'), name='unique_donor_total'),
+        ),
+    ]
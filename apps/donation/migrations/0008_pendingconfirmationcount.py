@@ -0,0 +1,27 @@
+# Generated by Django 4.2.13 on 2026-10-18 09:28
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('user', '0001_initial'),
+        ('donation', '0007_donortotal'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PendingConfirmationCount',
+            fields=[
+                ('user', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='pending_confirmation_count', serialize=False, to=settings.AUTH_USER_MODEL)),
+                ('count', models.IntegerField(default=0)),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='donation',
+            index=models.Index(condition=models.Q(('status', 2)), fields=['streaming', 'date_created'], name='donation_pending_idx'),
+        ),
+    ]
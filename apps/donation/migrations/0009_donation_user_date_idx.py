@@ -0,0 +1,17 @@
+# Generated by Django 4.2.13 on 2026-10-18 09:29
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('donation', '0008_pendingconfirmationcount'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='donation',
+            index=models.Index(fields=['user', 'date_created'], name='donation_user_date_idx'),
+        ),
+    ]
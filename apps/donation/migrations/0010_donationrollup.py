@@ -0,0 +1,30 @@
+# Generated by Django 4.2.13 on 2026-10-18 09:31
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('streaming', '0006_streamingranking'),
+        ('donation', '0009_donation_user_date_idx'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DonationRollup',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('granularity', models.PositiveIntegerField(choices=[(60, 'Minute'), (3600, 'Hour')])),
+                ('bucket_start', models.DateTimeField()),
+                ('total', models.FloatField(default=0)),
+                ('donation_count', models.PositiveIntegerField(default=0)),
+                ('streaming', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='donation_rollups', to='streaming.streaming')),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='donationrollup',
+            constraint=models.UniqueConstraint(fields=('streaming', 'granularity', 'bucket_start'), name='unique_donation_rollup'),
+        ),
+    ]
@@ -0,0 +1,32 @@
+# Generated by Django 4.2.13 on 2026-10-18 09:41
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('streaming', '0007_sharding'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('donation', '0010_donationrollup'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='donation',
+            name='streaming',
+            field=models.ForeignKey(db_constraint=False, on_delete=django.db.models.deletion.PROTECT, related_name='donations', to='streaming.streaming'),
+        ),
+        migrations.AlterField(
+            model_name='donation',
+            name='user',
+            field=models.ForeignKey(db_constraint=False, on_delete=django.db.models.deletion.PROTECT, related_name='donations', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AlterField(
+            model_name='paymentjob',
+            name='donation',
+            field=models.OneToOneField(db_constraint=False, on_delete=django.db.models.deletion.CASCADE, related_name='payment_job', to='donation.donation'),
+        ),
+    ]
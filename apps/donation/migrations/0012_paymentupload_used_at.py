@@ -0,0 +1,18 @@
+# Generated by Django 4.2.13 on 2026-10-18 09:50
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('donation', '0011_donation_sharding'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='paymentupload',
+            name='used_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
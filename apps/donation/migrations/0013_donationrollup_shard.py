@@ -0,0 +1,26 @@
+# Generated by Django 4.2.13 on 2026-10-18 10:06
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('donation', '0012_paymentupload_used_at'),
+    ]
+
+    operations = [
+        migrations.RemoveConstraint(
+            model_name='donationrollup',
+            name='unique_donation_rollup',
+        ),
+        migrations.AddField(
+            model_name='donationrollup',
+            name='shard',
+            field=models.PositiveSmallIntegerField(default=0),
+        ),
+        migrations.AddConstraint(
+            model_name='donationrollup',
+            constraint=models.UniqueConstraint(fields=('streaming', 'granularity', 'bucket_start', 'shard'), name='unique_donation_rollup_shard'),
+        ),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 4.2.13 on 2026-10-18 10:07
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('donation', '0013_donationrollup_shard'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='donation',
+            index=models.Index(condition=models.Q(('status__in', (2, 3))), fields=['streaming', 'date_created', 'id'], name='donation_feed_idx'),
+        ),
+    ]
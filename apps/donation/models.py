@@ -1,10 +1,20 @@
+import random
+import uuid
+from collections import defaultdict
+from datetime import datetime, timedelta, timezone as dt_timezone
+from django.conf import settings
 from django.contrib.auth import get_user_model
-from django.db import models
+from django.db import DEFAULT_DB_ALIAS, IntegrityError, models, transaction
+from django.db.models import F
 from django.utils import timezone
 
 from apps.streaming.models import Streaming
+from apps.utils.events import publish_on_commit
+from apps.utils.image import render_image_variants
 from apps.utils.models import BaseModel
-from apps.libs.midtrans import Midtrans, RequestPayment
+from apps.utils.sharding import ShardedModel, atomic_across, get_shards
+from apps.libs.midtrans import Midtrans, MidtransPayment, RequestPayment
+from apps.donation.tasks import schedule_payment_image
 
 User = get_user_model()
 
@@ -18,9 +28,10 @@ class ManualPayment:
         self.payment_file = payment_file
 
 
-class Donation(BaseModel):
-    user = models.ForeignKey(User, on_delete=models.PROTECT, related_name='donations')
-    streaming = models.ForeignKey(Streaming, on_delete=models.PROTECT, related_name='donations')
+class Donation(ShardedModel, BaseModel):
+    # donations can live on another database than users and streams, where no foreign key can reach them
+    user = models.ForeignKey(User, on_delete=models.PROTECT, related_name='donations', db_constraint=False)
+    streaming = models.ForeignKey(Streaming, on_delete=models.PROTECT, related_name='donations', db_constraint=False)
     amount = models.FloatField()
 
     INSTANT_PAYMENT = 1
@@ -45,13 +56,32 @@ class Donation(BaseModel):
     success_at = models.DateTimeField(null=True)
 
     # instant payment
-    payment_id = models.CharField(max_length=100, null=True, blank=True)
+    payment_id = models.CharField(max_length=100, null=True, blank=True, unique=True)
     va_number = models.CharField(max_length=100, null=True, blank=True)
     bank_code = models.CharField(max_length=100, null=True, blank=True)
 
     # manual payment
     bank_name = models.CharField(max_length=100, null=True, blank=True)
     payment_file = models.FileField(null=True, blank=True)
+    payment_image = models.FileField(null=True, blank=True)
+    payment_thumbnail = models.FileField(null=True, blank=True)
+
+    class Meta:
+        indexes = (
+            models.Index(fields=('streaming', 'status', 'date_created'), name='donation_stream_status_idx'),
+            # the public feed, a range scan in (date_created, id) order that no IN on status has to merge
+            models.Index(
+                fields=('streaming', 'date_created', 'id'),
+                condition=models.Q(status__in=(2, 3)),  # NEED_CONFIRMATION_STATUS, SUCCESS_STATUS
+                name='donation_feed_idx',
+            ),
+            models.Index(fields=('user', 'date_created'), name='donation_user_date_idx'),
+            models.Index(
+                fields=('streaming', 'date_created'),
+                condition=models.Q(status=2),  # NEED_CONFIRMATION_STATUS
+                name='donation_pending_idx',
+            ),
+        )
 
     @classmethod
     def create_manual_payment(cls, streaming, user, amount, payment: ManualPayment):
@@ -65,6 +95,11 @@ class Donation(BaseModel):
             payment_file=payment.payment_file,
         )
         donation.save()
+        PendingConfirmationCount.add(streaming.user_id, 1)
+        Streaming.invalidate_summary(streaming.user_id)
+        if donation.payment_file:
+            schedule_payment_image(donation.id)
+        donation.publish('donation.needs_confirmation')
         return donation
     
     @classmethod
@@ -75,21 +110,47 @@ class Donation(BaseModel):
             amount=amount,
             payment_type=Donation.INSTANT_PAYMENT,
             status=Donation.PENDING_STATUS,
-        )
-        donation.save()
-
-        midtrans_payment = RequestPayment(
-            order_id=donation.id,
-            gross_amount=amount,
             bank_code=bank_code,
         )
-        midtrans_response = Midtrans().create_payment(midtrans_payment)
-        donation.va_number = midtrans_response.va_number
-        donation.payment_id = midtrans_response.transaction_id
-        donation.bank_code = bank_code
         donation.save()
 
+        if settings.MIDTRANS_ASYNC_CHARGE:
+            PaymentJob.enqueue(donation)
+        else:
+            donation.charge()
+
         return donation
+
+    def process_payment_image(self):
+        with self.payment_file.open('rb') as file:
+            image, thumbnail = render_image_variants(
+                file,
+                sizes=(settings.PAYMENT_IMAGE_SIZE, settings.PAYMENT_THUMBNAIL_SIZE),
+                format=settings.PAYMENT_IMAGE_FORMAT,
+            )
+        self.payment_image.save(image.name, image, save=False)
+        self.payment_thumbnail.save(thumbnail.name, thumbnail, save=False)
+        Donation.objects.for_stream(self.streaming_id).filter(id=self.id).update(
+            payment_image=self.payment_image.name,
+            payment_thumbnail=self.payment_thumbnail.name,
+            date_updated=timezone.now(),
+        )
+
+    def charge(self, retry=False):
+        midtrans = Midtrans.instance()
+        # an earlier attempt may have created the charge and lost its response, charging the same order_id
+        # again would be refused, so the existing transaction is taken over instead
+        midtrans_response = midtrans.find_transaction(str(self.id)) if retry else None
+        if midtrans_response is None:
+            midtrans_payment = RequestPayment(
+                order_id=self.id,
+                gross_amount=self.amount,
+                bank_code=self.bank_code,
+            )
+            midtrans_response = midtrans.create_payment(midtrans_payment)
+        self.va_number = midtrans_response.va_number
+        self.payment_id = midtrans_response.transaction_id
+        self.save(update_fields=('va_number', 'payment_id', 'date_updated'))
     
     def confirm(self, by_user):
         if self.streaming.user != by_user:
@@ -97,10 +158,12 @@ class Donation(BaseModel):
 
         if self.status != self.NEED_CONFIRMATION_STATUS:
             raise Exception('Confirmation not needed')
-        
-        self.status = self.SUCCESS_STATUS
-        self.success_at = timezone.now()
-        self.save()
+
+        queryset = Donation.objects.for_stream(self.streaming_id).filter(id=self.id, status=self.NEED_CONFIRMATION_STATUS)
+        with atomic_across(DEFAULT_DB_ALIAS, queryset.db):
+            if not self._transition_to_success(queryset):
+                raise Exception('Confirmation not needed')
+            PendingConfirmationCount.add(by_user.id, -1)
 
     def reject(self, by_user):
         if self.streaming.user != by_user:
@@ -109,14 +172,410 @@ class Donation(BaseModel):
         if self.status != self.NEED_CONFIRMATION_STATUS:
             raise Exception('Confirmation not needed')
         
+        now = timezone.now()
+        queryset = Donation.objects.for_stream(self.streaming_id).filter(id=self.id, status=self.NEED_CONFIRMATION_STATUS)
+        with atomic_across(DEFAULT_DB_ALIAS, queryset.db):
+            if not queryset.update(status=self.FAILED_STATUS, date_updated=now):
+                raise Exception('Confirmation not needed')
+            PendingConfirmationCount.add(by_user.id, -1)
+            Streaming.invalidate_summary(by_user.id)
         self.status = self.FAILED_STATUS
-        self.save()
+        self.date_updated = now
+
+    @classmethod
+    def review_many(cls, ids, by_user, valid):
+        results = dict.fromkeys(ids, 'not_found')
+        # ids do not say which database their rows are on, every one holding donations reviews its part
+        for queryset in cls.objects.filter(id__in=ids).get_shard_querysets():
+            with atomic_across(DEFAULT_DB_ALIAS, queryset.db):
+                results.update(cls.review_rows(queryset, by_user, valid))
+        return results
+
+    @classmethod
+    def review_rows(cls, queryset, by_user, valid):
+        now = timezone.now()
+        status = cls.SUCCESS_STATUS if valid else cls.FAILED_STATUS
+        results = {}
+        # ownership and status for the whole batch come from one query, the rows stay locked until commit
+        donations = list(
+            queryset
+            .select_for_update(of=('self',))
+            .with_related(
+                ('user', 'streaming'),
+                (
+                    'id', 'status', 'amount', 'user', 'streaming',
+                    'user__id', 'user__first_name', 'user__last_name', 'streaming__user',
+                ),
+            )
+        )
+        if settings.DATABASE_SHARDS:
+            # while a stream is moved its rows are on two databases, only the one it is placed on counts
+            shards = get_shards({donation.streaming_id for donation in donations})
+            donations = [donation for donation in donations if shards[donation.streaming_id] == queryset.db]
+        reviewed = []
+        for donation in donations:
+            if donation.streaming.user_id != by_user.id:
+                # reported like a missing id, so the ids of other streamers' donations cannot be probed
+                results[donation.id] = 'not_found'
+            elif donation.status != cls.NEED_CONFIRMATION_STATUS:
+                results[donation.id] = 'not_needed'
+            else:
+                reviewed.append(donation)
+
+        changes = {'status': status, 'date_updated': now}
+        if valid:
+            changes['success_at'] = now
+        updated = queryset.filter(id__in=[donation.id for donation in reviewed], status=cls.NEED_CONFIRMATION_STATUS)
+        PendingConfirmationCount.add(by_user.id, -updated.update(**changes))
+        Streaming.invalidate_summary(by_user.id)
+
+        for donation in reviewed:
+            for field, value in changes.items():
+                setattr(donation, field, value)
+            results[donation.id] = 'confirmed' if valid else 'rejected'
+        if valid:
+            cls.record_success(reviewed)
+        return results
 
     def mark_as_success(self):
-        self.status = self.SUCCESS_STATUS
-        self.success_at = timezone.now()
-        self.save()
+        queryset = Donation.objects.for_stream(self.streaming_id).filter(id=self.id, status=self.PENDING_STATUS)
+        return self._transition_to_success(queryset)
+
+    def _transition_to_success(self, queryset):
+        # the conditional update makes the transition happen once, so totals are never counted twice
+        now = timezone.now()
+        # the status change commits before the counters, a failure in between is repaired by reconciling
+        # instead of counting the donation twice
+        with atomic_across(DEFAULT_DB_ALIAS, queryset.db):
+            if not queryset.update(status=self.SUCCESS_STATUS, success_at=now, date_updated=now):
+                return False
+            self.status = self.SUCCESS_STATUS
+            self.success_at = now
+            self.date_updated = now
+            Donation.record_success([self])
+        return True
+
+    @classmethod
+    def record_success(cls, donations):
+        totals = defaultdict(float)
+        donors = defaultdict(lambda: [0.0, 0])
+        for donation in donations:
+            totals[donation.streaming_id] += donation.amount
+            donor = donors[(donation.streaming_id, donation.user_id)]
+            donor[0] += donation.amount
+            donor[1] += 1
+
+        for code, amount in totals.items():
+            Streaming.add_donation(code, amount)
+        for (code, user_id), (amount, count) in donors.items():
+            DonorTotal.add_donations(code, user_id, amount, count)
+        DonationRollup.add_donations(donations)
+        Streaming.invalidate_summary_of_streams(list(totals))
+        for donation in donations:
+            donation.publish('donation.succeeded')
+
+    def publish(self, type):
+        user = self.user
+        publish_on_commit(Streaming.get_topic(self.streaming_id), type, {
+            'id': self.id,
+            'user': {
+                'id': user.id,
+                'name': user.name,
+            },
+            'amount': self.amount,
+            'status': self.status,
+            'success_at': self.success_at.isoformat() if self.success_at else None,
+        })
     
     def mark_as_failed(self):
+        now = timezone.now()
+        Donation.objects.for_stream(self.streaming_id).filter(id=self.id, status=self.PENDING_STATUS).update(status=self.FAILED_STATUS, date_updated=now)
         self.status = self.FAILED_STATUS
-        self.save()
+        self.date_updated = now
+
+    @classmethod
+    def apply_payment(cls, payment: MidtransPayment):
+        # the donation is picked by order_id, the donation id Midtrans signs, never by transaction_id.
+        # replayed or out-of-order notifications match no row and cost a single indexed lookup.
+        # failed is final at Midtrans too, so only pending donations can still succeed
+        try:
+            queryset = cls.objects.filter(id=int(payment.order_id), status=cls.PENDING_STATUS)
+        except (TypeError, ValueError):
+            return
+        if payment.is_success:
+            donation = (
+                queryset
+                .with_related(('user',), ('id', 'streaming', 'amount', 'user', 'user__id', 'user__first_name', 'user__last_name'))
+                .find()
+            )
+            # a settlement of another amount does not pay for this donation
+            if donation is not None and payment.is_amount(donation.amount):
+                donation.mark_as_success()
+        elif payment.is_failed:
+            queryset.update_all(
+                status=cls.FAILED_STATUS,
+                date_updated=timezone.now(),
+            )
+
+
+class DonorTotal(models.Model):
+    streaming = models.ForeignKey(Streaming, on_delete=models.CASCADE, related_name='donor_totals')
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='donor_totals')
+    total = models.FloatField(default=0)
+    donation_count = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        constraints = (
+            models.UniqueConstraint(fields=('streaming', 'user'), name='unique_donor_total'),
+        )
+        indexes = (
+            models.Index(fields=('streaming', '-total'), name='donor_total_rank_idx'),
+        )
+
+    @classmethod
+    def add_donations(cls, code, user_id, amount, count):
+        queryset = cls.objects.filter(streaming=code, user=user_id)
+        changes = {'total': F('total') + amount, 'donation_count': F('donation_count') + count}
+        if queryset.update(**changes):
+            return
+
+        try:
+            with transaction.atomic():
+                cls.objects.create(streaming_id=code, user_id=user_id, total=amount, donation_count=count)
+        except IntegrityError:
+            queryset.update(**changes)
+
+    @classmethod
+    def get_leaderboard(cls, code, limit):
+        return (
+            cls.objects
+            .filter(streaming=code)
+            .select_related('user')
+            .only('total', 'donation_count', 'user__id', 'user__first_name', 'user__last_name')
+            .order_by('-total', 'user_id')[:limit]
+        )
+
+
+class DonationRollup(models.Model):
+    # successful donations per stream bucketed by success time, read by the stats endpoint instead of the ledger
+    MINUTE = 60
+    HOUR = 3600
+    GRANULARITY_CHOICES = (
+        (MINUTE, 'Minute'),
+        (HOUR, 'Hour'),
+    )
+
+    streaming = models.ForeignKey(Streaming, on_delete=models.CASCADE, related_name='donation_rollups')
+    granularity = models.PositiveIntegerField(choices=GRANULARITY_CHOICES)
+    bucket_start = models.DateTimeField()
+    # like DonationTotalShard, a bucket is spread over DONATION_TOTAL_SHARDS rows so concurrent settlements
+    # of a busy stream do not all wait on its current minute and hour
+    shard = models.PositiveSmallIntegerField(default=0)
+    total = models.FloatField(default=0)
+    donation_count = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        constraints = (
+            models.UniqueConstraint(
+                fields=('streaming', 'granularity', 'bucket_start', 'shard'),
+                name='unique_donation_rollup_shard',
+            ),
+        )
+
+    @staticmethod
+    def get_bucket(moment, granularity):
+        seconds = int(moment.timestamp()) // granularity * granularity
+        return datetime.fromtimestamp(seconds, tz=dt_timezone.utc)
+
+    @classmethod
+    def add_donations(cls, donations):
+        buckets = defaultdict(lambda: [0.0, 0])
+        for donation in donations:
+            for granularity, _ in cls.GRANULARITY_CHOICES:
+                bucket = buckets[(donation.streaming_id, granularity, cls.get_bucket(donation.success_at, granularity))]
+                bucket[0] += donation.amount
+                bucket[1] += 1
+
+        shard = random.randrange(max(settings.DONATION_TOTAL_SHARDS, 1))
+        # a fixed order keeps concurrent batches from locking the same rows in opposite orders
+        for (code, granularity, bucket_start), (amount, count) in sorted(buckets.items()):
+            queryset = cls.objects.filter(streaming=code, granularity=granularity, bucket_start=bucket_start, shard=shard)
+            changes = {'total': F('total') + amount, 'donation_count': F('donation_count') + count}
+            if queryset.update(**changes):
+                continue
+
+            try:
+                with transaction.atomic():
+                    cls.objects.create(
+                        streaming_id=code,
+                        granularity=granularity,
+                        bucket_start=bucket_start,
+                        shard=shard,
+                        total=amount,
+                        donation_count=count,
+                    )
+            except IntegrityError:
+                queryset.update(**changes)
+
+    @classmethod
+    def get_series(cls, code, granularity, since, until, step=1):
+        # one point per `step` buckets from since to until, empty buckets included so charts have no gaps
+        since = cls.get_bucket(since, granularity)
+        width = granularity * step
+        points = int((until - since).total_seconds()) // width + 1
+        series = [
+            {'bucket_start': since + timedelta(seconds=width * index), 'total': 0.0, 'donation_count': 0}
+            for index in range(points)
+        ]
+        rollups = (
+            cls.objects
+            .filter(streaming=code, granularity=granularity, bucket_start__gte=since, bucket_start__lte=until)
+            .values_list('bucket_start', 'total', 'donation_count')
+        )
+        for bucket_start, total, donation_count in rollups:
+            point = series[int((bucket_start - since).total_seconds()) // width]
+            point['total'] += total
+            point['donation_count'] += donation_count
+        return series
+
+
+class PendingConfirmationCount(models.Model):
+    # badge count of manual donations waiting for a streamer, kept in step with the status changes
+    user = models.OneToOneField(User, on_delete=models.CASCADE, primary_key=True, related_name='pending_confirmation_count')
+    count = models.IntegerField(default=0)
+
+    @classmethod
+    def add(cls, user_id, delta):
+        if not delta:
+            return
+        queryset = cls.objects.filter(user=user_id)
+        if queryset.update(count=F('count') + delta):
+            return
+
+        try:
+            with transaction.atomic():
+                cls.objects.create(user_id=user_id, count=delta)
+        except IntegrityError:
+            queryset.update(count=F('count') + delta)
+
+    @classmethod
+    def get_count(cls, user_id):
+        return cls.objects.filter(user=user_id).values_list('count', flat=True).first() or 0
+
+
+class PaymentUpload(BaseModel):
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    user = models.ForeignKey(User, on_delete=models.PROTECT, related_name='payment_uploads')
+    file = models.FileField()
+    size = models.PositiveIntegerField()
+    sha256 = models.CharField(max_length=64)
+    content_type = models.CharField(max_length=100)
+    used_at = models.DateTimeField(null=True, blank=True)
+
+    ALLOWED_CONTENT_TYPES = ('image/jpeg', 'image/png', 'image/gif', 'image/webp')
+
+    @classmethod
+    def create(cls, user, file):
+        if file.content_type not in cls.ALLOWED_CONTENT_TYPES:
+            raise Exception('Unsupported file type')
+
+        upload = cls(
+            user=user,
+            file=file,
+            size=file.size,
+            sha256=file.sha256,
+            content_type=file.content_type,
+        )
+        upload.save()
+        return upload
+
+    def claim(self):
+        # one receipt backs one donation, the conditional update keeps two racing donations from sharing it
+        now = timezone.now()
+        if not PaymentUpload.objects.filter(id=self.id, used_at=None).update(used_at=now, date_updated=now):
+            return False
+        self.used_at = now
+        return True
+
+
+class PaymentJob(BaseModel):
+    donation = models.OneToOneField(Donation, on_delete=models.CASCADE, related_name='payment_job', db_constraint=False)
+
+    QUEUED_STATUS = 1
+    RUNNING_STATUS = 2
+    DONE_STATUS = 3
+    FAILED_STATUS = 4
+    STATUS_CHOICES = (
+        (QUEUED_STATUS, 'Queued'),
+        (RUNNING_STATUS, 'Running'),
+        (DONE_STATUS, 'Done'),
+        (FAILED_STATUS, 'Failed'),
+    )
+    status = models.PositiveSmallIntegerField(choices=STATUS_CHOICES, default=QUEUED_STATUS)
+    attempts = models.PositiveSmallIntegerField(default=0)
+    available_at = models.DateTimeField(default=timezone.now)
+    last_error = models.TextField(null=True, blank=True)
+
+    MAX_ATTEMPTS = 5
+    MAX_BACKOFF = 3600
+    LEASE = timedelta(minutes=2)
+
+    class Meta:
+        indexes = (
+            models.Index(fields=('status', 'available_at'), name='payment_job_queue_idx'),
+        )
+
+    @classmethod
+    def enqueue(cls, donation):
+        return cls.objects.create(donation=donation)
+
+    @classmethod
+    def claim(cls, limit):
+        # running jobs whose lease expired belong to a worker that died mid-charge
+        now = timezone.now()
+        with transaction.atomic():
+            ids = list(
+                cls.objects
+                .select_for_update(skip_locked=True)
+                .filter(status__in=(cls.QUEUED_STATUS, cls.RUNNING_STATUS), available_at__lte=now)
+                .order_by('available_at')
+                .values_list('id', flat=True)[:limit]
+            )
+            cls.objects.filter(id__in=ids).update(
+                status=cls.RUNNING_STATUS,
+                available_at=now + cls.LEASE,
+                attempts=F('attempts') + 1,
+                date_updated=now,
+            )
+        return ids
+
+    def run(self):
+        try:
+            # attempts counts this one, claimed jobs start at 1
+            self.donation.charge(retry=self.attempts > 1)
+        except Exception as error:
+            self.fail(error)
+            return
+
+        self.status = self.DONE_STATUS
+        self.last_error = None
+        self.save(update_fields=('status', 'last_error', 'date_updated'))
+
+    def fail(self, error):
+        self.last_error = str(error)
+        # a donation whose VA may exist at Midtrans is never failed, the job keeps retrying until it is adopted
+        exhausted = self.attempts >= self.MAX_ATTEMPTS and not self.has_transaction()
+        with transaction.atomic():
+            if exhausted:
+                self.status = self.FAILED_STATUS
+                self.donation.mark_as_failed()
+            else:
+                self.status = self.QUEUED_STATUS
+                self.available_at = timezone.now() + timedelta(seconds=min(2 ** self.attempts, self.MAX_BACKOFF))
+            self.save(update_fields=('status', 'last_error', 'available_at', 'date_updated'))
+
+    def has_transaction(self):
+        try:
+            return Midtrans.instance().find_transaction(str(self.donation_id)) is not None
+        except Exception:
+            return True
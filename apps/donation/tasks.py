@@ -0,0 +1,25 @@
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from django.conf import settings
+from django.db import connections, transaction
+
+logger = logging.getLogger(__name__)
+
+image_executor = ThreadPoolExecutor(max_workers=settings.PAYMENT_IMAGE_WORKERS, thread_name_prefix='payment-image')
+
+
+def process_payment_image(donation_id):
+    from apps.donation.models import Donation
+
+    try:
+        donation = Donation.objects.filter(id=donation_id).find()
+        if donation is not None:
+            donation.process_payment_image()
+    except Exception:
+        logger.exception('Failed to process payment image for donation %s', donation_id)
+    finally:
+        connections.close_all()
+
+
+def schedule_payment_image(donation_id):
+    transaction.on_commit(lambda: image_executor.submit(process_payment_image, donation_id))
@@ -1,3 +1,587 @@
-from django.test import TestCase
+import hashlib
+import json
+import shutil
+import tempfile
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from io import BytesIO, StringIO
+from urllib.parse import urlencode
+from unittest import mock
+import requests
+from django.conf import settings
+from django.db import connection
+from django.core.cache import cache
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from PIL import Image
+from rest_framework.test import APIClient, APIRequestFactory
 
-# Create your tests here.
+from apps.donation.api.serializers import DonationFeedSerializer, DonationSerializer
+from apps.donation.management.commands.check_query_plans import Command as QueryPlanCommand
+from apps.donation.models import (
+    Donation,
+    DonationRollup,
+    ManualPayment,
+    PaymentJob,
+    PaymentUpload,
+    PendingConfirmationCount,
+)
+from apps.donation.tasks import image_executor, process_payment_image
+from apps.libs.midtrans import Midtrans, MidtransPayment
+from apps.utils.metrics import metrics
+from apps.utils.testing import StreamingFixtures
+
+
+@override_settings(PASSWORD_HASHERS=['django.contrib.auth.hashers.MD5PasswordHasher'])
+class DonationListTest(StreamingFixtures, TestCase):
+    def setUp(self):
+        streamer = self.create_user('Streamer')
+        self.streaming = self.create_streaming(streamer)
+        for index in range(30):
+            donor = self.create_user(f'Donor {index}')
+            Donation.create_manual_payment(
+                streaming=self.streaming,
+                user=donor,
+                amount=1000 * (index + 1),
+                payment=ManualPayment('BCA', None),
+            )
+        self.client = APIClient()
+
+    def count_list_queries(self, query):
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(f'/api/donations/?stream={self.streaming.code}&{query}')
+        self.assertEqual(response.status_code, 200)
+        return len(context.captured_queries)
+
+    def test_query_count_does_not_grow_with_page_size(self):
+        self.assertEqual(self.count_list_queries('page_size=1'), self.count_list_queries('page_size=30'))
+        self.assertEqual(self.count_list_queries('cursor=&page_size=1'), self.count_list_queries('cursor=&page_size=30'))
+
+    def read_feed(self, page_size):
+        ids = []
+        url = f'/api/donations/?stream={self.streaming.code}&cursor=&page_size={page_size}'
+        while url:
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            ids.extend(donation['id'] for donation in response.data['results'])
+            url = response.data['next']
+        return ids
+
+    def test_cursor_pages_cover_the_feed_once(self):
+        expected = list(Donation.objects.order_by('date_created', 'id').values_list('id', flat=True))
+        self.assertEqual(self.read_feed(7), expected)
+        self.assertEqual(self.read_feed(30), expected)
+
+    def test_cursor_pages_break_ties_on_id(self):
+        # a burst of donations in the same instant straddles page boundaries
+        Donation.objects.filter(id__in=Donation.objects.order_by('id').values('id')[5:20]).update(date_created=timezone.now())
+        expected = list(Donation.objects.order_by('date_created', 'id').values_list('id', flat=True))
+        for page_size in (1, 4, 10):
+            self.assertEqual(self.read_feed(page_size), expected)
+
+    def test_feed_matches_detail_serializer(self):
+        request = APIRequestFactory().get('/')
+        donation = DonationFeedSerializer.optimize(Donation.objects.all()).first()
+        context = {'request': request}
+        self.assertEqual(
+            DonationFeedSerializer(donation, context=context).data,
+            DonationSerializer(donation, context=context).data,
+        )
+
+
+@override_settings(PASSWORD_HASHERS=['django.contrib.auth.hashers.MD5PasswordHasher'])
+class ManualPaymentTest(StreamingFixtures, TransactionTestCase):
+    def setUp(self):
+        cache.clear()
+        streamer = self.create_user('Streamer')
+        self.streaming = self.create_streaming(streamer)
+        self.donor = self.create_user('Donor')
+        self.client = APIClient()
+        self.client.force_authenticate(self.donor)
+        # the receipts here are names without files, there is no image to process
+        patcher = mock.patch('apps.donation.models.schedule_payment_image')
+        self.schedule_payment_image = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def create_upload(self):
+        return PaymentUpload.objects.create(
+            user=self.donor, file='receipt.png', size=1, sha256='0' * 64, content_type='image/png',
+        )
+
+    def donate(self, manual_payment):
+        return self.client.post('/api/donations/', {
+            'streaming': self.streaming.code,
+            'amount': 1000,
+            'manual_payment': manual_payment,
+        }, format='json')
+
+    def test_payment_proof_is_required(self):
+        response = self.donate({'bank_name': 'BCA'})
+        self.assertEqual(response.status_code, 400)
+        response = self.donate({'bank_name': 'BCA', 'payment_file': ''})
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(Donation.objects.exists())
+
+    def test_payment_upload_is_used_once(self):
+        upload = self.create_upload()
+        response = self.donate({'bank_name': 'BCA', 'payment_upload': str(upload.id)})
+        self.assertEqual(response.status_code, 201)
+        response = self.donate({'bank_name': 'BCA', 'payment_upload': str(upload.id)})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(Donation.objects.count(), 1)
+        upload.refresh_from_db()
+        self.assertIsNotNone(upload.used_at)
+        self.schedule_payment_image.assert_called_once()
+
+    def test_claim_is_conditional(self):
+        upload = self.create_upload()
+        stale = PaymentUpload.objects.get(id=upload.id)
+        self.assertTrue(upload.claim())
+        self.assertFalse(stale.claim())
+
+    def test_unclaimed_uploads_are_deleted_after_a_while(self):
+        claimed, unclaimed, recent = self.create_upload(), self.create_upload(), self.create_upload()
+        self.assertTrue(claimed.claim())
+        PaymentUpload.objects.exclude(id=recent.id).update(date_created=timezone.now() - timedelta(hours=25))
+
+        storage = PaymentUpload._meta.get_field('file').storage
+        with mock.patch.object(storage, 'delete') as delete:
+            call_command('delete_unclaimed_uploads', hours=24, stdout=StringIO())
+        delete.assert_called_once_with('receipt.png')
+        self.assertEqual(set(PaymentUpload.objects.values_list('id', flat=True)), {claimed.id, recent.id})
+
+
+@override_settings(PASSWORD_HASHERS=['django.contrib.auth.hashers.MD5PasswordHasher'])
+class PaymentImageTest(StreamingFixtures, TestCase):
+    def setUp(self):
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root)
+        settings_override = override_settings(MEDIA_ROOT=media_root)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+        streaming = self.create_streaming(self.create_user('Streamer'))
+        with mock.patch.object(image_executor, 'submit') as submit, self.captureOnCommitCallbacks(execute=True):
+            self.donation = Donation.create_manual_payment(
+                streaming, self.create_user('Donor'), 1000, ManualPayment('BCA', self.create_receipt()),
+            )
+        # the image is processed by the worker pool once the donation is committed
+        submit.assert_called_once_with(process_payment_image, self.donation.id)
+
+    def create_receipt(self):
+        exif = Image.Exif()
+        exif[0x010F] = 'Phone'  # Make
+        output = BytesIO()
+        Image.new('RGB', (4000, 3000), 'white').save(output, format='JPEG', exif=exif)
+        return default_storage.save('receipt.jpg', ContentFile(output.getvalue()))
+
+    def test_proof_is_bounded_stripped_and_thumbnailed(self):
+        self.donation.process_payment_image()
+        self.donation.refresh_from_db()
+
+        with Image.open(self.donation.payment_image.path) as image:
+            self.assertEqual(image.format, 'WEBP')
+            self.assertEqual(max(image.size), settings.PAYMENT_IMAGE_SIZE)
+            self.assertNotIn('exif', image.info)
+        with Image.open(self.donation.payment_thumbnail.path) as thumbnail:
+            self.assertEqual(max(thumbnail.size), settings.PAYMENT_THUMBNAIL_SIZE)
+        self.assertLess(self.donation.payment_thumbnail.size * 10, self.donation.payment_file.size)
+
+        data = DonationSerializer(self.donation, context={'request': APIRequestFactory().get('/')}).data
+        self.assertTrue(data['manual_payment']['payment_file'].endswith(self.donation.payment_image.url))
+        self.assertTrue(data['manual_payment']['payment_thumbnail'].endswith(self.donation.payment_thumbnail.url))
+
+
+@override_settings(PASSWORD_HASHERS=['django.contrib.auth.hashers.MD5PasswordHasher'])
+class DonationReviewTest(StreamingFixtures, TestCase):
+    def setUp(self):
+        self.streamer = self.create_user('Streamer')
+        self.donor = self.create_user('Donor')
+        self.streaming = self.create_streaming(self.streamer)
+        self.client = APIClient()
+        self.client.force_authenticate(self.streamer)
+
+    def create_donations(self, streaming, count):
+        return [
+            Donation.create_manual_payment(
+                streaming=streaming,
+                user=self.donor,
+                amount=1000,
+                payment=ManualPayment('BCA', None),
+            ).id
+            for _ in range(count)
+        ]
+
+    def review(self, ids, valid):
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.post('/api/donations/review/', {'ids': ids, 'valid': valid}, format='json')
+        self.assertEqual(response.status_code, 200)
+        return {result['id']: result['result'] for result in response.data['results']}, len(context.captured_queries)
+
+    def test_confirms_owned_donations_in_constant_queries(self):
+        # the first confirmation creates the donor's leaderboard row
+        self.review(self.create_donations(self.streaming, 1), True)
+        _, few_queries = self.review(self.create_donations(self.streaming, 2), True)
+        ids = self.create_donations(self.streaming, 50)
+        other = self.create_donations(self.create_streaming(self.donor), 1)
+        results, many_queries = self.review(ids + other + [0], True)
+
+        self.assertEqual(few_queries, many_queries)
+        self.assertEqual([results[id] for id in ids], ['confirmed'] * 50)
+        self.assertEqual(results[other[0]], 'not_found')
+        self.assertEqual(results[0], 'not_found')
+        self.streaming.refresh_from_db()
+        self.assertEqual(self.streaming.donation_total, 53000)
+
+        results, _ = self.review(ids[:1], False)
+        self.assertEqual(results[ids[0]], 'not_needed')
+
+
+@override_settings(PASSWORD_HASHERS=['django.contrib.auth.hashers.MD5PasswordHasher'])
+class PendingConfirmationTest(StreamingFixtures, TestCase):
+    def setUp(self):
+        self.streamer = self.create_user('Streamer')
+        self.donor = self.create_user('Donor')
+        streams = [self.create_streaming(self.streamer) for _ in range(2)]
+        self.pending = [self.donate(streaming) for streaming in streams * 2]
+        # waiting for someone else
+        self.donate(self.create_streaming(self.donor))
+        self.client = APIClient()
+        self.client.force_authenticate(self.streamer)
+
+    def donate(self, streaming):
+        return Donation.create_manual_payment(streaming, self.donor, 1000, ManualPayment('BCA', None)).id
+
+    def get_count(self):
+        response = self.client.get('/api/donations/pending/count/')
+        self.assertEqual(response.status_code, 200)
+        return response.data['count']
+
+    def test_lists_the_streamers_pending_donations_oldest_first(self):
+        Donation.review_many(self.pending[:1], self.streamer, True)
+        response = self.client.get('/api/donations/pending/?page_size=10')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([donation['id'] for donation in response.data['results']], self.pending[1:])
+
+    def test_count_follows_reviews_without_counting_rows(self):
+        self.assertEqual(self.get_count(), 4)
+        Donation.review_many(self.pending[:1], self.streamer, True)
+        Donation.review_many(self.pending[1:2], self.streamer, False)
+        # reviewing twice does not count twice
+        Donation.review_many(self.pending[:2], self.streamer, True)
+        with CaptureQueriesContext(connection) as context:
+            self.assertEqual(self.get_count(), 2)
+        self.assertFalse([query for query in context.captured_queries if 'donation_donation' in query['sql']])
+
+    def test_rebuild_restores_a_drifted_count(self):
+        PendingConfirmationCount.objects.filter(user=self.streamer).update(count=40)
+        call_command('rebuild_pending_counts', stdout=StringIO())
+        self.assertEqual(self.get_count(), 4)
+        self.assertEqual(PendingConfirmationCount.get_count(self.donor.id), 1)
+
+
+@override_settings(PASSWORD_HASHERS=['django.contrib.auth.hashers.MD5PasswordHasher'])
+class DonationHistoryTest(StreamingFixtures, TestCase):
+    def setUp(self):
+        streamer = self.create_user('Streamer')
+        self.donor = self.create_user('Donor')
+        streams = [self.create_streaming(streamer) for _ in range(2)]
+        self.donations = [
+            Donation.create_manual_payment(streams[index % 2], self.donor, 1000, ManualPayment('BCA', None))
+            for index in range(7)
+        ]
+        Donation.review_many([self.donations[0].id], streamer, True)
+        Donation.create_manual_payment(streams[0], streamer, 1000, ManualPayment('BCA', None))
+        self.client = APIClient()
+        self.client.force_authenticate(self.donor)
+
+    def get_page(self, url):
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return response.data, len(context.captured_queries)
+
+    def test_pages_through_the_callers_donations_newest_first(self):
+        results = []
+        url = '/api/donations/mine/?page_size=3'
+        while url:
+            data, _ = self.get_page(url)
+            results.extend(data['results'])
+            url = data['next']
+        self.assertEqual([result['id'] for result in results], [donation.id for donation in reversed(self.donations)])
+        self.assertEqual(results[-1]['status'], Donation.SUCCESS_STATUS)
+        self.assertEqual(
+            [result['streaming']['code'] for result in results],
+            [donation.streaming_id for donation in reversed(self.donations)],
+        )
+
+    def test_page_cost_does_not_grow_with_page_size(self):
+        _, few_queries = self.get_page('/api/donations/mine/?page_size=1')
+        _, many_queries = self.get_page('/api/donations/mine/?page_size=7')
+        self.assertEqual(few_queries, many_queries)
+
+
+@override_settings(PASSWORD_HASHERS=['django.contrib.auth.hashers.MD5PasswordHasher'])
+class QueryPlanTest(TestCase):
+    def test_hot_queries_use_indexes(self):
+        stdout = StringIO()
+        call_command('check_query_plans', seed=200, stdout=stdout)
+        self.assertIn('No sequential scans', stdout.getvalue())
+        # the seed is rolled back
+        self.assertFalse(Donation.objects.exists())
+
+    def test_fails_on_a_sequential_scan(self):
+        queries = [('unindexed', Donation.objects.filter(bank_name='BCA'))]
+        with mock.patch.object(QueryPlanCommand, 'get_queries', return_value=queries):
+            with self.assertRaisesMessage(CommandError, 'Sequential scan in: unindexed'):
+                call_command('check_query_plans', stdout=StringIO())
+
+
+class MidtransClientTest(SimpleTestCase):
+    def setUp(self):
+        patcher = mock.patch.object(Midtrans, '_instance', None)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def get_response(self, body):
+        response = requests.Response()
+        response.status_code = 200
+        response._content = json.dumps(body).encode()
+        return response
+
+    def test_one_client_is_shared_across_threads(self):
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            clients = set(executor.map(lambda _: Midtrans.instance(), range(32)))
+        self.assertEqual(len(clients), 1)
+        client = clients.pop()
+        self.assertIs(client.core_api.http_client.http_client, client.session)
+        self.assertIs(client.snap.http_client.http_client, client.session)
+
+    def test_calls_have_a_timeout_and_are_timed(self):
+        body = {'status_code': '200', 'transaction_id': 'tx-1', 'order_id': '1', 'transaction_status': 'settlement'}
+        count = metrics.snapshot()['timings'].get('midtrans.status', {}).get('count', 0)
+        with mock.patch.object(requests.Session, 'request', return_value=self.get_response(body)) as request:
+            payment = Midtrans.instance().get_transaction_detail('1')
+        self.assertTrue(payment.is_success)
+        self.assertEqual(request.call_args.kwargs['timeout'], Midtrans.TIMEOUT)
+        self.assertEqual(metrics.snapshot()['timings']['midtrans.status']['count'], count + 1)
+
+    def test_only_status_lookups_are_retried(self):
+        retry = Midtrans.instance().session.get_adapter('https://api.midtrans.com').max_retries
+        self.assertEqual(retry.allowed_methods, {'GET'})
+        self.assertEqual(retry.total, settings.MIDTRANS_MAX_RETRIES)
+
+
+@override_settings(PASSWORD_HASHERS=['django.contrib.auth.hashers.MD5PasswordHasher'])
+class MidtransCallbackTest(StreamingFixtures, TestCase):
+    def setUp(self):
+        streamer = self.create_user('Streamer')
+        streaming = self.create_streaming(streamer)
+        self.donation = Donation(
+            user=self.create_user('Donor'),
+            streaming=streaming,
+            amount=10000,
+            payment_type=Donation.INSTANT_PAYMENT,
+            status=Donation.PENDING_STATUS,
+            bank_code='bca',
+            payment_id=f'tx-{uuid.uuid4()}',
+        )
+        self.donation.save()
+        self.client = APIClient()
+
+    def notify(self, transaction_status, status_code, transaction_id=None):
+        order_id = str(self.donation.id)
+        key = order_id + status_code + '10000.00' + settings.MIDTRANS_SERVER_KEY
+        return self.client.post('/api/midtrans/callback/', {
+            'transaction_id': transaction_id or self.donation.payment_id,
+            'order_id': order_id,
+            'status_code': status_code,
+            'gross_amount': '10000.00',
+            'signature_key': hashlib.sha512(key.encode()).hexdigest(),
+            'transaction_status': transaction_status,
+        }, format='json')
+
+    def get_detail(self, transaction_status, gross_amount='10000.00'):
+        payment = MidtransPayment(
+            self.donation.payment_id, str(self.donation.id), transaction_status, None, '', None, gross_amount,
+        )
+        return mock.patch.object(Midtrans, 'get_transaction_detail', return_value=payment)
+
+    def assert_status(self, status, donation=None):
+        donation = donation or self.donation
+        donation.refresh_from_db()
+        self.assertEqual(donation.status, status)
+
+    @override_settings(MIDTRANS_TRUST_NOTIFICATION=True)
+    def test_trusts_a_status_with_a_code_of_its_own(self):
+        with self.get_detail('pending') as get_transaction_detail:
+            self.assertEqual(self.notify('expire', '407').status_code, 200)
+        get_transaction_detail.assert_not_called()
+        self.assert_status(Donation.FAILED_STATUS)
+
+    @override_settings(MIDTRANS_TRUST_NOTIFICATION=True)
+    def test_asks_midtrans_about_a_settlement(self):
+        # cancel is signed with the same 200, a settlement cannot be told from it
+        with self.get_detail('cancel') as get_transaction_detail:
+            self.assertEqual(self.notify('settlement', '200').status_code, 200)
+        get_transaction_detail.assert_called_once_with(str(self.donation.id))
+        self.assert_status(Donation.FAILED_STATUS)
+
+    @override_settings(MIDTRANS_TRUST_NOTIFICATION=True)
+    def test_asks_midtrans_when_the_status_disagrees_with_its_signed_code(self):
+        with self.get_detail('pending') as get_transaction_detail:
+            self.assertEqual(self.notify('expire', '201').status_code, 200)
+        get_transaction_detail.assert_called_once_with(str(self.donation.id))
+        self.assert_status(Donation.PENDING_STATUS)
+
+    @override_settings(MIDTRANS_TRUST_NOTIFICATION=False)
+    def test_asks_midtrans_unless_notifications_are_trusted(self):
+        with self.get_detail('settlement') as get_transaction_detail:
+            self.assertEqual(self.notify('settlement', '200').status_code, 200)
+        get_transaction_detail.assert_called_once_with(str(self.donation.id))
+        self.assert_status(Donation.SUCCESS_STATUS)
+
+    def test_transaction_id_does_not_pick_the_donation(self):
+        other = Donation(
+            user=self.donation.user,
+            streaming=self.donation.streaming,
+            amount=500000,
+            payment_type=Donation.INSTANT_PAYMENT,
+            status=Donation.PENDING_STATUS,
+            bank_code='bca',
+            payment_id=f'tx-{uuid.uuid4()}',
+        )
+        other.save()
+        with self.get_detail('settlement'):
+            self.notify('settlement', '200', transaction_id=other.payment_id)
+        self.assert_status(Donation.PENDING_STATUS, other)
+        self.assert_status(Donation.SUCCESS_STATUS)
+
+    def test_settlement_of_another_amount_is_ignored(self):
+        with self.get_detail('settlement', gross_amount='1.00'):
+            self.notify('settlement', '200')
+        self.assert_status(Donation.PENDING_STATUS)
+
+    def test_failed_donations_do_not_succeed_later(self):
+        Donation.objects.filter(id=self.donation.id).update(status=Donation.FAILED_STATUS)
+        with self.get_detail('settlement'):
+            self.notify('settlement', '200')
+        self.assert_status(Donation.FAILED_STATUS)
+
+    def test_rejects_an_invalid_signature(self):
+        response = self.client.post('/api/midtrans/callback/', {
+            'order_id': '1', 'status_code': '200', 'gross_amount': '1', 'signature_key': 'x',
+        }, format='json')
+        self.assertEqual(response.status_code, 400)
+
+
+@override_settings(PASSWORD_HASHERS=['django.contrib.auth.hashers.MD5PasswordHasher'])
+class PaymentJobTest(StreamingFixtures, TestCase):
+    def setUp(self):
+        streamer = self.create_user('Streamer')
+        streaming = self.create_streaming(streamer)
+        self.donation = Donation(
+            user=self.create_user('Donor'),
+            streaming=streaming,
+            amount=10000,
+            payment_type=Donation.INSTANT_PAYMENT,
+            status=Donation.PENDING_STATUS,
+            bank_code='bca',
+        )
+        self.donation.save()
+        self.job = PaymentJob.enqueue(self.donation)
+        self.payment = MidtransPayment('tx-1', str(self.donation.id), 'pending', None, '1234567890', None, '10000.00')
+
+    def run_job(self, attempts):
+        PaymentJob.objects.filter(id=self.job.id).update(attempts=attempts - 1, available_at=timezone.now())
+        PaymentJob.claim(1)
+        job = PaymentJob.objects.get(id=self.job.id)
+        job.donation = self.donation
+        job.run()
+        return job
+
+    def test_retry_adopts_a_charge_whose_response_was_lost(self):
+        lost = Exception('Read timed out')
+        with mock.patch.object(Midtrans, 'create_payment', side_effect=lost), \
+                mock.patch.object(Midtrans, 'find_transaction', return_value=None):
+            job = self.run_job(1)
+        self.assertEqual(job.status, PaymentJob.QUEUED_STATUS)
+
+        with mock.patch.object(Midtrans, 'create_payment') as create_payment, \
+                mock.patch.object(Midtrans, 'find_transaction', return_value=self.payment) as find_transaction:
+            job = self.run_job(2)
+        create_payment.assert_not_called()
+        find_transaction.assert_called_once_with(str(self.donation.id))
+        self.assertEqual(job.status, PaymentJob.DONE_STATUS)
+        self.donation.refresh_from_db()
+        self.assertEqual((self.donation.payment_id, self.donation.va_number), ('tx-1', '1234567890'))
+
+    def test_last_attempt_fails_only_without_a_transaction(self):
+        error = Exception('Midtrans is down')
+        with mock.patch.object(Midtrans, 'create_payment', side_effect=error), \
+                mock.patch.object(Midtrans, 'find_transaction', side_effect=[None, error]):
+            job = self.run_job(PaymentJob.MAX_ATTEMPTS)
+        # the charge may exist while Midtrans cannot be asked, the job is retried instead of failed
+        self.assertEqual(job.status, PaymentJob.QUEUED_STATUS)
+        self.donation.refresh_from_db()
+        self.assertEqual(self.donation.status, Donation.PENDING_STATUS)
+
+        with mock.patch.object(Midtrans, 'create_payment', side_effect=error), \
+                mock.patch.object(Midtrans, 'find_transaction', return_value=None):
+            job = self.run_job(PaymentJob.MAX_ATTEMPTS)
+        self.assertEqual(job.status, PaymentJob.FAILED_STATUS)
+        self.donation.refresh_from_db()
+        self.assertEqual(self.donation.status, Donation.FAILED_STATUS)
+
+
+@override_settings(PASSWORD_HASHERS=['django.contrib.auth.hashers.MD5PasswordHasher'], DONATION_TOTAL_SHARDS=4)
+class DonationRollupTest(StreamingFixtures, TestCase):
+    def setUp(self):
+        streamer = self.create_user('Streamer')
+        self.streaming = self.create_streaming(streamer)
+        self.now = DonationRollup.get_bucket(timezone.now(), DonationRollup.HOUR) + timedelta(minutes=30)
+
+    def add(self, amount, shard):
+        donation = Donation(streaming=self.streaming, amount=amount, success_at=self.now)
+        with mock.patch('apps.donation.models.random.randrange', return_value=shard):
+            DonationRollup.add_donations([donation])
+
+    def test_bucket_is_spread_over_shard_rows(self):
+        self.add(1000, 0)
+        self.add(2000, 3)
+        self.add(4000, 3)
+        rows = DonationRollup.objects.filter(streaming=self.streaming, granularity=DonationRollup.MINUTE)
+        self.assertEqual(sorted(rows.values_list('shard', 'total')), [(0, 1000), (3, 6000)])
+
+        series = DonationRollup.get_series(self.streaming.code, DonationRollup.MINUTE, self.now, self.now)
+        self.assertEqual(series, [{'bucket_start': self.now, 'total': 7000, 'donation_count': 3}])
+        series = DonationRollup.get_series(self.streaming.code, DonationRollup.HOUR, self.now, self.now)
+        self.assertEqual([(point['total'], point['donation_count']) for point in series], [(7000, 3)])
+
+    def get_stats(self, query):
+        return APIClient().get(f'/api/streams/{self.streaming.code}/stats/?{urlencode(query)}')
+
+    def test_stats_fill_empty_buckets(self):
+        self.add(1000, 0)
+        self.add(500, 1)
+        response = self.get_stats({
+            'granularity': 'hour',
+            'since': (self.now - timedelta(hours=2)).isoformat(),
+            'until': self.now.isoformat(),
+        })
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([point['total'] for point in response.data['results']], [0, 0, 1500])
+        self.assertEqual(response.data['results'][-1]['donation_count'], 2)
+
+        day = {'since': (self.now - timedelta(days=1)).isoformat(), 'until': self.now.isoformat()}
+        response = self.get_stats({'granularity': 'minute', 'step': 60, **day})
+        self.assertEqual(len(response.data['results']), 25)
+        # a 400 rolls the test's transaction back, so it comes last
+        response = self.get_stats({'granularity': 'minute', **day})
+        self.assertEqual(response.status_code, 400)
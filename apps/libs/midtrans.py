@@ -1,6 +1,14 @@
 import midtransclient
 import hashlib
+import threading
+import time
+import requests
 from django.conf import settings
+from midtransclient.error_midtrans import MidtransAPIError
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from apps.utils.metrics import metrics
 
 
 class RequestPayment:
@@ -21,14 +29,22 @@ class MidtransPayment:
     fraud_status = None
     va_number = None
     transaction_time = None
+    gross_amount = None
 
-    def __init__(self, transaction_id, order_id, transaction_status, fraud_status, va_number, transaction_time):
+    def __init__(self, transaction_id, order_id, transaction_status, fraud_status, va_number, transaction_time, gross_amount=None):
         self.transaction_id = transaction_id
         self.order_id = order_id
         self.transaction_status = transaction_status
         self.fraud_status = fraud_status
         self.va_number = va_number
         self.transaction_time = transaction_time
+        self.gross_amount = gross_amount
+
+    def is_amount(self, amount):
+        try:
+            return float(self.gross_amount) == float(amount)
+        except (TypeError, ValueError):
+            return False
     
     @property
     def is_success(self):
@@ -43,22 +59,84 @@ class MidtransPayment:
         return self.transaction_status in ("expire", "cancel", "deny")
 
 
+class MidtransSession(requests.Session):
+    def __init__(self, timeout, pool_size, max_retries):
+        super().__init__()
+        self.timeout = timeout
+
+        # connect errors are retried for every call since nothing reached Midtrans,
+        # read errors and 5xx responses only for idempotent status lookups
+        retry = Retry(
+            total=max_retries,
+            allowed_methods=frozenset(['GET']),
+            status_forcelist=(500, 502, 503, 504),
+            backoff_factor=0.2,
+            backoff_jitter=0.2,
+            raise_on_status=False,
+        )
+        adapter = HTTPAdapter(pool_maxsize=pool_size, max_retries=retry)
+        self.mount('https://', adapter)
+        self.mount('http://', adapter)
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        call = url.rstrip('/').rsplit('/', 1)[-1]
+        started = time.perf_counter()
+        try:
+            return super().request(method, url, **kwargs)
+        except requests.RequestException:
+            metrics.incr(f'midtrans.{call}.errors')
+            raise
+        finally:
+            metrics.observe(f'midtrans.{call}', time.perf_counter() - started)
+
+
 class Midtrans:
     IS_PRODUCTION = settings.MIDTRANS_PRODUCTION
     CLIENT_KEY = settings.MIDTRANS_CLIENT_KEY
     SERVER_KEY = settings.MIDTRANS_SERVER_KEY
+    TIMEOUT = (settings.MIDTRANS_CONNECT_TIMEOUT, settings.MIDTRANS_READ_TIMEOUT)
+
+    # status_code Midtrans sends with each transaction_status. The signature covers the code but not the status,
+    # so only a status whose code no other status shares can be told from its code.
+    NOTIFICATION_STATUS_CODES = {
+        "capture": "200",
+        "settlement": "200",
+        "cancel": "200",
+        "pending": "201",
+        "deny": "202",
+        "expire": "407",
+    }
+
+    _instance = None
+    _instance_lock = threading.Lock()
 
     def __init__(self):
+        self.session = MidtransSession(
+            timeout=self.TIMEOUT,
+            pool_size=settings.MIDTRANS_POOL_SIZE,
+            max_retries=settings.MIDTRANS_MAX_RETRIES,
+        )
         self.core_api = midtransclient.CoreApi(
             is_production=self.IS_PRODUCTION,
             client_key=self.CLIENT_KEY,
             server_key=self.SERVER_KEY,
         )
+        self.core_api.http_client.http_client = self.session
         self.snap = midtransclient.Snap(
             is_production=self.IS_PRODUCTION,
             client_key=self.CLIENT_KEY,
             server_key=self.SERVER_KEY,
         )
+        self.snap.http_client.http_client = self.session
+
+    @classmethod
+    def instance(cls):
+        if cls._instance is None:
+            with cls._instance_lock:
+                if cls._instance is None:
+                    cls._instance = cls()
+        return cls._instance
 
     def validate_transaction_signature(cls, transaction_data: dict):
         order_id = transaction_data.get("order_id")
@@ -98,7 +176,25 @@ class Midtrans:
             }
         ]
     
+    def get_notification_payment(self, notification: dict):
+        return MidtransPayment(
+            transaction_id=notification.get("transaction_id"),
+            order_id=notification.get("order_id"),
+            transaction_status=notification.get("transaction_status"),
+            fraud_status=notification.get("fraud_status"),
+            va_number="",
+            transaction_time=notification.get("transaction_time"),
+            gross_amount=notification.get("gross_amount"),
+        )
+
+    def is_notification_consistent(self, notification: dict):
+        # capture, settlement and cancel all come with 200, a signed cancel could be replayed as a settlement
+        status_code = notification.get("status_code")
+        statuses = [status for status, code in self.NOTIFICATION_STATUS_CODES.items() if code == status_code]
+        return statuses == [notification.get("transaction_status")]
+
     def get_transaction_detail(self, id):
+        # id is the order_id or the transaction_id
         response = self.core_api.transactions.status(id)
         return MidtransPayment(
             transaction_id=response.get("transaction_id"),
@@ -107,8 +203,37 @@ class Midtrans:
             fraud_status=response.get("fraud_status"),
             va_number="",
             transaction_time=response.get("transaction_time"),
+            gross_amount=response.get("gross_amount"),
+        )
+
+    def find_transaction(self, order_id):
+        # None only when Midtrans answers that the order has no transaction, other errors are raised
+        try:
+            response = self.core_api.transactions.status(order_id)
+        except MidtransAPIError as error:
+            if str((error.api_response_dict or {}).get("status_code")) == "404":
+                return None
+            raise
+        return MidtransPayment(
+            transaction_id=response.get("transaction_id"),
+            order_id=response.get("order_id"),
+            transaction_status=response.get("transaction_status"),
+            fraud_status=response.get("fraud_status"),
+            va_number=self.get_va_number(response),
+            transaction_time=response.get("transaction_time"),
+            gross_amount=response.get("gross_amount"),
         )
 
+    def get_va_number(self, response: dict):
+        if response.get("permata_va_number"):
+            return response.get("permata_va_number")
+        if response.get("bill_key"):
+            return f"{response.get('biller_code')}#{response.get('bill_key')}"
+        va_number = None
+        for va in response.get("va_numbers", []):
+            va_number = va.get("va_number")
+        return va_number
+
     def create_payment(self, payment: RequestPayment):
         handler = {
             "bca": self.create_bca_payment,
@@ -1,3 +1,4 @@
+from django.conf import settings
 from rest_framework import serializers
 from rest_framework.exceptions import ValidationError
 
@@ -38,8 +39,12 @@ class CreateStreamingSerializer(serializers.ModelSerializer):
 
 
 class StreamingSerializer(serializers.ModelSerializer):
+    donation_total = serializers.SerializerMethodField()
     bank = serializers.SerializerMethodField()
 
+    def get_donation_total(self, obj: Streaming):
+        return obj.get_donation_total()
+
     def get_bank(self, obj: Streaming):
         return {
             "name": obj.bank_name,
@@ -62,10 +67,22 @@ class StreamingSerializer(serializers.ModelSerializer):
         )
 
 
+class StreamingSummarySerializer(serializers.Serializer):
+    code = serializers.CharField()
+    status = serializers.IntegerField()
+    date_start = serializers.DateTimeField()
+    date_end = serializers.DateTimeField()
+    donation_total = serializers.FloatField()
+    donation_count = serializers.IntegerField()
+    pending_count = serializers.IntegerField()
+    comment_count = serializers.IntegerField()
+
+
 class CreateCommentSerializer(serializers.ModelSerializer):
     def create(self, validated_data):
         user = self.context.get('request').user
-        return Comment.create(
+        create = Comment.create_buffered if settings.COMMENT_WRITE_BEHIND else Comment.create
+        return create(
             comment=validated_data.get('comment'),
             user=user,
             streaming=validated_data.get('streaming'),
@@ -90,3 +107,35 @@ class CommentSerializer(serializers.ModelSerializer):
     class Meta:
         model = Comment
         fields = ('id', 'user', 'comment', 'date_created')
+
+
+class CommentFeedSerializer(serializers.BaseSerializer):
+    FIELDS = (
+        'id',
+        'user',
+        'user__id',
+        'user__first_name',
+        'user__last_name',
+        'user__email',
+        'streaming_id',
+        'comment',
+        'date_created',
+    )
+    datetime_field = serializers.DateTimeField()
+
+    @classmethod
+    def optimize(cls, queryset):
+        return queryset.with_related(('user',), cls.FIELDS)
+
+    def to_representation(self, obj: Comment):
+        user = obj.user
+        return {
+            'id': obj.id,
+            'user': {
+                'id': user.id,
+                'name': user.name,
+                'email': user.email,
+            },
+            'comment': obj.comment,
+            'date_created': self.datetime_field.to_representation(obj.date_created),
+        }
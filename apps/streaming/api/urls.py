@@ -1,9 +1,12 @@
+from django.urls import path
 from rest_framework.routers import DefaultRouter
 
 from apps.streaming.api import views
 
 
-urlpatterns = []
+urlpatterns = [
+    path('streams/<str:code>/donations/events', views.donation_events_view, name='streams-donation-events'),
+]
 
 router = DefaultRouter()
 router.register('streams', views.streaming_view, basename='streams')
@@ -1,20 +1,61 @@
+import asyncio
+import hashlib
+import json
+import time
+from itertools import islice
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import transaction
+from django.db.models import Count, FloatField, IntegerField, OuterRef, Subquery, Sum, Value
+from django.db.models.functions import Coalesce
+from django.http import Http404, StreamingHttpResponse
+from django.utils.cache import patch_vary_headers
+from django.utils.http import parse_etags, quote_etag
 from rest_framework import status, permissions
 from rest_framework.response import Response
 from rest_framework.viewsets import GenericViewSet
 from rest_framework.decorators import action
-from rest_framework.exceptions import NotFound
+from rest_framework.exceptions import NotFound, PermissionDenied, ValidationError
 
-from apps.streaming.models import Streaming, Comment
+from apps.donation.api.serializers import DonationStatsQuerySerializer, DonationStatsSerializer, DonorTotalSerializer
+from apps.donation.models import Donation, DonationRollup, DonorTotal
+from apps.streaming.buffers import comment_buffers
+from apps.streaming.models import Comment, DonationTotalShard, Streaming, StreamingRanking
 from apps.streaming.api.serializers import (
+    CommentFeedSerializer,
     CommentSerializer,
     CreateCommentSerializer,
     CreateStreamingSerializer,
     StreamingSerializer,
+    StreamingSummarySerializer,
 )
+from apps.utils.cache import read_through
+from apps.utils.db import ReplicaReadMixin, read_from_primary
+from apps.utils.events import get_broker
+from apps.utils.export import CSVRenderer, NDJSONRenderer, accepts_gzip, iter_csv, iter_gzip, iter_ndjson
+from apps.utils.lru import LRUSet
+from apps.utils.paginations import FeedPagination, KeysetPagination
+from apps.utils.throttles import StreamRateThrottle
 
+User = get_user_model()
 
-class StreamingView(GenericViewSet):
+
+class StreamingView(ReplicaReadMixin, GenericViewSet):
     permission_classes = (permissions.IsAuthenticatedOrReadOnly,)
+    replica_actions = ('list', 'retrieve', 'leaderboard', 'stats')
+    pagination_class = KeysetPagination
+    keyset_ordering = ('-score', 'streaming_id')
+    export_fields = (
+        'id', 'date_created', 'success_at', 'user_id',
+        'amount', 'payment_type', 'status', 'bank_name', 'bank_code', 'va_number', 'payment_id',
+    )
+    export_batch_size = 2000
+    export_columns = (
+        'id', 'date_created', 'success_at', 'user_id', 'user_first_name', 'user_last_name', 'user_email',
+        'amount', 'payment_type', 'status', 'bank_name', 'bank_code', 'va_number', 'payment_id',
+    )
 
     def get_object(self):
         streaming = Streaming.objects.filter(code=self.kwargs['pk']).first()
@@ -30,12 +71,190 @@ class StreamingView(GenericViewSet):
         response_serializer = StreamingSerializer(streaming, context=self.get_serializer_context())
         return Response(response_serializer.data, status=status.HTTP_201_CREATED)
     
+    def list(self, request):
+        if request.query_params.get('status', 'live') != 'live' or request.query_params.get('sort', 'trending') != 'trending':
+            raise ValidationError('Only live streams sorted by trending can be listed')
+
+        # every viewer asks for the same first pages, the ranking itself only changes once per compute run
+        cache_key = f'streams:trending:{request.get_full_path()}'
+        data = cache.get(cache_key)
+        if data is None:
+            # rankings are only recomputed periodically, streams that ended since are dropped here
+            rankings = StreamingRanking.objects.filter(streaming__status=Streaming.LIVE).select_related('streaming')
+            if settings.DONATION_TOTAL_SHARDS > 1:
+                rankings = rankings.annotate(shard_total=DonationTotalShard.get_total(OuterRef('streaming')))
+            rankings = self.paginate_queryset(rankings)
+            for ranking in rankings:
+                if hasattr(ranking, 'shard_total'):
+                    ranking.streaming.shard_total = ranking.shard_total
+            serializer = StreamingSerializer([ranking.streaming for ranking in rankings], many=True, context=self.get_serializer_context())
+            data = self.get_paginated_response(serializer.data).data
+            cache.set(cache_key, data, settings.STREAM_LIST_CACHE_TTL)
+
+        return Response(data)
+
     def retrieve(self, request, pk):
-        streaming = self.get_object()
-        serializer = StreamingSerializer(streaming, context=self.get_serializer_context())
-        
-        return Response(serializer.data)
+        detail = read_through(
+            Streaming.get_cache_key(pk),
+            self.load_detail,
+            settings.STREAMING_CACHE_TTL,
+            name='streaming.detail',
+        )
+        headers = {'ETag': detail['etag'], 'Cache-Control': 'no-cache'}
+        if detail['etag'] in parse_etags(request.headers.get('If-None-Match', '')):
+            return Response(status=status.HTTP_304_NOT_MODIFIED, headers=headers)
+
+        return Response(detail['data'], headers=headers)
+
+    def load_detail(self):
+        with read_from_primary():
+            streaming = self.get_object()
+            data = dict(StreamingSerializer(streaming, context=self.get_serializer_context()).data)
+        body = json.dumps(data, cls=DjangoJSONEncoder, sort_keys=True).encode()
+        return {'data': data, 'etag': quote_etag(hashlib.sha1(body).hexdigest())}
     
+    @action(methods=['get'], detail=True)
+    def leaderboard(self, request, pk):
+        try:
+            limit = min(max(int(request.query_params.get('limit', 10)), 1), 100)
+        except ValueError:
+            limit = 10
+
+        # overlays poll this every few seconds, a short-lived cache absorbs most of it
+        cache_key = f'leaderboard:{pk}:{limit}'
+        data = cache.get(cache_key)
+        if data is None:
+            self.get_object()
+            donors = DonorTotal.get_leaderboard(pk, limit)
+            data = DonorTotalSerializer(donors, many=True).data
+            cache.set(cache_key, data, settings.LEADERBOARD_CACHE_TTL)
+
+        return Response(data)
+
+    @action(methods=['get'], detail=False, url_path='mine/summary', permission_classes=(permissions.IsAuthenticated,))
+    def summary(self, request):
+        data = cache.get(Streaming.get_summary_cache_key(request.user.id))
+        if data is None:
+            data = self.load_summary(request.user)
+            cache.set(Streaming.get_summary_cache_key(request.user.id), data, settings.STREAM_SUMMARY_CACHE_TTL)
+        return Response(data)
+
+    def load_summary(self, user):
+        # every figure is a correlated subquery over an index on the stream, so all streams come back in one query
+        def aggregate(queryset, value, output_field=IntegerField()):
+            subquery = queryset.order_by().values('streaming').annotate(value=value).values('value')
+            return Coalesce(Subquery(subquery), Value(0), output_field=output_field)
+
+        pending = Donation.objects.filter(status=Donation.NEED_CONFIRMATION_STATUS)
+        comments = Comment.objects.all()
+        if settings.DATABASE_SHARDS:
+            # donations and comments on shards cannot be joined, they are counted there per stream afterwards
+            counts = {'pending_count': Value(0), 'comment_count': Value(0)}
+        else:
+            counts = {
+                'pending_count': aggregate(pending.filter(streaming=OuterRef('code')), Count('id')),
+                'comment_count': aggregate(comments.filter(streaming=OuterRef('code')), Count('id')),
+            }
+        streams = (
+            Streaming.objects
+            .filter(user=user)
+            .annotate(
+                shard_total=aggregate(
+                    DonationTotalShard.objects.filter(streaming=OuterRef('code')),
+                    Sum('total'),
+                    output_field=FloatField(),
+                ),
+                donation_count=aggregate(DonorTotal.objects.filter(streaming=OuterRef('code')), Sum('donation_count')),
+                **counts,
+            )
+            .order_by('-date_start')
+            .values(
+                'code', 'status', 'date_start', 'date_end', 'donation_total', 'shard_total',
+                'donation_count', 'pending_count', 'comment_count',
+            )
+        )
+        results = []
+        for stream in streams:
+            stream['donation_total'] += stream.pop('shard_total')
+            results.append(stream)
+        if settings.DATABASE_SHARDS:
+            codes = [result['code'] for result in results]
+            pending_counts = pending.aggregate_by_stream(codes, Count('id'))
+            comment_counts = comments.aggregate_by_stream(codes, Count('id'))
+            for result in results:
+                result['pending_count'] = pending_counts.get(result['code'], 0)
+                result['comment_count'] = comment_counts.get(result['code'], 0)
+        totals = {
+            field: sum(result[field] for result in results)
+            for field in ('donation_total', 'donation_count', 'pending_count', 'comment_count')
+        }
+        return {'totals': totals, 'results': StreamingSummarySerializer(results, many=True).data}
+
+    @action(methods=['get'], detail=True)
+    def stats(self, request, pk):
+        serializer = DonationStatsQuerySerializer(data=request.query_params)
+        serializer.is_valid(raise_exception=True)
+        self.get_object()
+
+        series = DonationRollup.get_series(pk, **serializer.validated_data)
+        return Response({
+            'granularity': serializer.validated_data['granularity'],
+            'step': serializer.validated_data['step'],
+            'results': DonationStatsSerializer(series, many=True).data,
+        })
+
+    @action(
+        methods=['get'],
+        detail=True,
+        url_path='donations/export',
+        url_name='donations-export',
+        permission_classes=(permissions.IsAuthenticated,),
+        renderer_classes=(CSVRenderer, NDJSONRenderer),
+    )
+    def export_donations(self, request, pk):
+        streaming = self.get_object()
+        if streaming.user_id != request.user.id and not request.user.is_staff:
+            raise PermissionDenied()
+
+        rows = self.iter_export_rows(streaming)
+        renderer = request.accepted_renderer
+        if renderer.format == 'ndjson':
+            chunks = iter_ndjson(self.export_columns, rows)
+        else:
+            chunks = iter_csv(self.export_columns, rows)
+
+        gzip = accepts_gzip(request.headers.get('Accept-Encoding', ''))
+        response = StreamingHttpResponse(
+            iter_gzip(chunks) if gzip else chunks,
+            content_type=f'{renderer.media_type}; charset={renderer.charset}',
+        )
+        if gzip:
+            response['Content-Encoding'] = 'gzip'
+        patch_vary_headers(response, ('Accept-Encoding',))
+        response['Content-Disposition'] = f'attachment; filename="donations-{streaming.code}.{renderer.format}"'
+        return response
+
+    def iter_export_rows(self, streaming):
+        # a server-side cursor over plain tuples keeps memory flat however many donations there are
+        rows = (
+            Donation.objects
+            .for_stream(streaming.code)
+            .order_by('id')
+            .values_list(*self.export_fields)
+            .iterator(chunk_size=self.export_batch_size)
+        )
+        # donations can be on another database than users, names are looked up once per batch instead of joined
+        user_index = self.export_fields.index('user_id') + 1
+        for batch in iter(lambda: list(islice(rows, self.export_batch_size)), []):
+            users = {
+                user[0]: user[1:]
+                for user in User.objects.filter(id__in={row[user_index - 1] for row in batch}).values_list(
+                    'id', 'first_name', 'last_name', 'email',
+                )
+            }
+            for row in batch:
+                yield row[:user_index] + users.get(row[user_index - 1], (None, None, None)) + row[user_index:]
+
     @action(methods=['post'], detail=True)
     def start(self, request, pk):
         streaming = self.get_object()
@@ -51,27 +270,142 @@ class StreamingView(GenericViewSet):
         return Response(status=status.HTTP_204_NO_CONTENT)
 
 
-class CommentView(GenericViewSet):
+class CommentView(ReplicaReadMixin, GenericViewSet):
     permission_classes = (permissions.IsAuthenticatedOrReadOnly,)
+    pagination_class = FeedPagination
+    keyset_ordering = ('-date_created', '-id')
+    poll_limit = 100
+    throttle_scope = 'comments'
+    # long polls must not hold a transaction open while they wait, create opens its own
+    replica_actions = ('list',)
+    non_atomic_actions = ('create',)
 
     def get_queryset(self):
         query_params = self.request.query_params
         streaming_code = query_params.get('stream')
-        return Comment.objects.filter(streaming=streaming_code).order_by('-date_created')
+        return Comment.objects.for_stream(streaming_code).order_by('-date_created')
+
+    def get_throttles(self):
+        if self.action == 'create':
+            return [StreamRateThrottle()]
+        return super().get_throttles()
 
     def create(self, request):
         serializer = CreateCommentSerializer(data=request.data, context=self.get_serializer_context())
         serializer.is_valid(raise_exception=True)
-        comment = serializer.save()
+        if settings.COMMENT_WRITE_BEHIND:
+            # buffered comments are written by the batch writer, waiting for it inside a transaction could deadlock
+            comment = serializer.save()
+        else:
+            with transaction.atomic():
+                comment = serializer.save()
 
         response_serializer = CommentSerializer(comment, context=self.get_serializer_context())
         return Response(response_serializer.data, status=status.HTTP_201_CREATED)
     
     def list(self, request):
-        streaming = self.paginate_queryset(self.get_queryset())
-        serializer = CommentSerializer(streaming, many=True, context=self.get_serializer_context())
+        if 'since' in request.query_params:
+            return self.poll(request)
+
+        comments = self.paginate_queryset(CommentFeedSerializer.optimize(self.get_queryset()))
+        serializer = CommentFeedSerializer(comments, many=True, context=self.get_serializer_context())
         return self.get_paginated_response(serializer.data)
 
+    def poll(self, request):
+        streaming_code = request.query_params.get('stream')
+        try:
+            since = int(request.query_params.get('since') or 0)
+            wait = min(max(float(request.query_params.get('wait') or 0), 0), settings.COMMENT_POLL_MAX_WAIT)
+        except ValueError:
+            raise ValidationError("Invalid since or wait")
+
+        buffer = comment_buffers.get(streaming_code, self.load_recent_comments)
+        comments = buffer.get_since(since, self.poll_limit)
+        if comments is None:
+            # the cursor is older than the buffer, only the database has these comments
+            queryset = Comment.objects.for_stream(streaming_code).filter(id__gt=since).order_by('id')
+            comments = CommentFeedSerializer(
+                CommentFeedSerializer.optimize(queryset)[:self.poll_limit],
+                many=True,
+            ).data
+        if not comments and wait:
+            comments = buffer.wait(since, self.poll_limit, wait)
+
+        return Response({
+            'results': comments,
+            'last_id': comments[-1]['id'] if comments else since,
+        })
+
+    def load_recent_comments(self, size):
+        if not Streaming.objects.filter(code=self.request.query_params.get('stream')).exists():
+            raise NotFound()
+        queryset = self.get_queryset().order_by('-date_created', '-id')
+        return CommentFeedSerializer(CommentFeedSerializer.optimize(queryset)[:size], many=True).data[::-1]
+
+
+def format_event(event):
+    return f'id: {event.id}\nevent: {event.type}\ndata: {json.dumps(event.data)}\n\n'
+
+
+@transaction.non_atomic_requests
+async def donation_events_view(request, code):
+    if not await Streaming.objects.filter(code=code).aexists():
+        raise Http404()
+
+    last_event_id = request.headers.get('Last-Event-ID') or request.GET.get('last_event_id')
+
+    broker = get_broker()
+    topic = Streaming.get_topic(code)
+    loop = asyncio.get_running_loop()
+    queue = asyncio.Queue(maxsize=settings.SSE_QUEUE_SIZE)
+    overflowed = asyncio.Event()
+
+    def enqueue(event):
+        # a client too slow to keep up is disconnected, it reconnects with Last-Event-ID and replays what it missed
+        if queue.full():
+            overflowed.set()
+        else:
+            queue.put_nowait(event)
+
+    # subscribe before replaying history so nothing published in between is missed
+    unsubscribe = broker.subscribe(topic, lambda event: loop.call_soon_threadsafe(enqueue, event))
+
+    async def stream():
+        # ids are unique but not ordered across processes, the ones sent recently are skipped when seen again
+        sent = LRUSet(broker.history_size + settings.SSE_QUEUE_SIZE)
+        deadline = time.monotonic() + settings.SSE_MAX_DURATION
+        try:
+            yield f'retry: {settings.SSE_RETRY_MS}\n\n'
+            if last_event_id:
+                history = broker.get_history(topic, last_event_id)
+                if history is None:
+                    # the event is no longer held here, the client reloads its state instead of missing events
+                    yield 'event: resync\ndata: {}\n\n'
+                for event in history or ():
+                    sent.add(event.id)
+                    yield format_event(event)
+
+            # connections are recycled periodically, the client reconnects with Last-Event-ID
+            while time.monotonic() < deadline and not overflowed.is_set():
+                try:
+                    event = await asyncio.wait_for(queue.get(), timeout=settings.SSE_HEARTBEAT)
+                except asyncio.TimeoutError:
+                    yield ': keep-alive\n\n'
+                    continue
+                if overflowed.is_set():
+                    break
+                if event.id in sent:
+                    continue
+                sent.add(event.id)
+                yield format_event(event)
+        finally:
+            unsubscribe()
+
+    response = StreamingHttpResponse(stream(), content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'
+    return response
+
 
 streaming_view = StreamingView
 comment_view = CommentView
@@ -1,6 +1,14 @@
 from django.apps import AppConfig
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.db import DEFAULT_DB_ALIAS, connections
 
 
 class StreamingConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'apps.streaming'
+
+    def ready(self):
+        # buffered comments get their ids from blocks reserved per process, only a sequence keeps them unique
+        if settings.COMMENT_WRITE_BEHIND and connections[DEFAULT_DB_ALIAS].vendor != 'postgresql':
+            raise ImproperlyConfigured('COMMENT_WRITE_BEHIND needs a PostgreSQL database')
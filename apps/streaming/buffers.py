@@ -0,0 +1,120 @@
+import threading
+import time
+from collections import OrderedDict, deque
+from itertools import islice
+from django.conf import settings
+
+from apps.streaming.models import Streaming
+from apps.utils.events import get_broker
+
+
+class CommentBuffer:
+    def __init__(self, size):
+        self.size = size
+        # comments in the order their commits were published. Ids reserved in blocks do not follow that order,
+        # so a cursor is the id of the last comment seen and the buffer serves whatever arrived after it.
+        self.comments = deque()
+        self.sequences = {}
+        self.first_sequence = 0
+        self.next_sequence = 0
+        self.condition = threading.Condition()
+        self.ready = threading.Event()
+        self.loaded = False
+        self.unsubscribe = None
+
+    def add(self, comment):
+        with self.condition:
+            if comment['id'] in self.sequences:
+                return
+            self.sequences[comment['id']] = self.next_sequence
+            self.next_sequence += 1
+            self.comments.append(comment)
+            if len(self.comments) > self.size:
+                del self.sequences[self.comments.popleft()['id']]
+                self.first_sequence += 1
+            self.condition.notify_all()
+
+    def load(self, recent):
+        # comments committed before the subscription go ahead of the ones that arrived while they were loaded
+        with self.condition:
+            older = [comment for comment in recent if comment['id'] not in self.sequences]
+            for comment in reversed(older[max(len(older) - (self.size - len(self.comments)), 0):]):
+                self.first_sequence -= 1
+                self.sequences[comment['id']] = self.first_sequence
+                self.comments.appendleft(comment)
+            self.loaded = True
+
+    def get_after(self, sequence, limit):
+        start = max(sequence - self.first_sequence, 0)
+        return list(islice(self.comments, start, start + limit))
+
+    def get_since(self, since, limit):
+        # None when the cursor is not held, it is then older than the buffer
+        sequence = self.sequences.get(since)
+        if not self.loaded or sequence is None:
+            return None
+        return self.get_after(sequence + 1, limit)
+
+    def wait(self, since, limit, timeout):
+        deadline = time.monotonic() + timeout
+        with self.condition:
+            # whatever arrives from now on is new to a cursor the buffer does not hold
+            mark = self.next_sequence
+            while True:
+                comments = self.get_since(since, limit)
+                if comments is None:
+                    comments = [comment for comment in self.get_after(mark, limit + 1) if comment['id'] != since][:limit]
+                remaining = deadline - time.monotonic()
+                if comments or remaining <= 0:
+                    return comments
+                self.condition.wait(remaining)
+
+
+class CommentBuffers:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.buffers = OrderedDict()
+
+    def get(self, code, load_recent):
+        with self.lock:
+            buffer = self.buffers.get(code)
+            created = buffer is None
+            if created:
+                buffer = self.create(code)
+            else:
+                self.buffers.move_to_end(code)
+
+        if not created:
+            buffer.ready.wait()
+            return buffer
+
+        try:
+            buffer.load(load_recent(buffer.size))
+        except Exception:
+            with self.lock:
+                self.discard(code)
+            raise
+        finally:
+            buffer.ready.set()
+        return buffer
+
+    def create(self, code):
+        buffer = CommentBuffer(settings.COMMENT_BUFFER_SIZE)
+        self.buffers[code] = buffer
+        while len(self.buffers) > settings.COMMENT_BUFFER_STREAMS:
+            self.discard(next(iter(self.buffers)))
+
+        # subscribe before loading recent comments so the ones committed in between are not lost
+        buffer.unsubscribe = get_broker().subscribe(
+            Streaming.get_comment_topic(code),
+            lambda event: buffer.add(event.data),
+        )
+        return buffer
+
+    def discard(self, code):
+        buffer = self.buffers.pop(code, None)
+        if buffer is not None:
+            buffer.unsubscribe()
+
+
+comment_buffers = CommentBuffers()
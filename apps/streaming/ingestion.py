@@ -0,0 +1,114 @@
+import atexit
+import logging
+import threading
+import time
+from collections import defaultdict, deque
+from concurrent.futures import Future
+from django.db import connection, router
+from django.utils import timezone
+from rest_framework import status
+from rest_framework.exceptions import APIException
+
+from apps.utils.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class IngestionBacklogged(APIException):
+    status_code = status.HTTP_503_SERVICE_UNAVAILABLE
+    default_detail = 'Too many messages, try again shortly.'
+    default_code = 'ingestion_backlogged'
+    wait = 1
+
+
+class BatchWriter:
+    def __init__(self, model, name, batch_size, interval, capacity):
+        self.model = model
+        self.name = name
+        self.batch_size = batch_size
+        self.interval = interval
+        self.capacity = capacity
+        self.queue = deque()
+        self.condition = threading.Condition()
+        self.thread = None
+        self.stopping = False
+
+    def submit(self, obj):
+        future = Future()
+        with self.condition:
+            if len(self.queue) >= self.capacity:
+                metrics.incr(f'{self.name}.rejected')
+                raise IngestionBacklogged()
+            self.queue.append((obj, future))
+            if self.thread is None:
+                self.start()
+            # wake the writer when a batch starts and again when it fills up
+            if len(self.queue) == 1 or len(self.queue) >= self.batch_size:
+                self.condition.notify()
+        return future
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name=f'{self.name}-writer', daemon=True)
+        self.thread.start()
+        atexit.register(self.stop)
+
+    def stop(self):
+        with self.condition:
+            self.stopping = True
+            self.condition.notify()
+        self.thread.join(timeout=10)
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.queue and not self.stopping:
+                    self.condition.wait()
+                if not self.queue:
+                    return
+
+                # give a burst the flush interval to fill the batch, unless it is already full
+                deadline = time.monotonic() + self.interval
+                while len(self.queue) < self.batch_size and not self.stopping:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self.condition.wait(remaining)
+
+                batch = [self.queue.popleft() for _ in range(min(self.batch_size, len(self.queue)))]
+            # rows whose caller gave up waiting were cancelled and are not written
+            batch = [(obj, future) for obj, future in batch if future.set_running_or_notify_cancel()]
+            if batch:
+                self.flush(batch)
+
+    def flush(self, batch):
+        objs = [obj for obj, _ in batch]
+        started = time.perf_counter()
+        try:
+            self.insert(objs)
+        except Exception as error:
+            logger.exception('Failed to write %s %s rows', len(objs), self.name)
+            metrics.incr(f'{self.name}.failed', len(objs))
+            connection.close()
+            for _, future in batch:
+                future.set_exception(error)
+            return
+        finally:
+            metrics.observe(f'{self.name}.flush', time.perf_counter() - started)
+
+        metrics.incr(f'{self.name}.flushes')
+        metrics.incr(f'{self.name}.rows', len(objs))
+        for obj, future in batch:
+            future.set_result(obj)
+
+    def insert(self, objs):
+        # raw inserts keep the id assigned when the row was accepted. Rows are stamped when they are written,
+        # so date_created follows commit order for readers that page by it.
+        fields = self.model._meta.concrete_fields
+        now = timezone.now()
+        for obj in objs:
+            obj.date_created = obj.date_updated = now
+        databases = defaultdict(list)
+        for obj in objs:
+            databases[router.db_for_write(self.model, instance=obj)].append(obj)
+        for using, rows in databases.items():
+            self.model.objects.using(using)._insert(rows, fields=fields, raw=True, using=using)
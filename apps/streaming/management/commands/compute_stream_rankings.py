@@ -0,0 +1,55 @@
+import time
+from datetime import timedelta
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+from django.db.models import Count, Sum
+from django.utils import timezone
+
+from apps.donation.models import Donation
+from apps.streaming.models import Comment, Streaming, StreamingRanking
+
+
+class Command(BaseCommand):
+    help = 'Rank live streams by recent donation volume and comment velocity'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500)
+        parser.add_argument('--interval', type=float, default=60.0)
+        parser.add_argument('--once', action='store_true', help='Compute the ranking once and exit')
+
+    def handle(self, *args, **options):
+        while True:
+            close_old_connections()
+            ranked = self.compute(options['batch_size'])
+            self.stdout.write(f'Ranked {ranked} live streams')
+            if options['once']:
+                break
+            time.sleep(options['interval'])
+
+    def compute(self, batch_size):
+        since = timezone.now() - timedelta(minutes=settings.STREAM_RANKING_WINDOW)
+        queryset = Streaming.objects.filter(status=Streaming.LIVE).order_by('code')
+
+        ranked = 0
+        last_code = ''
+        while True:
+            codes = list(queryset.filter(code__gt=last_code).values_list('code', flat=True)[:batch_size])
+            if not codes:
+                break
+            StreamingRanking.store(codes, self.get_donation_volumes(codes, since), self.get_comment_counts(codes, since))
+            ranked += len(codes)
+            last_code = codes[-1]
+
+        StreamingRanking.objects.exclude(streaming__status=Streaming.LIVE).delete()
+        return ranked
+
+    def get_donation_volumes(self, codes, since):
+        return (
+            Donation.objects
+            .filter(status=Donation.SUCCESS_STATUS, success_at__gte=since)
+            .aggregate_by_stream(codes, Sum('amount'))
+        )
+
+    def get_comment_counts(self, codes, since):
+        return Comment.objects.filter(date_created__gte=since).aggregate_by_stream(codes, Count('id'))
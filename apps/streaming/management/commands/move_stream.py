@@ -0,0 +1,90 @@
+import time
+from functools import reduce
+from operator import or_
+from django.conf import settings
+from django.core.cache import cache
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DEFAULT_DB_ALIAS
+from django.db.models import Q
+from django.db.models.constants import OnConflict
+
+from apps.donation.models import Donation
+from apps.streaming.models import Comment, Streaming
+from apps.utils.sharding import get_databases, get_placement_key
+
+
+class Command(BaseCommand):
+    help = "Move a stream's donations and comments to another database"
+
+    models = (Donation, Comment)
+
+    def add_arguments(self, parser):
+        parser.add_argument('code')
+        parser.add_argument('database', help='default or one of the shard aliases')
+        parser.add_argument('--batch-size', type=int, default=500)
+        parser.add_argument(
+            '--settle',
+            type=float,
+            default=settings.SHARD_PLACEMENT_CACHE_TTL,
+            help='Seconds to wait for other processes to see the new placement before the source is cleared',
+        )
+
+    def handle(self, *args, **options):
+        code, target = options['code'], options['database']
+        if target not in get_databases():
+            raise CommandError(f'Unknown database {target}, expected one of {", ".join(get_databases())}')
+
+        streaming = Streaming.objects.filter(code=code).first()
+        if streaming is None:
+            raise CommandError(f'Stream {code} does not exist')
+        source = streaming.database or DEFAULT_DB_ALIAS
+        if source == target:
+            self.stdout.write(f'Stream {code} is already on {target}')
+            return
+
+        # rows are copied, the placement switched, and rows written to the old database by processes that had
+        # not seen the switch yet copied again while the source is cleared
+        self.copy(code, source, target, options['batch_size'])
+        Streaming.objects.filter(code=code).update(database=target)
+        cache.delete(get_placement_key(code))
+        time.sleep(options['settle'])
+
+        moved = 0
+        while True:
+            copied = self.copy(code, source, target, options['batch_size'], clear=True)
+            if not copied:
+                break
+            moved += copied
+        self.stdout.write(self.style.SUCCESS(f'Moved {moved} rows of stream {code} from {source} to {target}'))
+
+    def copy(self, code, source, target, batch_size, clear=False):
+        copied = 0
+        for model in self.models:
+            last_id = 0
+            while True:
+                rows = list(model.objects.using(source).filter(streaming=code, id__gt=last_id).order_by('id')[:batch_size])
+                if not rows:
+                    break
+                self.sync(model, rows, target)
+                if clear:
+                    # a row changed on the source since it was read is left for the next pass
+                    model.objects.using(source).filter(
+                        reduce(or_, (Q(id=row.id, date_updated=row.date_updated) for row in rows)),
+                    )._raw_delete(source)
+                copied += len(rows)
+                last_id = rows[-1].id
+        return copied
+
+    def sync(self, model, rows, target):
+        fields = model._meta.concrete_fields
+        # raw inserts keep ids and timestamps, rows the target already has are left to the update below
+        model.objects.using(target)._insert(rows, fields=fields, raw=True, using=target, on_conflict=OnConflict.IGNORE)
+
+        # the target is where the stream is written once the placement switched, a row is only overwritten
+        # when the source has the more recent change
+        updated = dict(model.objects.using(target).filter(id__in=[row.id for row in rows]).values_list('id', 'date_updated'))
+        for row in rows:
+            if updated.get(row.id) is not None and updated[row.id] < row.date_updated:
+                model.objects.using(target).filter(id=row.id, date_updated__lt=row.date_updated).update(**{
+                    field.attname: field.value_from_object(row) for field in fields if not field.primary_key
+                })
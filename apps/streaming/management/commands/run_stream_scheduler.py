@@ -0,0 +1,33 @@
+import time
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+from django.utils import timezone
+
+from apps.streaming.models import Streaming
+
+
+class Command(BaseCommand):
+    help = 'Start and end streams when their date_start and date_end pass'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500)
+        parser.add_argument('--poll-interval', type=float, default=5.0)
+        parser.add_argument('--once', action='store_true', help='Transition the due streams once and exit')
+
+    def handle(self, *args, **options):
+        while True:
+            close_old_connections()
+            ended, started = self.tick(options['batch_size'])
+            if ended or started:
+                self.stdout.write(f'Ended {ended} and started {started} streams')
+                continue
+            if options['once']:
+                break
+            time.sleep(options['poll_interval'])
+
+    def tick(self, batch_size):
+        # ending first keeps streams whose whole window already passed from being started
+        now = timezone.now()
+        ended = len(Streaming.end_due(now, batch_size))
+        started = len(Streaming.start_due(now, batch_size))
+        return ended, started
@@ -0,0 +1,27 @@
+# Generated by Django 4.2.13 on 2026-10-18 09:10
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('streaming', '0002_comment'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DonationTotalShard',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('shard', models.PositiveSmallIntegerField()),
+                ('total', models.FloatField(default=0)),
+                ('streaming', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='donation_total_shards', to='streaming.streaming')),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='donationtotalshard',
+            constraint=models.UniqueConstraint(fields=('streaming', 'shard'), name='unique_donation_total_shard'),
+        ),
+    ]
@@ -0,0 +1,21 @@
+# Generated by Django 4.2.13 on 2026-10-18 09:25
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('streaming', '0004_comment_stream_date_idx'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='streaming',
+            index=models.Index(fields=['status', 'date_start'], name='streaming_status_start_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='streaming',
+            index=models.Index(fields=['status', 'date_end'], name='streaming_status_end_idx'),
+        ),
+    ]
@@ -0,0 +1,27 @@
+# Generated by Django 4.2.13 on 2026-10-18 09:26
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('streaming', '0005_streaming_schedule_idx'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StreamingRanking',
+            fields=[
+                ('streaming', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='ranking', serialize=False, to='streaming.streaming')),
+                ('score', models.FloatField(default=0)),
+                ('donation_volume', models.FloatField(default=0)),
+                ('comment_count', models.PositiveIntegerField(default=0)),
+                ('date_updated', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['-score', 'streaming'], name='streaming_ranking_score_idx')],
+            },
+        ),
+    ]
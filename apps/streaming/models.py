@@ -1,9 +1,20 @@
+import math
 import random
 import string
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from django.conf import settings
 from django.contrib.auth import get_user_model
-from django.db import models
+from django.db import IntegrityError, models, transaction
+from django.db.models import F, Subquery, Sum, Value
+from django.db.models.functions import Coalesce
+from django.utils import timezone
 
+from apps.streaming.ingestion import BatchWriter, IngestionBacklogged
+from apps.utils.cache import delete_on_commit
+from apps.utils.events import publish_on_commit
+from apps.utils.ids import get_id_allocator
 from apps.utils.models import BaseModel
+from apps.utils.sharding import ShardedModel, pick_shard
 
 User = get_user_model()
 
@@ -42,6 +53,15 @@ class Streaming(BaseModel):
 
     donation_total = models.FloatField(default=0)
 
+    # database holding the stream's donations and comments, empty for the primary
+    database = models.CharField(max_length=50, null=True, blank=True)
+
+    class Meta:
+        indexes = (
+            models.Index(fields=('status', 'date_start'), name='streaming_status_start_idx'),
+            models.Index(fields=('status', 'date_end'), name='streaming_status_end_idx'),
+        )
+
     @classmethod
     def create_streaming(cls, user, start, end, bank: BankInfo):
         streaming = cls(
@@ -53,32 +73,256 @@ class Streaming(BaseModel):
             bank_account_number=bank.account_number,
         )
         streaming.set_code()
+        if settings.DATABASE_SHARDS:
+            streaming.database = pick_shard(streaming.code)
         streaming.save()
+        DonationTotalShard.create_shards(streaming)
 
         return streaming
     
+    @staticmethod
+    def get_topic(code):
+        return f'streaming:{code}'
+
+    @staticmethod
+    def get_comment_topic(code):
+        return f'streaming:{code}:comments'
+
+    @staticmethod
+    def get_cache_key(code):
+        return f'streaming:{code}:detail'
+
+    @classmethod
+    def invalidate_cache(cls, *codes):
+        delete_on_commit(*[cls.get_cache_key(code) for code in codes])
+
+    @staticmethod
+    def get_summary_cache_key(user_id):
+        return f'streaming:summary:{user_id}'
+
+    @classmethod
+    def invalidate_summary(cls, *user_ids):
+        delete_on_commit(*[cls.get_summary_cache_key(user_id) for user_id in user_ids])
+
+    @classmethod
+    def invalidate_summary_of_streams(cls, codes):
+        cls.invalidate_summary(*set(cls.objects.filter(code__in=codes).values_list('user', flat=True)))
+
     def set_code(self):
         code = ''.join(random.choice(string.digits + string.ascii_letters) for _ in range(8))
         self.code = code
     
     def start(self):
         self.status = self.LIVE
-        self.save()
+        # a full save could put back a placement move_stream changed in the meantime
+        self.save(update_fields=('status', 'date_updated'))
+        self.invalidate_cache(self.code)
+        self.invalidate_summary(self.user_id)
+        self.publish(self.code, 'streaming.started', self.status)
     
     def stop(self):
         self.status = self.ENDED
-        self.save()
+        self.save(update_fields=('status', 'date_updated'))
+        self.invalidate_cache(self.code)
+        self.invalidate_summary(self.user_id)
+        self.publish(self.code, 'streaming.ended', self.status)
+
+    @classmethod
+    def start_due(cls, now, limit):
+        return cls.transition_due((cls.PENDING,), 'date_start', cls.LIVE, 'streaming.started', now, limit)
+
+    @classmethod
+    def end_due(cls, now, limit):
+        # streams nobody started are ended as well once their end has passed
+        return cls.transition_due((cls.PENDING, cls.LIVE), 'date_end', cls.ENDED, 'streaming.ended', now, limit)
+
+    @classmethod
+    def transition_due(cls, statuses, date_field, status, event, now, limit):
+        with transaction.atomic():
+            codes = list(
+                cls.objects
+                .select_for_update(skip_locked=True)
+                .filter(status__in=statuses, **{f'{date_field}__lte': now})
+                .order_by(date_field)
+                .values_list('code', flat=True)[:limit]
+            )
+            if not codes:
+                return codes
+            cls.objects.filter(code__in=codes, status__in=statuses).update(status=status, date_updated=now)
+            cls.invalidate_cache(*codes)
+            cls.invalidate_summary_of_streams(codes)
+            for code in codes:
+                cls.publish(code, event, status)
+        return codes
+
+    @classmethod
+    def publish(cls, code, type, status):
+        publish_on_commit(cls.get_topic(code), type, {'code': code, 'status': status})
+
+    @classmethod
+    def add_donation(cls, code, amount):
+        cls.invalidate_cache(code)
+        shards = settings.DONATION_TOTAL_SHARDS
+        if shards <= 1:
+            cls.objects.filter(code=code).update(donation_total=F('donation_total') + amount)
+            return
+        DonationTotalShard.increment(code, random.randrange(shards), amount)
+
+    @classmethod
+    def lock_counters(cls, codes):
+        # record_success increments these first and holds them until commit, so while they are locked no
+        # donation of the streams can be counted halfway through a rebuild
+        list(cls.objects.select_for_update().filter(code__in=codes).values_list('code', flat=True))
+        list(DonationTotalShard.objects.select_for_update().filter(streaming__in=codes).values_list('id', flat=True))
+
+    def get_donation_total(self):
+        if settings.DONATION_TOTAL_SHARDS <= 1:
+            return self.donation_total
+        # lists annotate shard_total with DonationTotalShard.get_total instead of querying every stream
+        shard_total = getattr(self, 'shard_total', None)
+        if shard_total is None:
+            shard_total = self.donation_total_shards.aggregate(total=Sum('total'))['total'] or 0
+        return self.donation_total + shard_total
+
+
+class StreamingRanking(models.Model):
+    # precomputed by compute_stream_rankings so browsing live streams never aggregates donations or comments
+    streaming = models.OneToOneField(Streaming, on_delete=models.CASCADE, primary_key=True, related_name='ranking')
+    score = models.FloatField(default=0)
+    donation_volume = models.FloatField(default=0)
+    comment_count = models.PositiveIntegerField(default=0)
+    date_updated = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        indexes = (
+            models.Index(fields=('-score', 'streaming'), name='streaming_ranking_score_idx'),
+        )
+
+    @staticmethod
+    def get_score(donation_volume, comment_count):
+        # logarithms keep one huge donation from outweighing a busy chat
+        return math.log1p(donation_volume) + math.log1p(comment_count)
+
+    @classmethod
+    def store(cls, codes, donation_volumes, comment_counts):
+        now = timezone.now()
+        rankings = [
+            cls(
+                streaming_id=code,
+                score=cls.get_score(donation_volumes.get(code, 0), comment_counts.get(code, 0)),
+                donation_volume=donation_volumes.get(code, 0),
+                comment_count=comment_counts.get(code, 0),
+                date_updated=now,
+            )
+            for code in codes
+        ]
+        cls.objects.bulk_create(
+            rankings,
+            update_conflicts=True,
+            unique_fields=('streaming',),
+            update_fields=('score', 'donation_volume', 'comment_count', 'date_updated'),
+        )
+
 
+class DonationTotalShard(models.Model):
+    streaming = models.ForeignKey(Streaming, on_delete=models.CASCADE, related_name='donation_total_shards')
+    shard = models.PositiveSmallIntegerField()
+    total = models.FloatField(default=0)
+
+    class Meta:
+        constraints = (
+            models.UniqueConstraint(fields=('streaming', 'shard'), name='unique_donation_total_shard'),
+        )
+
+    @classmethod
+    def create_shards(cls, streaming):
+        shards = settings.DONATION_TOTAL_SHARDS
+        if shards <= 1:
+            return
+        cls.objects.bulk_create(
+            [cls(streaming=streaming, shard=shard) for shard in range(shards)],
+            ignore_conflicts=True,
+        )
+
+    @classmethod
+    def get_total(cls, code):
+        subquery = cls.objects.filter(streaming=code).order_by().values('streaming').annotate(total=Sum('total')).values('total')
+        return Coalesce(Subquery(subquery), Value(0.0), output_field=models.FloatField())
+
+    @classmethod
+    def increment(cls, code, shard, amount):
+        queryset = cls.objects.filter(streaming=code, shard=shard)
+        if queryset.update(total=F('total') + amount):
+            return
 
-class Comment(BaseModel):
-    user = models.ForeignKey(User, on_delete=models.PROTECT, related_name='comments')
-    streaming = models.ForeignKey(Streaming, on_delete=models.PROTECT, related_name='streamings')
+        # streams created before sharding was enabled have no shard rows yet
+        try:
+            with transaction.atomic():
+                cls.objects.create(streaming_id=code, shard=shard, total=amount)
+        except IntegrityError:
+            queryset.update(total=F('total') + amount)
+
+
+class Comment(ShardedModel, BaseModel):
+    # comments can live on another database than users and streams, where no foreign key can reach them
+    user = models.ForeignKey(User, on_delete=models.PROTECT, related_name='comments', db_constraint=False)
+    streaming = models.ForeignKey(Streaming, on_delete=models.PROTECT, related_name='streamings', db_constraint=False)
     comment = models.TextField()
 
+    class Meta:
+        indexes = (
+            models.Index(fields=('streaming', 'date_created'), name='comment_stream_date_idx'),
+        )
+
     @classmethod
     def create(cls, comment, user, streaming):
-        return cls.objects.create(
+        comment = cls(
             comment=comment,
             user=user,
             streaming=streaming
         )
+        comment.save()
+        comment.on_created()
+        return comment
+
+    @classmethod
+    def create_buffered(cls, comment, user, streaming):
+        now = timezone.now()
+        comment = cls(
+            id=comment_ids.allocate(),
+            comment=comment,
+            user=user,
+            streaming=streaming,
+            date_created=now,
+            date_updated=now,
+        )
+        future = comment_writer.submit(comment)
+        future.add_done_callback(lambda future: not future.cancelled() and future.exception() is None and comment.on_created())
+        if settings.COMMENT_WRITE_BEHIND_DURABILITY == 'flushed':
+            try:
+                future.result(timeout=settings.COMMENT_WRITE_BEHIND_TIMEOUT)
+            except FutureTimeoutError:
+                # a comment still queued is dropped, so the client retrying does not post it twice
+                future.cancel()
+                raise IngestionBacklogged()
+        return comment
+
+    def on_created(self):
+        Streaming.invalidate_summary(self.streaming.user_id)
+        self.publish()
+
+    def publish(self):
+        from apps.streaming.api.serializers import CommentFeedSerializer
+
+        data = CommentFeedSerializer(self).data
+        publish_on_commit(Streaming.get_comment_topic(self.streaming_id), 'comment.created', data)
+
+
+comment_ids = get_id_allocator(Comment, settings.COMMENT_ID_BLOCK_SIZE)
+comment_writer = BatchWriter(
+    Comment,
+    name='comments',
+    batch_size=settings.COMMENT_WRITE_BEHIND_BATCH_SIZE,
+    interval=settings.COMMENT_WRITE_BEHIND_INTERVAL_MS / 1000,
+    capacity=settings.COMMENT_WRITE_BEHIND_CAPACITY,
+)
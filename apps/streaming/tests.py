@@ -1,3 +1,756 @@
-from django.test import TestCase
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from datetime import timedelta
+from io import StringIO
+from types import SimpleNamespace
+from unittest import mock, skipUnless
+from django.conf import settings
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import connection, connections
+from django.db.models import Sum
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from rest_framework.test import APIClient, APIRequestFactory
 
-# Create your tests here.
+from apps.donation.models import Donation, DonorTotal, ManualPayment, PendingConfirmationCount
+from apps.streaming.buffers import CommentBuffer
+from apps.streaming.ingestion import BatchWriter, IngestionBacklogged
+from apps.streaming.api.views import donation_events_view
+from apps.streaming.management.commands.move_stream import Command as MoveStreamCommand
+from apps.streaming.models import Comment, DonationTotalShard, Streaming, StreamingRanking
+from apps.utils.cache import read_through
+from apps.utils.db import ReplicaRouter, read_database, read_from_primary
+from apps.utils.events import Event, LocalBroker
+from apps.utils.sharding import get_shard, get_shards, pick_shard
+from apps.utils.testing import StreamingFixtures
+from apps.utils.throttles import StreamRateThrottle
+
+
+@override_settings(PASSWORD_HASHERS=['django.contrib.auth.hashers.MD5PasswordHasher'])
+class CommentListTest(StreamingFixtures, TestCase):
+    def setUp(self):
+        streamer = self.create_user('Streamer')
+        self.streaming = self.create_streaming(streamer)
+        for index in range(30):
+            viewer = self.create_user(f'Viewer {index}')
+            Comment.create(f'Comment {index}', viewer, self.streaming)
+        self.client = APIClient()
+
+    def count_list_queries(self, query):
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(f'/api/comments/?stream={self.streaming.code}&{query}')
+        self.assertEqual(response.status_code, 200)
+        return len(context.captured_queries)
+
+    def test_query_count_does_not_grow_with_page_size(self):
+        self.assertEqual(self.count_list_queries('page_size=1'), self.count_list_queries('page_size=30'))
+        self.assertEqual(self.count_list_queries('cursor=&page_size=1'), self.count_list_queries('cursor=&page_size=30'))
+
+
+@override_settings(PASSWORD_HASHERS=['django.contrib.auth.hashers.MD5PasswordHasher'])
+class CommentThrottleTest(StreamingFixtures, TransactionTestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = self.create_user('Viewer')
+        self.streamings = [self.create_streaming(self.user) for _ in range(2)]
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def post_comment(self, streaming):
+        return self.client.post('/api/comments/', {'streaming': streaming.code, 'comment': 'Hi'}, format='json')
+
+    def test_rejects_comments_once_the_bucket_is_empty(self):
+        # a fixed clock keeps the bucket from refilling
+        with mock.patch.object(StreamRateThrottle, 'timer', return_value=30.0):
+            self.assert_rejects_the_21st_comment()
+
+    def assert_rejects_the_21st_comment(self):
+        for _ in range(20):
+            self.assertEqual(self.post_comment(self.streamings[0]).status_code, 201)
+
+        response = self.post_comment(self.streamings[0])
+        self.assertEqual(response.status_code, 429)
+        self.assertIn('Retry-After', response)
+        self.assertEqual(Comment.objects.count(), 20)
+
+        self.assertEqual(self.post_comment(self.streamings[1]).status_code, 201)
+
+
+class StreamRateThrottleTest(SimpleTestCase):
+    def setUp(self):
+        cache.clear()
+        self.view = SimpleNamespace(throttle_scope='comments')
+
+    def get_request(self, data):
+        user = SimpleNamespace(is_authenticated=True, pk=1)
+        return SimpleNamespace(user=user, content_type='application/json', data=data)
+
+    def test_concurrent_requests_share_the_bucket(self):
+        request = self.get_request({'streaming': 'abc'})
+        with mock.patch.object(StreamRateThrottle, 'timer', return_value=30.0):
+            with ThreadPoolExecutor(max_workers=10) as executor:
+                allowed = list(executor.map(lambda _: StreamRateThrottle().allow_request(request, self.view), range(50)))
+        self.assertEqual(allowed.count(True), 20)
+
+    def allow(self, request, now):
+        throttle = StreamRateThrottle()
+        with mock.patch.object(StreamRateThrottle, 'timer', return_value=now):
+            return throttle.allow_request(request, self.view), throttle
+
+    def test_tokens_refill_one_interval_at_a_time(self):
+        request = self.get_request({'streaming': 'abc'})
+        for _ in range(20):
+            self.assertTrue(self.allow(request, 59.0)[0])
+
+        # 20/min refills a token every 3 seconds
+        allowed, throttle = self.allow(request, 61.0)
+        self.assertFalse(allowed)
+        self.assertAlmostEqual(throttle.wait(), 1.0)
+        self.assertTrue(self.allow(request, 62.0)[0])
+        self.assertFalse(self.allow(request, 62.0)[0])
+
+    def test_rejected_requests_do_not_use_tokens(self):
+        request = self.get_request({'streaming': 'abc'})
+        for _ in range(20):
+            _, throttle = self.allow(request, 0.0)
+        key = throttle.get_cache_key(request, self.view)
+        full_at = cache.get(key)
+        self.assertEqual(full_at, 60000)
+        for _ in range(10):
+            self.assertFalse(self.allow(request, 1.0)[0])
+        self.assertEqual(cache.get(key), full_at)
+        self.assertTrue(self.allow(request, 3.0)[0])
+
+    def test_idle_bucket_holds_no_more_than_its_size(self):
+        request = self.get_request({'streaming': 'abc'})
+        self.assertTrue(self.allow(request, 0.0)[0])
+        allowed = [self.allow(request, 600.0)[0] for _ in range(25)]
+        self.assertEqual(allowed.count(True), 20)
+
+    def test_non_object_bodies_share_one_bucket(self):
+        self.assertTrue(StreamRateThrottle().allow_request(self.get_request(['abc']), self.view))
+
+
+class ReadFromPrimaryTest(SimpleTestCase):
+    def test_cache_fills_bypass_the_replica(self):
+        token = read_database.set('replica0')
+        try:
+            with read_from_primary():
+                self.assertIsNone(ReplicaRouter().db_for_read(Streaming))
+            self.assertEqual(ReplicaRouter().db_for_read(Streaming), 'replica0')
+        finally:
+            read_database.reset(token)
+
+
+@override_settings(PASSWORD_HASHERS=['django.contrib.auth.hashers.MD5PasswordHasher'])
+class StreamingDetailCacheTest(StreamingFixtures, TestCase):
+    def setUp(self):
+        cache.clear()
+        self.streaming = self.create_streaming(self.create_user('Streamer'))
+        self.client = APIClient()
+        self.url = f'/api/streams/{self.streaming.code}/'
+
+    def test_etag_revalidation_and_invalidation(self):
+        etag = self.client.get(self.url)['ETag']
+        self.assertEqual(self.client.get(self.url, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.streaming.start()
+
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['status'], Streaming.LIVE)
+        self.assertNotEqual(response['ETag'], etag)
+
+
+class ReadThroughTest(TestCase):
+    def setUp(self):
+        cache.clear()
+
+    def test_waiter_that_times_out_leaves_the_loader_lock(self):
+        cache.add('key:lock', 1, 5)
+
+        self.assertEqual(read_through('key', lambda: 'value', 60, name='test', wait=0.1), 'value')
+        self.assertIsNotNone(cache.get('key:lock'))
+        self.assertIsNone(cache.get('key'))
+
+
+@override_settings(PASSWORD_HASHERS=['django.contrib.auth.hashers.MD5PasswordHasher'])
+class DonationExportTest(StreamingFixtures, TestCase):
+    def setUp(self):
+        streamer = self.create_user('Streamer')
+        self.streaming = self.create_streaming(streamer)
+        self.client = APIClient()
+        self.client.force_authenticate(streamer)
+
+    def export(self, accept_encoding):
+        url = f'/api/streams/{self.streaming.code}/donations/export/?format=csv'
+        return self.client.get(url, HTTP_ACCEPT_ENCODING=accept_encoding)
+
+    def test_gzip_follows_q_values(self):
+        self.assertEqual(self.export('gzip, br')['Content-Encoding'], 'gzip')
+        self.assertNotIn('Content-Encoding', self.export('gzip;q=0, br'))
+        self.assertNotIn('Content-Encoding', self.export('identity'))
+
+
+@override_settings(PASSWORD_HASHERS=['django.contrib.auth.hashers.MD5PasswordHasher'])
+class DonationTotalTest(StreamingFixtures, TestCase):
+    def setUp(self):
+        cache.clear()
+        self.streamer = self.create_user('Streamer')
+        self.donor = self.create_user('Donor')
+        self.streaming = self.create_streaming(self.streamer)
+
+    def donate(self, amount):
+        donation = Donation.create_manual_payment(self.streaming, self.donor, amount, ManualPayment('BCA', None))
+        Donation.review_many([donation.id], self.streamer, True)
+        return donation
+
+    def get_total(self):
+        return Streaming.objects.get(code=self.streaming.code).get_donation_total()
+
+    def test_success_is_counted_once(self):
+        donation = self.donate(1000)
+        self.donate(2500)
+        Donation.review_many([donation.id], self.streamer, True)
+        self.assertEqual(self.get_total(), 3500)
+
+    @override_settings(DONATION_TOTAL_SHARDS=4)
+    def test_shards_add_up_to_the_total(self):
+        self.streaming = self.create_streaming(self.streamer)
+        for shard in range(4):
+            with mock.patch('apps.streaming.models.random.randrange', return_value=shard):
+                self.donate(1000 * (shard + 1))
+        self.assertEqual(DonationTotalShard.objects.filter(streaming=self.streaming, total__gt=0).count(), 4)
+        self.assertEqual(self.get_total(), 10000)
+
+    @override_settings(DONATION_TOTAL_SHARDS=4)
+    def test_reconcile_rebuilds_totals_from_successful_donations(self):
+        self.streaming = self.create_streaming(self.streamer)
+        self.donate(1000)
+        self.donate(2000)
+        Donation.create_manual_payment(self.streaming, self.donor, 4000, ManualPayment('BCA', None))
+        # a counter that drifted from the ledger
+        Streaming.objects.filter(code=self.streaming.code).update(donation_total=99)
+        DonationTotalShard.objects.filter(streaming=self.streaming).update(total=7)
+
+        call_command('reconcile_donation_totals', stream=[self.streaming.code], stdout=StringIO())
+        self.assertEqual(self.get_total(), 3000)
+        self.assertFalse(DonationTotalShard.objects.filter(streaming=self.streaming).exclude(total=0).exists())
+
+
+@override_settings(PASSWORD_HASHERS=['django.contrib.auth.hashers.MD5PasswordHasher'])
+class LeaderboardTest(StreamingFixtures, TestCase):
+    def setUp(self):
+        cache.clear()
+        self.streamer = self.create_user('Streamer')
+        self.streaming = self.create_streaming(self.streamer)
+        self.donors = [self.create_user(f'Donor {index}') for index in range(3)]
+        for donor, amounts in zip(self.donors, ((1000, 500), (3000,), (1500,))):
+            for amount in amounts:
+                donation = Donation.create_manual_payment(self.streaming, donor, amount, ManualPayment('BCA', None))
+                Donation.review_many([donation.id], self.streamer, True)
+        # a donation waiting for confirmation is not on the board
+        Donation.create_manual_payment(self.streaming, self.donors[0], 9000, ManualPayment('BCA', None))
+        self.client = APIClient()
+
+    def get_leaderboard(self, limit=10):
+        response = self.client.get(f'/api/streams/{self.streaming.code}/leaderboard/?limit={limit}')
+        self.assertEqual(response.status_code, 200)
+        return [(donor['user']['id'], donor['total'], donor['donation_count']) for donor in response.data]
+
+    def test_ranks_donors_by_successful_total(self):
+        self.assertEqual(self.get_leaderboard(), [
+            (self.donors[1].id, 3000, 1),
+            (self.donors[0].id, 1500, 2),
+            (self.donors[2].id, 1500, 1),
+        ])
+        cache.clear()
+        self.assertEqual(len(self.get_leaderboard(limit=1)), 1)
+
+    def test_polls_are_served_from_the_cache(self):
+        self.get_leaderboard()
+        with self.assertNumQueries(0):
+            self.get_leaderboard()
+
+    def test_rebuild_matches_the_maintained_totals(self):
+        expected = self.get_leaderboard()
+        DonorTotal.objects.filter(streaming=self.streaming).update(total=1, donation_count=1)
+        call_command('rebuild_leaderboards', stream=[self.streaming.code], stdout=StringIO())
+        cache.clear()
+        self.assertEqual(self.get_leaderboard(), expected)
+
+
+@override_settings(PASSWORD_HASHERS=['django.contrib.auth.hashers.MD5PasswordHasher'])
+class StreamSchedulerTest(StreamingFixtures, TestCase):
+    def setUp(self):
+        self.streamer = self.create_user('Streamer')
+        now = timezone.now()
+        self.upcoming = self.create_scheduled(now + timedelta(hours=1), now + timedelta(hours=2))
+        self.due_to_start = self.create_scheduled(now - timedelta(minutes=1), now + timedelta(hours=1))
+        self.due_to_end = self.create_scheduled(now - timedelta(hours=2), now - timedelta(minutes=1), Streaming.LIVE)
+        self.missed = self.create_scheduled(now - timedelta(hours=2), now - timedelta(hours=1))
+
+    def create_scheduled(self, start, end, status=Streaming.PENDING):
+        streaming = self.create_streaming(self.streamer)
+        Streaming.objects.filter(code=streaming.code).update(date_start=start, date_end=end, status=status)
+        return streaming.code
+
+    def get_statuses(self):
+        return dict(Streaming.objects.values_list('code', 'status'))
+
+    def test_transitions_due_streams_and_publishes_each(self):
+        with mock.patch('apps.streaming.models.publish_on_commit') as publish:
+            call_command('run_stream_scheduler', once=True, batch_size=1, stdout=StringIO())
+        self.assertEqual(self.get_statuses(), {
+            self.upcoming: Streaming.PENDING,
+            self.due_to_start: Streaming.LIVE,
+            self.due_to_end: Streaming.ENDED,
+            # a stream whose whole window passed is ended, never started
+            self.missed: Streaming.ENDED,
+        })
+        events = sorted((call.args[0], call.args[1]) for call in publish.call_args_list)
+        self.assertEqual(events, sorted([
+            (Streaming.get_topic(self.due_to_start), 'streaming.started'),
+            (Streaming.get_topic(self.due_to_end), 'streaming.ended'),
+            (Streaming.get_topic(self.missed), 'streaming.ended'),
+        ]))
+
+    def test_a_tick_transitions_one_batch_in_one_update(self):
+        with CaptureQueriesContext(connection) as context:
+            ended = Streaming.end_due(timezone.now(), 1)
+        self.assertEqual(len(ended), 1)
+        updates = [query for query in context.captured_queries if query['sql'].startswith('UPDATE')]
+        self.assertEqual(len(updates), 1)
+        self.assertEqual(Streaming.objects.filter(status=Streaming.ENDED).count(), 1)
+
+
+@override_settings(PASSWORD_HASHERS=['django.contrib.auth.hashers.MD5PasswordHasher'], DONATION_TOTAL_SHARDS=4)
+class StreamSummaryTest(StreamingFixtures, TestCase):
+    def setUp(self):
+        cache.clear()
+        self.streamer = self.create_user('Streamer')
+        self.donor = self.create_user('Donor')
+        self.streams = [self.create_streaming(self.streamer) for _ in range(2)]
+        for amount in (1000, 2000):
+            self.confirm(self.donate(self.streams[0], amount))
+        self.donate(self.streams[0], 500)
+        self.donate(self.streams[1], 700)
+        for _ in range(3):
+            Comment.create('Hi', self.donor, self.streams[0])
+        # another streamer's stream is not summed
+        self.donate(self.create_streaming(self.donor), 900)
+        self.client = APIClient()
+        self.client.force_authenticate(self.streamer)
+
+    def donate(self, streaming, amount):
+        return Donation.create_manual_payment(streaming, self.donor, amount, ManualPayment('BCA', None))
+
+    def confirm(self, donation):
+        Donation.review_many([donation.id], self.streamer, True)
+
+    def get_summary(self):
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get('/api/streams/mine/summary/')
+        self.assertEqual(response.status_code, 200)
+        # the request's own transaction shows up as savepoints
+        return response.data, len([query for query in context.captured_queries if query['sql'].startswith('SELECT')])
+
+    def test_sums_every_stream_in_one_query(self):
+        data, queries = self.get_summary()
+        self.assertEqual(queries, 1)
+        figures = {
+            result['code']: (result['donation_total'], result['donation_count'], result['pending_count'], result['comment_count'])
+            for result in data['results']
+        }
+        self.assertEqual(figures, {self.streams[0].code: (3000, 2, 1, 3), self.streams[1].code: (0, 0, 1, 0)})
+        self.assertEqual(
+            data['totals'],
+            {'donation_total': 3000, 'donation_count': 2, 'pending_count': 2, 'comment_count': 3},
+        )
+
+    def test_cache_is_dropped_on_donation_and_comment_writes(self):
+        self.get_summary()
+        self.assertEqual(self.get_summary()[1], 0)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            donation = self.donate(self.streams[1], 100)
+        self.assertEqual(self.get_summary()[0]['totals']['pending_count'], 3)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.confirm(donation)
+        self.assertEqual(self.get_summary()[0]['totals']['donation_total'], 3100)
+        with self.captureOnCommitCallbacks(execute=True):
+            Comment.create('Hi', self.donor, self.streams[1])
+        self.assertEqual(self.get_summary()[0]['totals']['comment_count'], 4)
+
+
+@override_settings(PASSWORD_HASHERS=['django.contrib.auth.hashers.MD5PasswordHasher'], DONATION_TOTAL_SHARDS=4)
+class TrendingStreamListTest(StreamingFixtures, TestCase):
+    def setUp(self):
+        cache.clear()
+        streamer = self.create_user('Streamer')
+        self.streamings = []
+        for _ in range(6):
+            streaming = self.create_streaming(streamer)
+            streaming.start()
+            Streaming.add_donation(streaming.code, 5)
+            self.streamings.append(streaming)
+        StreamingRanking.store([streaming.code for streaming in self.streamings], {}, {})
+        self.client = APIClient()
+
+    def list_streams(self, page_size):
+        cache.clear()
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(f'/api/streams/?page_size={page_size}')
+        self.assertEqual(response.status_code, 200)
+        return response, len(context.captured_queries)
+
+    def test_lists_live_streams_without_a_query_per_stream(self):
+        self.streamings[0].stop()
+
+        response, queries = self.list_streams(10)
+        self.assertEqual(len(response.data['results']), 5)
+        self.assertNotIn(self.streamings[0].code, [result['code'] for result in response.data['results']])
+        self.assertEqual([result['donation_total'] for result in response.data['results']], [5.0] * 5)
+        self.assertEqual(queries, self.list_streams(1)[1])
+
+    def test_ranks_by_recent_donations_and_comments(self):
+        donor = self.create_user('Donor')
+        for _ in range(5):
+            Comment.create('Hi', donor, self.streamings[2])
+        donation = Donation.create_manual_payment(self.streamings[3], donor, 10000, ManualPayment('BCA', None))
+        Donation.review_many([donation.id], self.streamings[3].user, True)
+        self.streamings[5].stop()
+
+        call_command('compute_stream_rankings', once=True, stdout=StringIO())
+        codes = [result['code'] for result in self.list_streams(10)[0].data['results']]
+        self.assertEqual(codes[:2], [self.streamings[3].code, self.streamings[2].code])
+        self.assertNotIn(self.streamings[5].code, codes)
+        self.assertFalse(StreamingRanking.objects.filter(streaming=self.streamings[5]).exists())
+
+
+@override_settings(PASSWORD_HASHERS=['django.contrib.auth.hashers.MD5PasswordHasher'])
+class CommentWriteBehindTest(StreamingFixtures, TestCase):
+    def setUp(self):
+        self.user = self.create_user('Streamer')
+        self.streaming = self.create_streaming(self.user)
+
+    @override_settings(COMMENT_WRITE_BEHIND_DURABILITY='flushed', COMMENT_WRITE_BEHIND_TIMEOUT=0)
+    def test_timeout_is_backlogged_and_cancels_the_comment(self):
+        future = Future()
+        with mock.patch('apps.streaming.models.comment_writer.submit', return_value=future):
+            with self.assertRaises(IngestionBacklogged):
+                Comment.create_buffered('Hello', self.user, self.streaming)
+        self.assertTrue(future.cancelled())
+
+    def test_cancelled_rows_are_not_written(self):
+        writer = BatchWriter(Comment, name='test-comments', batch_size=10, interval=0, capacity=10)
+        comments = [Comment(id=index, comment='Hello', user=self.user, streaming=self.streaming) for index in (1, 2)]
+        with mock.patch.object(BatchWriter, 'start'):
+            futures = [writer.submit(comment) for comment in comments]
+        futures[0].cancel()
+        writer.stopping = True
+        with mock.patch.object(writer, 'insert') as insert:
+            writer.run()
+        insert.assert_called_once_with([comments[1]])
+        self.assertIs(futures[1].result(timeout=0), comments[1])
+
+
+@override_settings(PASSWORD_HASHERS=['django.contrib.auth.hashers.MD5PasswordHasher'])
+class CommentPollTest(StreamingFixtures, TestCase):
+    def setUp(self):
+        self.user = self.create_user('Streamer')
+        self.streaming = self.create_streaming(self.user)
+        self.client = APIClient()
+
+    def poll(self, since):
+        response = self.client.get(f'/api/comments/?stream={self.streaming.code}&since={since}')
+        self.assertEqual(response.status_code, 200)
+        return [comment['id'] for comment in response.data['results']], response.data['last_id']
+
+    def test_idle_polls_are_served_from_the_buffer(self):
+        first = Comment.create('First', self.user, self.streaming)
+        self.assertEqual(self.poll(0), ([first.id], first.id))
+
+        with self.captureOnCommitCallbacks(execute=True):
+            second = Comment.create('Second', self.user, self.streaming)
+        with CaptureQueriesContext(connection) as context:
+            self.assertEqual(self.poll(first.id), ([second.id], second.id))
+            self.assertEqual(self.poll(second.id), ([], second.id))
+        self.assertEqual(len(context.captured_queries), 0)
+
+    def test_invalid_since(self):
+        response = self.client.get(f'/api/comments/?stream={self.streaming.code}&since=abc')
+        self.assertEqual(response.status_code, 400)
+
+
+class CommentBufferTest(SimpleTestCase):
+    def create_buffer(self, size, *ids):
+        buffer = CommentBuffer(size)
+        buffer.load([{'id': id} for id in ids])
+        return buffer
+
+    def get_ids(self, comments):
+        return None if comments is None else [comment['id'] for comment in comments]
+
+    def test_comments_are_served_in_commit_order(self):
+        buffer = self.create_buffer(10, 1, 2)
+        # ids reserved in blocks commit out of order
+        buffer.add({'id': 5})
+        buffer.add({'id': 3})
+        self.assertEqual(self.get_ids(buffer.get_since(2, 10)), [5, 3])
+        self.assertEqual(self.get_ids(buffer.get_since(5, 10)), [3])
+        self.assertEqual(self.get_ids(buffer.get_since(3, 10)), [])
+
+    def test_loaded_comments_go_ahead_of_arrivals(self):
+        buffer = CommentBuffer(3)
+        buffer.add({'id': 9})
+        buffer.load([{'id': 6}, {'id': 7}, {'id': 8}, {'id': 9}])
+        self.assertEqual(self.get_ids(buffer.get_since(7, 10)), [8, 9])
+        self.assertIsNone(buffer.get_since(6, 10))
+
+    def test_evicted_cursors_are_not_held(self):
+        buffer = self.create_buffer(2, 1, 2)
+        buffer.add({'id': 3})
+        self.assertIsNone(buffer.get_since(1, 10))
+        self.assertEqual(self.get_ids(buffer.get_since(2, 10)), [3])
+
+    def test_wait_returns_as_soon_as_a_comment_arrives(self):
+        buffer = self.create_buffer(10, 1)
+        timer = threading.Timer(0.05, lambda: buffer.add({'id': 2}))
+        timer.start()
+        started = time.monotonic()
+        self.assertEqual(self.get_ids(buffer.wait(1, 10, 5)), [2])
+        self.assertLess(time.monotonic() - started, 1)
+        # a cursor the buffer does not hold gets what arrives after the wait started
+        timer = threading.Timer(0.05, lambda: buffer.add({'id': 4}))
+        timer.start()
+        self.assertEqual(self.get_ids(buffer.wait(3, 10, 5)), [4])
+
+
+
+# the shard databases are only configured by configs.settings_test
+TEST_SHARDS = [alias for alias in ('test_shard0', 'test_shard1') if alias in settings.DATABASES]
+
+
+@skipUnless(TEST_SHARDS, 'run with --settings=configs.settings_test')
+@override_settings(PASSWORD_HASHERS=['django.contrib.auth.hashers.MD5PasswordHasher'], DATABASE_SHARDS=TEST_SHARDS)
+class ShardingTest(StreamingFixtures, TestCase):
+    databases = {'default', *TEST_SHARDS}
+
+    @classmethod
+    def setUpClass(cls):
+        # shards only hold donations and comments, the tables are created before the test transactions open
+        for alias in TEST_SHARDS:
+            tables = connections[alias].introspection.table_names()
+            with connections[alias].schema_editor() as editor:
+                for model in (Donation, Comment):
+                    if model._meta.db_table not in tables:
+                        editor.create_model(model)
+        super().setUpClass()
+
+    def setUp(self):
+        cache.clear()
+        self.streamer = self.create_user('Streamer')
+        self.donor = self.create_user('Donor')
+        self.streams = [self.create_placed_streaming(database) for database in (*TEST_SHARDS, None)]
+
+    def create_placed_streaming(self, database):
+        streaming = self.create_streaming(self.streamer)
+        streaming.database = database
+        streaming.save(update_fields=('database',))
+        return streaming
+
+    def donate(self, streaming, amount=1000):
+        return Donation.create_manual_payment(streaming, self.donor, amount, ManualPayment('BCA', None))
+
+    def get_donations(self):
+        return [donation for alias in ('default', *TEST_SHARDS) for donation in Donation.objects.using(alias)]
+
+    def follow(self, client, url):
+        ids = []
+        while url:
+            response = client.get(url)
+            self.assertEqual(response.status_code, 200)
+            ids += [donation['id'] for donation in response.data['results']]
+            url = response.data['next']
+        return ids
+
+    def test_placement(self):
+        self.assertEqual(pick_shard('abcdef'), pick_shard('abcdef'))
+        self.assertEqual({pick_shard(f'code{index}') for index in range(100)}, set(TEST_SHARDS))
+
+        codes = [streaming.code for streaming in self.streams]
+        self.assertEqual(get_shards([*codes, 'unknown']), {**dict(zip(codes, (*TEST_SHARDS, 'default'))), 'unknown': 'default'})
+        # placements are cached, a moved stream is seen once its key is dropped
+        Streaming.objects.filter(code=codes[0]).update(database=TEST_SHARDS[1])
+        self.assertEqual(get_shard(codes[0]), TEST_SHARDS[0])
+        cache.clear()
+        self.assertEqual(get_shard(codes[0]), TEST_SHARDS[1])
+
+    def test_ids_are_unique_across_databases(self):
+        donations = [self.donate(streaming) for streaming in self.streams for _ in range(3)]
+        self.assertEqual(len({donation.id for donation in donations}), len(donations))
+        for streaming, alias in zip(self.streams, (*TEST_SHARDS, 'default')):
+            for other in ('default', *TEST_SHARDS):
+                count = Donation.objects.using(other).filter(streaming=streaming).count()
+                self.assertEqual(count, 3 if other == alias else 0)
+
+    def test_pages_are_merged_in_order(self):
+        for index in range(7):
+            self.donate(self.streams[index % 3])
+        donations = self.get_donations()
+
+        client = APIClient()
+        client.force_authenticate(self.donor)
+        ids = self.follow(client, '/api/donations/mine/?page_size=2')
+        expected = sorted(donations, key=lambda donation: (donation.date_created, donation.id), reverse=True)
+        self.assertEqual(ids, [donation.id for donation in expected])
+
+        client.force_authenticate(self.streamer)
+        ids = self.follow(client, '/api/donations/pending/?page_size=2')
+        self.assertEqual(ids, [donation.id for donation in reversed(expected)])
+
+    def test_review_many_across_databases(self):
+        donations = [self.donate(streaming) for streaming in self.streams]
+        other = self.donate(self.create_streaming(self.donor))
+        ids = [donation.id for donation in donations] + [other.id, 0]
+
+        results = Donation.review_many(ids, self.streamer, True)
+        self.assertEqual(results, {**{donation.id: 'confirmed' for donation in donations}, other.id: 'not_found', 0: 'not_found'})
+        self.assertEqual(Donation.review_many(ids[:1], self.streamer, True), {ids[0]: 'not_needed'})
+        for donation in donations:
+            self.assertEqual(Donation.objects.for_stream(donation.streaming_id).get(id=donation.id).status, Donation.SUCCESS_STATUS)
+        self.assertEqual(PendingConfirmationCount.get_count(self.streamer.id), 0)
+        self.assertEqual(Streaming.objects.get(code=self.streams[0].code).donation_total, 1000)
+
+    def test_aggregate_by_stream(self):
+        for index, streaming in enumerate(self.streams):
+            self.donate(streaming, 1000 * (index + 1))
+            self.donate(streaming, 500)
+        codes = [streaming.code for streaming in self.streams]
+        self.assertEqual(
+            Donation.objects.aggregate_by_stream(codes, Sum('amount')),
+            {codes[0]: 1500, codes[1]: 2500, codes[2]: 3500},
+        )
+
+    def move(self, streaming, target):
+        call_command('move_stream', streaming.code, target, settle=0, stdout=StringIO())
+
+    def test_move_stream_keeps_writes_made_while_moving(self):
+        streaming = self.streams[0]
+        confirmed, changed = self.donate(streaming), self.donate(streaming)
+        Comment.create('Hello', self.donor, streaming)
+
+        def write_while_settling(seconds):
+            # the placement switched, reviews reach the target while stale processes still write to the source
+            Donation.review_many([confirmed.id], self.streamer, True)
+            Donation.objects.using(TEST_SHARDS[0]).filter(id=changed.id).update(bank_name='Changed', date_updated=timezone.now())
+            Comment(comment='Late', user=self.donor, streaming=streaming).save(using=TEST_SHARDS[0])
+
+        with mock.patch('apps.streaming.management.commands.move_stream.time.sleep', side_effect=write_while_settling):
+            self.move(streaming, TEST_SHARDS[1])
+
+        self.assertEqual(get_shard(streaming.code), TEST_SHARDS[1])
+        donations = Donation.objects.using(TEST_SHARDS[1]).filter(streaming=streaming).in_bulk()
+        self.assertEqual(donations[confirmed.id].status, Donation.SUCCESS_STATUS)
+        self.assertEqual(donations[changed.id].bank_name, 'Changed')
+        self.assertEqual(
+            sorted(Comment.objects.for_stream(streaming.code).values_list('comment', flat=True)),
+            ['Hello', 'Late'],
+        )
+        self.assertFalse(Donation.objects.using(TEST_SHARDS[0]).filter(streaming=streaming).exists())
+        self.assertFalse(Comment.objects.using(TEST_SHARDS[0]).filter(streaming=streaming).exists())
+        self.assertEqual(Streaming.objects.get(code=streaming.code).donation_total, 1000)
+
+    def test_move_stream_copies_rows_changed_while_clearing(self):
+        streaming = self.streams[2]
+        donation = self.donate(streaming)
+        sync = MoveStreamCommand.sync
+        calls = []
+
+        def sync_then_write(command, model, rows, target):
+            sync(command, model, rows, target)
+            calls.append(model)
+            # the second donation batch is the first pass that clears the source
+            if calls.count(Donation) == 2:
+                Donation.objects.using('default').filter(id=donation.id).update(bank_name='Late', date_updated=timezone.now())
+
+        with mock.patch.object(MoveStreamCommand, 'sync', sync_then_write):
+            self.move(streaming, TEST_SHARDS[0])
+
+        self.assertEqual(calls.count(Donation), 3)
+        self.assertEqual(Donation.objects.for_stream(streaming.code).get(id=donation.id).bank_name, 'Late')
+        self.assertFalse(Donation.objects.using('default').filter(streaming=streaming).exists())
+
+
+class LocalBrokerTest(SimpleTestCase):
+    def test_history_follows_arrival_order(self):
+        broker = LocalBroker()
+        # another process's clock is behind, its event has the lower id but arrives last
+        for id in ('200-a', '300-a', '100-b'):
+            broker.dispatch(Event(id, 'topic', 'donation.succeeded', {}))
+        self.assertEqual([event.id for event in broker.get_history('topic', '200-a')], ['300-a', '100-b'])
+        self.assertIsNone(broker.get_history('topic', 'unknown'))
+
+    def test_idle_topics_are_evicted(self):
+        broker = LocalBroker(history_topics=2)
+        unsubscribe = broker.subscribe('watched', lambda event: None)
+        for topic in ('watched', 'idle', 'recent'):
+            broker.dispatch(Event(f'1-{topic}', topic, 'donation.succeeded', {}))
+        self.assertEqual(broker.get_history('watched', '1-watched'), [])
+        self.assertIsNone(broker.get_history('idle', '1-idle'))
+        self.assertEqual(broker.get_history('recent', '1-recent'), [])
+        unsubscribe()
+
+
+@override_settings(PASSWORD_HASHERS=['django.contrib.auth.hashers.MD5PasswordHasher'], SSE_HEARTBEAT=1)
+class DonationEventsTest(StreamingFixtures, TestCase):
+    def setUp(self):
+        self.streaming = self.create_streaming(self.create_user('Streamer'))
+        self.topic = Streaming.get_topic(self.streaming.code)
+        self.broker = LocalBroker()
+        patcher = mock.patch('apps.streaming.api.views.get_broker', return_value=self.broker)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    async def connect(self, last_event_id=None):
+        headers = {'HTTP_LAST_EVENT_ID': last_event_id} if last_event_id else {}
+        request = APIRequestFactory().get(f'/api/streams/{self.streaming.code}/donations/events', **headers)
+        response = await donation_events_view(request, self.streaming.code)
+        events = aiter(response.streaming_content)
+        self.assertEqual(await anext(events), f'retry: {settings.SSE_RETRY_MS}\n\n'.encode())
+        return events
+
+    def publish(self, id):
+        event = Event(id, self.topic, 'donation.succeeded', {'id': id})
+        self.broker.dispatch(event)
+        return event
+
+    async def test_replays_after_last_event_id_and_skips_duplicates(self):
+        self.publish('200-a')
+        replayed = self.publish('300-a')
+        events = await self.connect('200-a')
+        self.assertIn(b'id: 300-a', await anext(events))
+
+        # a repeat of a replayed event is skipped, a lower id from another process is not
+        self.broker.dispatch(replayed)
+        self.publish('100-b')
+        self.assertIn(b'id: 100-b', await anext(events))
+        await events.aclose()
+
+    async def test_unknown_last_event_id_asks_for_a_resync(self):
+        events = await self.connect('gone')
+        self.assertEqual(await anext(events), b'event: resync\ndata: {}\n\n')
+        await events.aclose()
+
+    @override_settings(SSE_QUEUE_SIZE=1)
+    async def test_overflow_ends_the_stream(self):
+        events = await self.connect()
+        self.publish('1-a')
+        self.publish('2-a')
+        with self.assertRaises(StopAsyncIteration):
+            await anext(events)
@@ -0,0 +1,11 @@
+from rest_framework.routers import DefaultRouter
+
+from apps.utils.api import views
+
+
+urlpatterns = []
+
+router = DefaultRouter()
+router.register('metrics', views.metrics_view, basename='metrics')
+
+urlpatterns += router.urls
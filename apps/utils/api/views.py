@@ -0,0 +1,15 @@
+from rest_framework import permissions
+from rest_framework.response import Response
+from rest_framework.viewsets import GenericViewSet
+
+from apps.utils.metrics import metrics
+
+
+class MetricsView(GenericViewSet):
+    permission_classes = (permissions.IsAdminUser,)
+
+    def list(self, request):
+        return Response(metrics.snapshot())
+
+
+metrics_view = MetricsView
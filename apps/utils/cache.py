@@ -0,0 +1,40 @@
+import time
+from django.core.cache import cache
+from django.db import transaction
+
+from apps.utils.metrics import metrics
+
+
+def read_through(key, load, timeout, name, lock_timeout=5, wait=2):
+    value = cache.get(key)
+    if value is not None:
+        metrics.incr(f'{name}.hit')
+        return value
+    metrics.incr(f'{name}.miss')
+
+    # only the request holding the lock loads, the others wait for its value
+    lock_key = f'{key}:lock'
+    if not cache.add(lock_key, 1, lock_timeout):
+        deadline = time.monotonic() + wait
+        while time.monotonic() < deadline:
+            time.sleep(0.05)
+            value = cache.get(key)
+            if value is not None:
+                metrics.incr(f'{name}.coalesced')
+                return value
+
+        # the loader is still busy, this request loads for itself and leaves the lock and the cache to it
+        metrics.incr(f'{name}.wait_timeout')
+        return load()
+
+    try:
+        value = load()
+        cache.set(key, value, timeout)
+    finally:
+        cache.delete(lock_key)
+    return value
+
+
+def delete_on_commit(*keys):
+    # deleting before the commit would let a concurrent miss cache the old row again
+    transaction.on_commit(lambda: cache.delete_many(keys))
@@ -0,0 +1,80 @@
+import random
+from contextlib import contextmanager
+from contextvars import ContextVar
+from django.conf import settings
+from django.core.cache import cache
+from django.db import DEFAULT_DB_ALIAS, transaction
+
+read_database = ContextVar('read_database', default=None)
+
+
+class ReplicaRouter:
+    def db_for_read(self, model, **hints):
+        return read_database.get()
+
+    def db_for_write(self, model, **hints):
+        # objects read from a replica must still be saved to the primary
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        return db == DEFAULT_DB_ALIAS
+
+
+@contextmanager
+def read_from_primary():
+    # values cached until an on-commit invalidation must not be refilled from a replica that lags behind it
+    token = read_database.set(None)
+    try:
+        yield
+    finally:
+        read_database.reset(token)
+
+
+def get_pin_key(user):
+    return f'db:pinned:{user.pk}'
+
+
+def pin_primary(user):
+    if user.is_authenticated:
+        cache.set(get_pin_key(user), 1, settings.REPLICA_PIN_SECONDS)
+
+
+def is_pinned(user):
+    return user.is_authenticated and cache.get(get_pin_key(user)) is not None
+
+
+class ReplicaReadMixin:
+    # read actions run without a transaction and, when replicas are configured, on one of them.
+    # every other action gets the transaction ATOMIC_REQUESTS would have opened.
+    replica_actions = ('list', 'retrieve')
+    non_atomic_actions = ()
+
+    @classmethod
+    def as_view(cls, *args, **kwargs):
+        return transaction.non_atomic_requests(super().as_view(*args, **kwargs))
+
+    def dispatch(self, request, *args, **kwargs):
+        action = self.action_map.get(request.method.lower())
+        self.read_database_token = None
+        try:
+            if action in self.replica_actions or action in self.non_atomic_actions:
+                response = super().dispatch(request, *args, **kwargs)
+            else:
+                with transaction.atomic():
+                    response = super().dispatch(request, *args, **kwargs)
+        finally:
+            if self.read_database_token is not None:
+                read_database.reset(self.read_database_token)
+
+        if action not in self.replica_actions and request.method not in ('GET', 'HEAD', 'OPTIONS') and response.status_code < 400:
+            pin_primary(self.request.user)
+        return response
+
+    def initial(self, request, *args, **kwargs):
+        super().initial(request, *args, **kwargs)
+        # the user is known once authentication ran, their own writes are read back from the primary
+        if self.action in self.replica_actions and settings.DATABASE_REPLICAS and not is_pinned(request.user):
+            self.read_database_token = read_database.set(random.choice(settings.DATABASE_REPLICAS))
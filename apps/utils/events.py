@@ -0,0 +1,167 @@
+import json
+import logging
+import select
+import threading
+import time
+import uuid
+from collections import OrderedDict, defaultdict, deque
+from django.conf import settings
+from django.db import connection, transaction
+from django.utils.module_loading import import_string
+
+from apps.utils.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class Event:
+    def __init__(self, id, topic, type, data):
+        self.id = id
+        self.topic = topic
+        self.type = type
+        self.data = data
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'topic': self.topic,
+            'type': self.type,
+            'data': self.data,
+        }
+
+
+class LocalBroker:
+    def __init__(self, history_size=256, history_topics=None):
+        self._lock = threading.Lock()
+        self._subscribers = defaultdict(set)
+        # recent events of the most recently active topics, for Last-Event-ID replay
+        self._history = OrderedDict()
+        self.history_size = history_size
+        self.history_topics = history_topics or settings.EVENT_HISTORY_TOPICS
+        self._node = uuid.uuid4().hex[:8]
+        self._last_id = 0
+
+    def next_id(self):
+        # ids are unique across processes, not ordered: another process's clock can be behind this one's
+        with self._lock:
+            self._last_id = max(self._last_id + 1, time.time_ns() // 1000)
+            return f'{self._last_id}-{self._node}'
+
+    def publish(self, topic, type, data):
+        self.dispatch(Event(self.next_id(), topic, type, data))
+
+    def dispatch(self, event):
+        with self._lock:
+            history = self._history.get(event.topic)
+            if history is None:
+                history = self._history[event.topic] = deque(maxlen=self.history_size)
+            history.append(event)
+            self._history.move_to_end(event.topic)
+            self.evict_history()
+            subscribers = list(self._subscribers.get(event.topic, ()))
+
+        for callback in subscribers:
+            try:
+                callback(event)
+            except Exception:
+                logger.exception('Event subscriber failed for %s', event.topic)
+
+    def subscribe(self, topic, callback):
+        with self._lock:
+            self._subscribers[topic].add(callback)
+
+        def unsubscribe():
+            with self._lock:
+                subscribers = self._subscribers.get(topic)
+                if subscribers is not None:
+                    subscribers.discard(callback)
+                    if not subscribers:
+                        del self._subscribers[topic]
+
+        return unsubscribe
+
+    def evict_history(self):
+        # the least recently active topics nobody listens to are forgotten first
+        excess = len(self._history) - self.history_topics
+        if excess > 0:
+            for topic in [topic for topic in self._history if topic not in self._subscribers][:excess]:
+                del self._history[topic]
+
+    def get_history(self, topic, after_id):
+        # events after after_id in the order they were received, None once after_id is no longer held
+        with self._lock:
+            events = list(self._history.get(topic, ()))
+        for index, event in enumerate(events):
+            if event.id == after_id:
+                return events[index + 1:]
+        return None
+
+
+class PostgresBroker(LocalBroker):
+    channel = 'streaming_events'
+
+    def __init__(self, history_size=256):
+        super().__init__(history_size)
+        self._listener = None
+
+    def publish(self, topic, type, data):
+        event = Event(self.next_id(), topic, type, data)
+        payload = json.dumps(event.to_dict(), default=str)
+        try:
+            with transaction.atomic(), connection.cursor() as cursor:
+                cursor.execute('SELECT pg_notify(%s, %s)', [self.channel, payload])
+        except Exception:
+            # payloads over 8000 bytes are refused. Events are published after the write committed, so this
+            # process's subscribers still get the event instead of the request failing.
+            logger.exception('Failed to notify %s event on %s', type, topic)
+            metrics.incr('events.notify_failed')
+            self.dispatch(event)
+
+    def subscribe(self, topic, callback):
+        self.start_listener()
+        return super().subscribe(topic, callback)
+
+    def start_listener(self):
+        with self._lock:
+            if self._listener is not None:
+                return
+            self._listener = threading.Thread(target=self.listen, name='event-listener', daemon=True)
+        self._listener.start()
+
+    def listen(self):
+        import psycopg2
+
+        while True:
+            try:
+                listener = psycopg2.connect(**connection.get_connection_params())
+                listener.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+                with listener.cursor() as cursor:
+                    cursor.execute(f'LISTEN {self.channel}')
+
+                while True:
+                    if select.select([listener], [], [], 5) == ([], [], []):
+                        continue
+                    listener.poll()
+                    while listener.notifies:
+                        event = json.loads(listener.notifies.pop(0).payload)
+                        self.dispatch(Event(**event))
+            except Exception:
+                logger.exception('Event listener lost its connection, reconnecting')
+                time.sleep(1)
+
+
+_broker = None
+_broker_lock = threading.Lock()
+
+
+def get_broker():
+    global _broker
+    if _broker is None:
+        with _broker_lock:
+            if _broker is None:
+                _broker = import_string(settings.EVENT_BROKER)()
+    return _broker
+
+
+def publish_on_commit(topic, type, data):
+    transaction.on_commit(lambda: get_broker().publish(topic, type, data))
@@ -0,0 +1,85 @@
+import csv
+import io
+import zlib
+from django.core.serializers.json import DjangoJSONEncoder
+from rest_framework.renderers import BaseRenderer
+
+CHUNK_SIZE = 64 * 1024
+
+
+class CSVRenderer(BaseRenderer):
+    # exports stream their own body, the renderers let DRF accept ?format= and render errors
+    media_type = 'text/csv'
+    format = 'csv'
+    charset = 'utf-8'
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        return ''.join(iter_csv(('error',), [(DjangoJSONEncoder().encode(data),)])).encode()
+
+
+class NDJSONRenderer(BaseRenderer):
+    media_type = 'application/x-ndjson'
+    format = 'ndjson'
+    charset = 'utf-8'
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        return (DjangoJSONEncoder().encode(data) + '\n').encode()
+
+
+def iter_csv(header, rows):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(header)
+    yield take(buffer)
+
+    for row in rows:
+        writer.writerow(row)
+        if buffer.tell() >= CHUNK_SIZE:
+            yield take(buffer)
+    yield take(buffer)
+
+
+def iter_ndjson(fields, rows):
+    encoder = DjangoJSONEncoder()
+    buffer = io.StringIO()
+    for row in rows:
+        buffer.write(encoder.encode(dict(zip(fields, row))))
+        buffer.write('\n')
+        if buffer.tell() >= CHUNK_SIZE:
+            yield take(buffer)
+    yield take(buffer)
+
+
+def accepts_gzip(accept_encoding):
+    # an explicit gzip entry wins over *, either one only counts with a non-zero q-value
+    qualities = {}
+    for entry in accept_encoding.split(','):
+        coding, _, params = entry.strip().partition(';')
+        quality = 1.0
+        for param in params.split(';'):
+            name, _, value = param.strip().partition('=')
+            if name.lower() == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        qualities[coding.strip().lower()] = quality
+    quality = qualities.get('gzip', qualities.get('x-gzip', qualities.get('*', 0.0)))
+    return quality > 0
+
+
+def iter_gzip(chunks):
+    # wbits 16 + MAX_WBITS writes a gzip header and trailer around the deflate stream
+    compressor = zlib.compressobj(wbits=16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        data = compressor.compress(chunk.encode())
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def take(buffer):
+    value = buffer.getvalue()
+    buffer.seek(0)
+    buffer.truncate()
+    return value
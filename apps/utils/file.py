@@ -1,7 +1,12 @@
 import base64
+import hashlib
 import secrets
 import mimetypes
 from django.core.files.base import ContentFile
+from django.core.files.uploadedfile import TemporaryUploadedFile
+from django.core.files.uploadhandler import FileUploadHandler, StopUpload
+
+SNIFF_LENGTH = 16
 
 
 def get_content_file_from_base64(data: str):
@@ -18,3 +23,72 @@ def get_content_file_from_base64(data: str):
     filename = secrets.token_hex(16) + extension
     content_file = ContentFile(base64.b64decode(base64_data.encode()), name=filename)
     return content_file
+
+
+def sniff_content_type(head: bytes):
+    if head.startswith(b'\xff\xd8\xff'):
+        return 'image/jpeg'
+    if head.startswith(b'\x89PNG\r\n\x1a\n'):
+        return 'image/png'
+    if head.startswith((b'GIF87a', b'GIF89a')):
+        return 'image/gif'
+    if head[:4] == b'RIFF' and head[8:12] == b'WEBP':
+        return 'image/webp'
+    return None
+
+
+class FileTooLarge(Exception):
+    pass
+
+
+class StreamingFileWriter:
+    def __init__(self, max_size, name='upload', charset=None):
+        self.max_size = max_size
+        self.size = 0
+        self.head = b''
+        self.hash = hashlib.sha256()
+        self.file = TemporaryUploadedFile(name, 'application/octet-stream', 0, charset)
+
+    def write(self, chunk: bytes):
+        self.size += len(chunk)
+        if self.size > self.max_size:
+            self.file.close()
+            raise FileTooLarge()
+
+        if len(self.head) < SNIFF_LENGTH:
+            self.head += chunk[:SNIFF_LENGTH - len(self.head)]
+        self.hash.update(chunk)
+        self.file.write(chunk)
+
+    def complete(self):
+        content_type = sniff_content_type(self.head)
+        extension = mimetypes.guess_extension(content_type) if content_type else ''
+
+        self.file.seek(0)
+        self.file.size = self.size
+        self.file.name = secrets.token_hex(16) + (extension or '')
+        self.file.content_type = content_type
+        self.file.sha256 = self.hash.hexdigest()
+        return self.file
+
+
+class StreamingUploadHandler(FileUploadHandler):
+    def __init__(self, request=None, max_size=None):
+        super().__init__(request)
+        self.max_size = max_size
+        self.too_large = False
+        self.writer = None
+
+    def new_file(self, *args, **kwargs):
+        super().new_file(*args, **kwargs)
+        self.writer = StreamingFileWriter(self.max_size, self.file_name, self.charset)
+
+    def receive_data_chunk(self, raw_data, start):
+        try:
+            self.writer.write(raw_data)
+        except FileTooLarge:
+            self.too_large = True
+            raise StopUpload(connection_reset=True)
+
+    def file_complete(self, file_size):
+        return self.writer.complete()
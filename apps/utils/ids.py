@@ -0,0 +1,56 @@
+import threading
+from collections import deque
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, connections, router
+from django.db.models import Max
+
+
+class IdAllocator:
+    def __init__(self, model, block_size):
+        self.model = model
+        self.block_size = block_size
+        self.ids = deque()
+        self.last_id = None
+        self.lock = threading.Lock()
+
+    def allocate(self):
+        with self.lock:
+            if not self.ids:
+                self.ids.extend(self.fetch_block())
+            return self.ids.popleft()
+
+    def fetch_block(self):
+        table = self.model._meta.db_table
+        connection = connections[DEFAULT_DB_ALIAS]
+        if connection.vendor == 'postgresql':
+            # one round-trip reserves a whole block from the table's own sequence
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    "SELECT nextval(pg_get_serial_sequence(%s, 'id')) FROM generate_series(1, %s)",
+                    [table, self.block_size],
+                )
+                return [row[0] for row in cursor.fetchall()]
+
+        # without sequences ids are handed out after the current maximum of every database holding the table,
+        # which is only safe in a single process, write-behind refuses to start there
+        if self.last_id is None:
+            self.last_id = max(
+                self.model._base_manager.using(alias).aggregate(last_id=Max('id'))['last_id'] or 0
+                for alias in connections
+                if router.allow_migrate_model(alias, self.model)
+            )
+        block = range(self.last_id + 1, self.last_id + self.block_size + 1)
+        self.last_id = block[-1]
+        return block
+
+
+id_allocators = {}
+id_allocators_lock = threading.Lock()
+
+
+def get_id_allocator(model, block_size=None):
+    # allocators of the same model would both count from the same maximum, so there is one per model
+    with id_allocators_lock:
+        if model not in id_allocators:
+            id_allocators[model] = IdAllocator(model, block_size or settings.SHARD_ID_BLOCK_SIZE)
+        return id_allocators[model]
@@ -0,0 +1,26 @@
+import io
+import secrets
+from django.core.files.base import ContentFile
+from PIL import Image, ImageOps
+
+EXTENSIONS = {
+    'WEBP': '.webp',
+    'JPEG': '.jpg',
+}
+
+
+def render_image_variants(file, sizes, format='WEBP', quality=80):
+    # sizes are bounding boxes, largest first; metadata is dropped because nothing is copied across on save
+    with Image.open(file) as image:
+        image.draft('RGB', (sizes[0], sizes[0]))
+        image = ImageOps.exif_transpose(image)
+        if image.mode not in ('RGB', 'RGBA') or format == 'JPEG':
+            image = image.convert('RGB')
+
+        variants = []
+        for size in sizes:
+            image.thumbnail((size, size))
+            output = io.BytesIO()
+            image.save(output, format=format, quality=quality)
+            variants.append(ContentFile(output.getvalue(), name=secrets.token_hex(16) + EXTENSIONS[format]))
+        return variants
@@ -1,7 +1,138 @@
-from rest_framework.pagination import PageNumberPagination
+import base64
+import json
+from django.core.exceptions import ValidationError as DjangoValidationError
+from django.db.models import Q
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination, PageNumberPagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param
+
+
+def get_shard_querysets(queryset):
+    if hasattr(queryset, 'get_shard_querysets'):
+        return queryset.get_shard_querysets()
+    return [queryset]
 
 
 class Pagination(PageNumberPagination):
     page_size = 10
     page_size_query_param = 'page_size'
     page_query_param = 'page'
+
+
+class KeysetPagination(BasePagination):
+    page_size = 10
+    max_page_size = 100
+    page_size_query_param = 'page_size'
+    cursor_query_param = 'cursor'
+    ordering = ('-date_created', '-id')
+    invalid_cursor_message = 'Invalid cursor'
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        self.page_size = self.get_page_size(request)
+        self.ordering = getattr(view, 'keyset_ordering', self.ordering)
+        self.model = queryset.model
+
+        queryset = queryset.order_by(*self.ordering)
+        position = self.decode_cursor(request)
+        if position is not None:
+            queryset = queryset.filter(self.get_position_filter(position))
+
+        # one extra row tells whether there is a next page without counting
+        results = self.fetch(queryset, self.page_size + 1)
+        self.page = results[:self.page_size]
+        self.next_position = None
+        if len(results) > self.page_size:
+            self.next_position = [self.get_value(self.page[-1], field.lstrip('-')) for field in self.ordering]
+        return self.page
+
+    def fetch(self, queryset, limit):
+        querysets = get_shard_querysets(queryset)
+        if len(querysets) == 1:
+            return list(queryset[:limit])
+
+        # the page is the head of every database's own page, merged in the same order
+        results = [obj for queryset in querysets for obj in queryset[:limit]]
+        for field in reversed(self.ordering):
+            results.sort(key=lambda obj: self.get_value(obj, field.lstrip('-')), reverse=field.startswith('-'))
+        return results[:limit]
+
+    def get_paginated_response(self, data):
+        return Response({
+            'next': self.get_next_link(),
+            'results': data,
+        })
+
+    def get_page_size(self, request):
+        try:
+            page_size = int(request.query_params[self.page_size_query_param])
+        except (KeyError, ValueError):
+            return self.page_size
+        if page_size <= 0:
+            return self.page_size
+        return min(page_size, self.max_page_size)
+
+    def get_next_link(self):
+        if self.next_position is None:
+            return None
+        url = self.request.build_absolute_uri()
+        return replace_query_param(url, self.cursor_query_param, self.encode_cursor(self.next_position))
+
+    def get_position_filter(self, position):
+        # (a, b) after (x, y) is: a after x, or a = x and b after y
+        position_filter = Q()
+        for index, field in enumerate(self.ordering):
+            lookup = 'lt' if field.startswith('-') else 'gt'
+            condition = Q(**{f'{field.lstrip("-")}__{lookup}': position[index]})
+            for previous_field, value in zip(self.ordering[:index], position[:index]):
+                condition &= Q(**{previous_field.lstrip('-'): value})
+            position_filter |= condition
+        return position_filter
+
+    def get_value(self, obj, path):
+        for name in path.split('__'):
+            obj = getattr(obj, name)
+        return obj
+
+    def get_field(self, path):
+        model = self.model
+        names = path.split('__')
+        for name in names[:-1]:
+            model = model._meta.get_field(name).related_model
+        return model._meta.get_field(names[-1])
+
+    def encode_cursor(self, position):
+        values = [value.isoformat() if hasattr(value, 'isoformat') else value for value in position]
+        return base64.urlsafe_b64encode(json.dumps(values).encode()).decode()
+
+    def decode_cursor(self, request):
+        cursor = request.query_params.get(self.cursor_query_param)
+        if not cursor:
+            return None
+
+        try:
+            values = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+            if len(values) != len(self.ordering):
+                raise ValueError()
+            return [
+                self.get_field(field.lstrip('-')).to_python(value)
+                for field, value in zip(self.ordering, values)
+            ]
+        except (TypeError, ValueError, DjangoValidationError):
+            raise NotFound(self.invalid_cursor_message)
+
+
+class FeedPagination(BasePagination):
+    # keyset pagination is opted into with ?cursor= so existing page-number clients keep working
+
+    def paginate_queryset(self, queryset, request, view=None):
+        # pages spread over several databases cannot be numbered
+        if KeysetPagination.cursor_query_param in request.query_params or len(get_shard_querysets(queryset)) > 1:
+            self.paginator = KeysetPagination()
+        else:
+            self.paginator = Pagination()
+        return self.paginator.paginate_queryset(queryset, request, view)
+
+    def get_paginated_response(self, data):
+        return self.paginator.get_paginated_response(data)
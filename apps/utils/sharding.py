@@ -0,0 +1,167 @@
+import zlib
+from collections import defaultdict
+from contextlib import ExitStack, contextmanager
+from django.conf import settings
+from django.core.cache import cache
+from django.db import DEFAULT_DB_ALIAS, models, transaction
+
+from apps.utils.db import read_database
+from apps.utils.ids import get_id_allocator
+
+# donations and comments are read per stream or per user, so they are the rows spread over DATABASE_SHARDS.
+# users, streams and every counter derived from them stay on the primary.
+SHARDED_MODELS = {'donation.donation', 'streaming.comment'}
+
+
+def is_sharded(model):
+    return model._meta.label_lower in SHARDED_MODELS
+
+
+def get_databases():
+    # streams created before sharding was enabled keep their rows on the primary until they are moved
+    return [DEFAULT_DB_ALIAS, *settings.DATABASE_SHARDS]
+
+
+def pick_shard(code):
+    # crc32 is stable across processes, unlike hash()
+    shards = settings.DATABASE_SHARDS
+    return shards[zlib.crc32(code.encode()) % len(shards)]
+
+
+def get_placement_key(code):
+    return f'shard:{code}'
+
+
+def get_shards(codes):
+    if not settings.DATABASE_SHARDS:
+        return dict.fromkeys(codes)
+    from apps.streaming.models import Streaming
+
+    keys = {code: get_placement_key(code) for code in codes}
+    cached = cache.get_many(keys.values())
+    shards = {code: cached[key] for code, key in keys.items() if key in cached}
+    missing = [code for code in keys if code not in shards]
+    if missing:
+        placements = {
+            code: database or DEFAULT_DB_ALIAS
+            for code, database in Streaming.objects.using(DEFAULT_DB_ALIAS).filter(code__in=missing).values_list('code', 'database')
+        }
+        # unknown codes are not cached, the stream may be created right after
+        cache.set_many({keys[code]: database for code, database in placements.items()}, settings.SHARD_PLACEMENT_CACHE_TTL)
+        shards.update({code: placements.get(code, DEFAULT_DB_ALIAS) for code in missing})
+    return shards
+
+
+def get_shard(code):
+    return get_shards([code])[code]
+
+
+@contextmanager
+def atomic_across(*using):
+    # one transaction per database, the last one listed commits first. This is not atomic across databases,
+    # callers list the database whose commit must not be lost last.
+    with ExitStack() as stack:
+        for alias in dict.fromkeys(using):
+            stack.enter_context(transaction.atomic(using=alias))
+        yield
+
+
+class ShardRouter:
+    def db_for_read(self, model, **hints):
+        return self.get_database(model, hints.get('instance'), read_database.get())
+
+    def db_for_write(self, model, **hints):
+        return self.get_database(model, hints.get('instance'), None)
+
+    def get_database(self, model, instance, replica):
+        if not settings.DATABASE_SHARDS or instance is None:
+            return None
+        if is_sharded(model):
+            if instance._meta.label_lower == 'streaming.streaming':
+                code = instance.pk
+            else:
+                code = getattr(instance, 'streaming_id', None)
+            return get_shard(code) if code is not None else None
+        if is_sharded(type(instance)):
+            # the user or stream of a sharded row is on the primary, not on the row's database
+            return replica or DEFAULT_DB_ALIAS
+        return None
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        if db not in settings.DATABASE_SHARDS:
+            return None
+        return model_name is not None and f'{app_label}.{model_name}' in SHARDED_MODELS
+
+
+class ShardedQuerySet(models.QuerySet):
+    def for_stream(self, code):
+        return self.using(get_shard(code)).filter(streaming=code)
+
+    def for_streams(self, codes):
+        # one queryset per database holding some of the streams, each covering only its own streams
+        if not settings.DATABASE_SHARDS:
+            return [self.filter(streaming__in=codes)]
+        groups = defaultdict(list)
+        for code, database in get_shards(codes).items():
+            groups[database].append(code)
+        return [self.using(database).filter(streaming__in=group) for database, group in groups.items()]
+
+    def in_streams(self, streams):
+        # a subquery while everything is on one database, the codes themselves once it is not
+        if settings.DATABASE_SHARDS:
+            streams = list(streams.values_list('code', flat=True))
+        return self.filter(streaming__in=streams)
+
+    def get_shard_querysets(self):
+        # a queryset not pinned to a database reads from every database holding sharded rows
+        if self._db is not None or not settings.DATABASE_SHARDS:
+            return [self]
+        return [self.using(database) for database in get_databases()]
+
+    def find(self):
+        querysets = self.get_shard_querysets()
+        for queryset in querysets:
+            obj = queryset.first()
+            # a stream being moved has rows on two databases, the copy on its old one is skipped
+            if obj is not None and (len(querysets) == 1 or get_shard(obj.streaming_id) == queryset.db):
+                return obj
+        return None
+
+    def update_all(self, **kwargs):
+        return sum(queryset.update(**kwargs) for queryset in self.get_shard_querysets())
+
+    def aggregate_by_stream(self, codes, value):
+        results = {}
+        for queryset in self.for_streams(codes):
+            results.update(
+                queryset
+                .order_by()
+                .values('streaming')
+                .annotate(value=value)
+                .values_list('streaming', 'value')
+            )
+        return results
+
+    def with_related(self, related, fields):
+        if not settings.DATABASE_SHARDS:
+            return self.select_related(*related).only(*fields)
+        # related rows are on the primary, one query per relation replaces the join
+        return self.only(*[field for field in fields if '__' not in field]).prefetch_related(*related)
+
+
+class ShardedManager(models.Manager.from_queryset(ShardedQuerySet)):
+    pass
+
+
+class ShardedModel(models.Model):
+    objects = ShardedManager()
+
+    class Meta:
+        abstract = True
+
+    def save(self, *args, **kwargs):
+        # ids come from one sequence so they stay unique across databases
+        if self.pk is None and settings.DATABASE_SHARDS:
+            self.pk = get_id_allocator(type(self)).allocate()
+            kwargs.setdefault('force_insert', True)
+        super().save(*args, **kwargs)
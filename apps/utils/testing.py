@@ -0,0 +1,19 @@
+from django.utils import timezone
+
+from apps.streaming.models import BankInfo, Streaming
+from apps.user.models import User
+
+
+class StreamingFixtures:
+    # the users and streams the test cases start from, mixed into TestCase and TransactionTestCase alike
+
+    def create_user(self, name):
+        return User.register(name, f'{name.lower().replace(" ", "")}@example.com', 'password')
+
+    def create_streaming(self, user):
+        return Streaming.create_streaming(
+            user=user,
+            start=timezone.now(),
+            end=timezone.now(),
+            bank=BankInfo('BCA', user.name, '1234567890'),
+        )
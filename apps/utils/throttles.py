@@ -0,0 +1,87 @@
+import math
+from rest_framework.throttling import SimpleRateThrottle
+
+from apps.utils.metrics import metrics
+
+
+class StreamRateThrottle(SimpleRateThrottle):
+    # Token bucket per user and stream holding `num_requests` tokens and refilled over `duration`, kept as the
+    # single time at which the bucket is full again (GCRA). Every allowed request pushes that time one refill
+    # interval further with the cache's atomic incr, so concurrent requests are counted without a read
+    # followed by a write, and a rejected request leaves the bucket untouched.
+    cache_format = 'throttle_%(scope)s_%(ident)s'
+    stream_field = 'streaming'
+
+    def __init__(self):
+        # the rate depends on the view's scope, so it is looked up in allow_request
+        pass
+
+    def allow_request(self, request, view):
+        self.scope = getattr(view, 'throttle_scope', None)
+        if not self.scope:
+            return True
+
+        self.rate = self.get_rate()
+        self.num_requests, self.duration = self.parse_rate(self.rate)
+        if self.rate is None:
+            return True
+
+        key = self.get_cache_key(request, view)
+        if key is None:
+            return True
+
+        # times are whole milliseconds so the cache can add to them
+        now = int(self.timer() * 1000)
+        interval = self.duration * 1000 // self.num_requests
+        # how far the full time may run ahead of now while a token is left
+        tolerance = self.duration * 1000 - interval
+
+        full_at = self.cache.get(key)
+        if full_at is not None and full_at - now > tolerance:
+            return self.reject(full_at - now - tolerance)
+
+        full_at = self.take(key, now, interval)
+        if full_at - interval - now > tolerance:
+            # a concurrent request took the last token between the get and the incr
+            return self.reject(full_at - interval - now - tolerance)
+        # the key expires once the bucket is full, the next request starts a fresh one at add
+        self.cache.touch(key, max(math.ceil((full_at - now) / 1000), 1))
+        return True
+
+    def take(self, key, now, interval):
+        self.cache.add(key, now, self.duration)
+        try:
+            full_at = self.cache.incr(key, interval)
+        except ValueError:
+            # the bucket expired between add and incr
+            full_at = now + interval
+            self.cache.set(key, full_at, self.duration)
+            return full_at
+
+        if full_at - interval < now:
+            # the bucket filled up before the key expired, its time moves up to now
+            full_at = self.cache.incr(key, now - (full_at - interval))
+        return full_at
+
+    def reject(self, wait_ms):
+        self.wait_time = wait_ms / 1000
+        metrics.incr(f'throttle.{self.scope}.rejected')
+        return False
+
+    def get_cache_key(self, request, view):
+        if not request.user.is_authenticated:
+            return None
+        return self.cache_format % {
+            'scope': self.scope,
+            'ident': f'{request.user.pk}_{self.get_stream(request)}',
+        }
+
+    def get_stream(self, request):
+        # parsing a multipart body would read the upload before the request can be rejected,
+        # those requests share one bucket per user instead
+        if request.content_type.startswith('multipart/') or not isinstance(request.data, dict):
+            return '*'
+        return request.data.get(self.stream_field) or '*'
+
+    def wait(self):
+        return self.wait_time
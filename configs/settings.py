@@ -95,10 +95,51 @@ DATABASES = {
         'PASSWORD': ENV('DB_PASSWORD'),
         'HOST': ENV('DB_HOST'),
         'PORT': ENV('DB_PORT'),
-        'ATOMIC_REQUESTS': True
+        'ATOMIC_REQUESTS': True,
+        'CONN_MAX_AGE': ENV.int('DB_CONN_MAX_AGE', default=60),
+        'CONN_HEALTH_CHECKS': True,
     }
 }
 
+# Read replicas share the primary's credentials. Viewsets using ReplicaReadMixin send their
+# read actions to them, unless the user wrote something in the last REPLICA_PIN_SECONDS.
+# That pin is kept in the default cache, so with replicas CACHE_URL must point at a cache shared
+# by every process, otherwise users only read their own writes on the process that served them.
+DATABASE_REPLICAS = []
+for index, host in enumerate(ENV.list('DB_REPLICA_HOSTS', default=[])):
+    alias = f'replica{index}'
+    DATABASES[alias] = {
+        **DATABASES['default'],
+        'HOST': host,
+        'ATOMIC_REQUESTS': False,
+        'TEST': {'MIRROR': 'default'},
+    }
+    DATABASE_REPLICAS.append(alias)
+
+REPLICA_PIN_SECONDS = ENV.int('REPLICA_PIN_SECONDS', default=5)
+
+# Donation and comment rows are spread over these databases by stream code. New streams are placed by hash,
+# older ones stay on the primary until moved with move_stream. Each shard is migrated with
+# `migrate --database shardN`; locally N sqlite files work, e.g. DB_SHARD_URLS=sqlite:////tmp/shard0.sqlite3
+DATABASE_SHARDS = []
+for index, url in enumerate(ENV.list('DB_SHARD_URLS', default=[])):
+    alias = f'shard{index}'
+    DATABASES[alias] = {
+        **ENV.db_url_config(url),
+        'CONN_MAX_AGE': DATABASES['default']['CONN_MAX_AGE'],
+        'CONN_HEALTH_CHECKS': True,
+    }
+    DATABASE_SHARDS.append(alias)
+
+DATABASE_ROUTERS = ['apps.utils.sharding.ShardRouter', 'apps.utils.db.ReplicaRouter']
+SHARD_PLACEMENT_CACHE_TTL = ENV.int('SHARD_PLACEMENT_CACHE_TTL', default=60)
+SHARD_ID_BLOCK_SIZE = ENV.int('SHARD_ID_BLOCK_SIZE', default=100)
+
+
+CACHES = {
+    'default': ENV.cache('CACHE_URL', default='locmemcache://'),
+}
+
 
 # Password validation
 # https://docs.djangoproject.com/en/4.2/ref/settings/#auth-password-validators
@@ -144,6 +185,14 @@ MEDIA_ROOT = APP_DIR / 'media'
 
 MEDIA_URL = 'media/'
 
+PAYMENT_UPLOAD_MAX_SIZE = ENV.int('PAYMENT_UPLOAD_MAX_SIZE', default=5 * 1024 * 1024)
+
+# Payment proofs are re-encoded in the background into a bounded image and a thumbnail.
+PAYMENT_IMAGE_FORMAT = ENV.str('PAYMENT_IMAGE_FORMAT', default='WEBP')
+PAYMENT_IMAGE_SIZE = ENV.int('PAYMENT_IMAGE_SIZE', default=1600)
+PAYMENT_THUMBNAIL_SIZE = ENV.int('PAYMENT_THUMBNAIL_SIZE', default=320)
+PAYMENT_IMAGE_WORKERS = ENV.int('PAYMENT_IMAGE_WORKERS', default=2)
+
 # Default primary key field type
 # https://docs.djangoproject.com/en/4.2/ref/settings/#default-auto-field
 
@@ -155,6 +204,11 @@ REST_FRAMEWORK = {
     ),
     'EXCEPTION_HANDLER': 'drf_standardized_errors.handler.exception_handler',
     'DEFAULT_PAGINATION_CLASS': 'apps.utils.paginations.Pagination',
+    # Token buckets per user and stream for creating comments and donations, kept in the default cache
+    'DEFAULT_THROTTLE_RATES': {
+        'comments': ENV.str('COMMENT_THROTTLE_RATE', default='20/min'),
+        'donations': ENV.str('DONATION_THROTTLE_RATE', default='10/min'),
+    },
 }
 
 SIMPLE_JWT = {
@@ -166,3 +220,62 @@ SIMPLE_JWT = {
 MIDTRANS_PRODUCTION = ENV.bool('MIDTRANS_PRODUCTION')
 MIDTRANS_SERVER_KEY = ENV.str('MIDTRANS_SERVER_KEY')
 MIDTRANS_CLIENT_KEY = ENV.str('MIDTRANS_CLIENT_KEY')
+MIDTRANS_CONNECT_TIMEOUT = ENV.float('MIDTRANS_CONNECT_TIMEOUT', default=3.05)
+MIDTRANS_READ_TIMEOUT = ENV.float('MIDTRANS_READ_TIMEOUT', default=15)
+MIDTRANS_POOL_SIZE = ENV.int('MIDTRANS_POOL_SIZE', default=10)
+MIDTRANS_MAX_RETRIES = ENV.int('MIDTRANS_MAX_RETRIES', default=2)
+
+# Apply the status carried by a signed notification instead of asking Midtrans for it again.
+# The signature covers order_id, status_code and gross_amount but not transaction_status, so only
+# statuses with a status_code of their own (pending, deny, expire) are trusted. Settlements share 200
+# with cancel and capture and are always looked up.
+MIDTRANS_TRUST_NOTIFICATION = ENV.bool('MIDTRANS_TRUST_NOTIFICATION', default=False)
+MIDTRANS_NOTIFICATION_CACHE_SIZE = ENV.int('MIDTRANS_NOTIFICATION_CACHE_SIZE', default=10000)
+
+# Charge instant payments from the run_payment_worker command instead of inside the request.
+MIDTRANS_ASYNC_CHARGE = ENV.bool('MIDTRANS_ASYNC_CHARGE', default=False)
+
+LEADERBOARD_CACHE_TTL = ENV.int('LEADERBOARD_CACHE_TTL', default=5)
+
+# Stream detail is invalidated on start, stop and donation success, the TTL only bounds missed invalidations
+STREAMING_CACHE_TTL = ENV.int('STREAMING_CACHE_TTL', default=60)
+
+# Live streams are ranked by donations and comments from the last STREAM_RANKING_WINDOW minutes
+STREAM_RANKING_WINDOW = ENV.int('STREAM_RANKING_WINDOW', default=15)
+STREAM_LIST_CACHE_TTL = ENV.int('STREAM_LIST_CACHE_TTL', default=5)
+
+# Creator dashboards are invalidated on donation and comment writes, the TTL only bounds missed invalidations
+STREAM_SUMMARY_CACHE_TTL = ENV.int('STREAM_SUMMARY_CACHE_TTL', default=300)
+
+# Pub/sub backend for live events. PostgresBroker fans events out across processes with LISTEN/NOTIFY.
+EVENT_BROKER = ENV.str('EVENT_BROKER', default='apps.utils.events.LocalBroker')
+# Last-Event-ID replay keeps the latest events of this many topics per process
+EVENT_HISTORY_TOPICS = ENV.int('EVENT_HISTORY_TOPICS', default=1000)
+
+# Server-Sent Events need the ASGI entry point (configs.asgi)
+SSE_HEARTBEAT = ENV.int('SSE_HEARTBEAT', default=15)
+SSE_MAX_DURATION = ENV.int('SSE_MAX_DURATION', default=300)
+SSE_RETRY_MS = ENV.int('SSE_RETRY_MS', default=2000)
+SSE_QUEUE_SIZE = ENV.int('SSE_QUEUE_SIZE', default=100)
+
+# Long-polled comments are served from a ring buffer of the latest comments per stream, filled from
+# EVENT_BROKER in commit order. The buffer sees the comments of every process only with a cross-process
+# broker such as PostgresBroker, with LocalBroker each process serves its own comments.
+COMMENT_BUFFER_SIZE = ENV.int('COMMENT_BUFFER_SIZE', default=200)
+COMMENT_BUFFER_STREAMS = ENV.int('COMMENT_BUFFER_STREAMS', default=1000)
+COMMENT_POLL_MAX_WAIT = ENV.int('COMMENT_POLL_MAX_WAIT', default=25)
+
+# Write-behind comment ingestion: comments get their id up front and are inserted in batches.
+# 'flushed' answers once the batch holding the comment is committed, 'buffered' answers as soon
+# as it is queued and loses queued comments if the process dies. Needs PostgreSQL for its id sequence.
+COMMENT_WRITE_BEHIND = ENV.bool('COMMENT_WRITE_BEHIND', default=False)
+COMMENT_WRITE_BEHIND_DURABILITY = ENV.str('COMMENT_WRITE_BEHIND_DURABILITY', default='flushed')
+COMMENT_WRITE_BEHIND_BATCH_SIZE = ENV.int('COMMENT_WRITE_BEHIND_BATCH_SIZE', default=500)
+COMMENT_WRITE_BEHIND_INTERVAL_MS = ENV.int('COMMENT_WRITE_BEHIND_INTERVAL_MS', default=50)
+COMMENT_WRITE_BEHIND_CAPACITY = ENV.int('COMMENT_WRITE_BEHIND_CAPACITY', default=10000)
+COMMENT_WRITE_BEHIND_TIMEOUT = ENV.int('COMMENT_WRITE_BEHIND_TIMEOUT', default=5)
+COMMENT_ID_BLOCK_SIZE = ENV.int('COMMENT_ID_BLOCK_SIZE', default=100)
+
+# Number of counter rows a stream's donation total and each of its rollup buckets are spread over.
+# Values above 1 avoid lock contention on the streaming row for very busy streams.
+DONATION_TOTAL_SHARDS = ENV.int('DONATION_TOTAL_SHARDS', default=1)
@@ -0,0 +1,12 @@
+from configs.settings import *  # noqa: F401,F403
+from configs.settings import BASE_DIR, DATABASES
+
+# the sharded code paths run against two sqlite files, listed in DATABASE_SHARDS by the tests that use them:
+# python manage.py test --settings=configs.settings_test
+DATABASES = {
+    **DATABASES,
+    **{
+        f'test_shard{index}': {'ENGINE': 'django.db.backends.sqlite3', 'NAME': BASE_DIR / f'test_shard{index}.sqlite3'}
+        for index in range(2)
+    },
+}
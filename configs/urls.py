@@ -22,4 +22,5 @@ urlpatterns = [
     path('api/', include('apps.user.api.urls')),
     path('api/', include('apps.streaming.api.urls')),
     path('api/', include('apps.donation.api.urls')),
+    path('api/', include('apps.utils.api.urls')),
 ]